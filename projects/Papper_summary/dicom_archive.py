@@ -0,0 +1,254 @@
+# dicom_archive.py
+# Archive sources (--archives): read DICOM members of ZIP / TAR files without extracting them
+#
+# Research datasets often arrive as .zip / .tar.gz bundles. With --archives
+# the crawler also accepts archive names (dicom_paths.ARCHIVE_SUFFIXES), and
+# this module replaces each archive by its member paths, recorded as
+# 'archive.zip!/member.dcm' (dicom_paths.member_path). Members carry the
+# stat of the archive, so an archive whose manifest rows still match its
+# stat is skipped as a whole on the next run without being opened.
+#
+# Extraction runs one task per archive: the archive is opened once and the
+# wanted members are visited in archive order (a single forward pass for a
+# compressed tar). Each member is wrapped in a MemberReader, so the header
+# parse pulls only the bytes it needs out of the archive and nothing is
+# written to disk.
+#
+# A changed .tar.gz / .tar.bz2 / .tar.xz is decompressed twice (listing,
+# then extraction); .zip and plain .tar listings only read the index / headers.
+import io
+import os
+import tarfile
+import time
+import zipfile
+import zlib
+from datetime import datetime
+
+from dicom_crawler import dcm_suffix_filter
+from dicom_failures import READ_ERROR, FailedFile, failed_file
+from dicom_fastread import SNIFF_BYTES, looks_like_dicom
+from dicom_manifest import archive_unchanged, manifest_entry
+from dicom_paths import is_archive_name, member_path, split_member_path
+
+# --- 設定 ---
+# Bytes pulled from a member stream per read while parsing its header
+MEMBER_READ_SIZE = 16384
+# Regular files per task when directory groups are mixed with archive groups
+MAX_GROUP_FILES = 2048
+ARCHIVE_ERRORS = (OSError, EOFError, zipfile.BadZipFile, zipfile.LargeZipFile, tarfile.TarError, zlib.error)
+
+
+def archive_name_filter(name_filter):
+    """Crawler name filter for --archives: name_filter's files plus archive files."""
+    return lambda name: is_archive_name(name) or name_filter(name)
+
+
+class ArchiveReader:
+    """One open .zip or .tar(.gz|.bz2|.xz) file: member listing and sequential member streams."""
+
+    def __init__(self, path):
+        self.path = path
+        self._zip = None
+        self._tar = None
+        if path.lower().endswith(".zip"):
+            self._zip = zipfile.ZipFile(path)
+        else:
+            self._tar = tarfile.open(path, "r:*")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        (self._zip or self._tar).close()
+
+    def members(self, name_filter):
+        """Names of the regular-file members whose base name passes name_filter, in archive order."""
+        if self._zip is not None:
+            return [info.filename for info in self._zip.infolist()
+                    if not info.is_dir() and name_filter(os.path.basename(info.filename))]
+        return [info.name for info in self._tar
+                if info.isfile() and name_filter(os.path.basename(info.name))]
+
+    def iter_open(self, wanted):
+        """Yield (member name, stream) for the names in wanted, in archive order.
+
+        A stream is only valid until the next item; iteration stops once
+        every wanted member has been seen (the rest of a tar is not read).
+        """
+        remaining = set(wanted)
+        if self._zip is not None:
+            for info in self._zip.infolist():
+                if info.filename in remaining:
+                    remaining.discard(info.filename)
+                    with self._zip.open(info) as stream:
+                        yield info.filename, stream
+                    if not remaining:
+                        return
+            return
+        for info in self._tar:
+            if info.isfile() and info.name in remaining:
+                remaining.discard(info.name)
+                yield info.name, self._tar.extractfile(info)
+                if not remaining:
+                    return
+
+
+class MemberReader(io.RawIOBase):
+    """Seekable view of a forward-only member stream.
+
+    Bytes are pulled from the archive only when the parser asks for them and
+    are kept, so the pydicom fallback can seek back to the start without
+    reopening the member (for a compressed tar that would mean decompressing
+    the archive up to the member again).
+    """
+
+    def __init__(self, stream, name):
+        super().__init__()
+        self.name = name
+        self._stream = stream
+        self._buffer = bytearray()
+        self._pos = 0
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _fill(self, end):
+        """Buffer the stream up to offset end (None: to the end of the member)."""
+        while not self._eof and (end is None or len(self._buffer) < end):
+            size = MEMBER_READ_SIZE if end is None else max(MEMBER_READ_SIZE, end - len(self._buffer))
+            data = self._stream.read(size)
+            if data:
+                self._buffer += data
+            else:
+                self._eof = True
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        end = None if size is None or size < 0 else self._pos + size
+        self._fill(end)
+        data = bytes(self._buffer[self._pos:end])
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            self._fill(None)
+            offset += len(self._buffer)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+def iter_expanded(entries, conn, name_filter, with_stat=False, skip_unchanged=True, counts=None, verbose=True):
+    """Phase 2 (streaming, --archives): replace archive paths by their member paths.
+
+    entries are paths, or (path, stat) pairs with with_stat (rescan); other
+    files and gone archives (stat None) pass through unchanged. Members
+    yield the archive's stat. An archive whose manifest rows match its
+    current stat is dropped without being opened, unless skip_unchanged is
+    False (--retry-failed). A counts dict, if given, receives archives /
+    unchanged / unreadable / members totals.
+    """
+    if counts is None:
+        counts = {}
+    for key in ("archives", "unchanged", "unreadable", "members"):
+        counts.setdefault(key, 0)
+    if verbose:
+        print(f"[{datetime.now()}] Phase 2: Listing archive members...")
+    start_time = time.time()
+    for entry in entries:
+        path, st = entry if with_stat else (entry, None)
+        if not is_archive_name(path) or (with_stat and st is None):
+            # (path, None): a listed archive that is gone, iter_changed_files() removes its members
+            yield entry
+            continue
+        counts["archives"] += 1
+        try:
+            if st is None:
+                st = os.stat(path)
+            if skip_unchanged and archive_unchanged(conn, path, st):
+                counts["unchanged"] += 1
+                continue
+            with ArchiveReader(path) as reader:
+                members = reader.members(name_filter)
+        except ARCHIVE_ERRORS as e:
+            counts["unreadable"] += 1
+            print(f"Warning: cannot list archive {path}: {e}")
+            continue
+        counts["members"] += len(members)
+        for member in members:
+            yield (member_path(path, member), st) if with_stat else member_path(path, member)
+    if verbose:
+        print(f"[{datetime.now()}] Phase 2: Archive listing complete in {time.time() - start_time:.2f} seconds. "
+              f"Archives: {counts['archives']} | Unchanged (skipped): {counts['unchanged']} | "
+              f"Unreadable: {counts['unreadable']} | Members listed: {counts['members']}")
+
+
+def iter_source_groups(paths, max_group=MAX_GROUP_FILES):
+    """Group consecutive paths by archive (members) or parent directory (regular files).
+
+    An archive group is never split, so each archive is opened once per run.
+    """
+    group = []
+    current_key = None
+    for path in paths:
+        archive, member = split_member_path(path)
+        key = archive if member is not None else os.path.dirname(path)
+        if group and (key != current_key or (member is None and len(group) >= max_group)):
+            yield group
+            group = []
+        current_key = key
+        group.append(path)
+    if group:
+        yield group
+
+
+def extract_archive_group(paths, extract_func, sniff=False):
+    """Worker task for the members of one archive; returns (attempted, [(row, manifest entry) / FailedFile, ...]).
+
+    extract_func(path, source=stream) is the parse of dicom_ingest
+    (extract_metadata_only). With sniff, members not named *.dcm are read
+    only if their first 132 bytes look like DICOM; the others are dropped.
+    """
+    archive = split_member_path(paths[0])[0]
+    wanted = {split_member_path(path)[1]: path for path in paths}
+    results = []
+    st = None
+    try:
+        st = os.stat(archive)
+        with ArchiveReader(archive) as reader:
+            for member, stream in reader.iter_open(wanted):
+                path = wanted.pop(member)
+                source = MemberReader(stream, path)
+                if sniff and not dcm_suffix_filter(member):
+                    if not looks_like_dicom(source.read(SNIFF_BYTES)):
+                        continue
+                    source.seek(0)
+                result = extract_func(path, source=source)
+                if isinstance(result, FailedFile):
+                    results.append(failed_file(path, st, result.error_class, result.message))
+                else:
+                    row, sop_instance_uid = result
+                    results.append((row, manifest_entry(path, st, sop_instance_uid)))
+        error = "member not found in archive"
+    except ARCHIVE_ERRORS as e:
+        print(f"Error reading archive {archive}: {e}")
+        error = e
+    # Members not reached (archive gone, truncated or rewritten since the listing)
+    results.extend(failed_file(path, st, READ_ERROR, error) for path in wanted.values())
+    return len(paths), results
@@ -0,0 +1,157 @@
+# dicom_autotune.py
+# Extraction concurrency autotuning (--autotune): hill-climb the number of workers on observed throughput
+#
+# os.cpu_count() workers is wrong on both storage tiers: on local NVMe extra
+# threads only fight over the GIL, on NFS far more are needed to hide the
+# network latency. With --autotune the engine pool is sized for an upper
+# bound and the AutoTuner decides how many tasks run at once (the in-flight
+# window, dicom_engine.iter_extracted). Every window of AUTOTUNE_WINDOW_SECONDS
+# it compares completed files/sec with the previous setting:
+#   - better: keep going in the same direction (doubling the step until the first setback)
+#   - worse: turn around with half the step
+#   - no clear change: try fewer workers (the extra ones buy nothing)
+# The first move (and the one after a drift, see below) goes up when per-file
+# time is mostly open / read (I/O wait) and down when it is mostly parsing.
+# It settles once a step of one worker no longer helps, logs the setting
+# (to be pinned with -w next time) and keeps watching: a throughput change
+# of more than AUTOTUNE_DRIFT (storage load, different tree) resumes the climb.
+import os
+import time
+from datetime import datetime
+
+# --- 設定 ---
+AUTOTUNE_MIN_WORKERS = 1
+# Upper bound per engine: threads are cheap and hide I/O latency, processes cost a core and memory each
+AUTOTUNE_MAX_THREADS = max(64, 8 * (os.cpu_count() or 4))
+AUTOTUNE_MAX_PROCESSES = 2 * (os.cpu_count() or 4)
+# Throughput is measured over at least this many seconds and files per setting
+AUTOTUNE_WINDOW_SECONDS = 10.0
+AUTOTUNE_WINDOW_FILES = 200
+# Relative throughput change treated as noise
+AUTOTUNE_TOLERANCE = 0.05
+# Share of per-file time spent in open + read above which a file counts as I/O-bound
+IO_BOUND_SHARE = 0.5
+# Relative change of the settled throughput that restarts the climb
+AUTOTUNE_DRIFT = 0.3
+
+
+def default_autotune_max(engine):
+    """Upper worker bound for an engine ('thread': AUTOTUNE_MAX_THREADS, process engines: AUTOTUNE_MAX_PROCESSES)."""
+    return AUTOTUNE_MAX_THREADS if engine == "thread" else AUTOTUNE_MAX_PROCESSES
+
+
+class AutoTuner:
+    """Hill-climbing controller for the number of extraction tasks running at once.
+
+    The engine reads `limit` whenever it tops up its window; the collection
+    loop reports completed files (and per-file timings, when the workers
+    return them) through observe().
+    """
+
+    def __init__(self, start, max_workers, min_workers=AUTOTUNE_MIN_WORKERS, window_seconds=AUTOTUNE_WINDOW_SECONDS):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.limit = self._clamp(start)
+        self.window_seconds = window_seconds
+        self.settled = False
+        self.rates = {} # workers -> files/sec of the latest window at that setting
+        self._step = max(1, self.limit // 2)
+        self._direction = 0 # chosen after the first window
+        self._expanding = True # step doubles while every move improves throughput
+        self._previous_rate = None
+        self._settled_rate = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._files = 0
+        self._io_seconds = 0.0
+        self._file_seconds = 0.0
+
+    def observe(self, attempted, timed_results=()):
+        """Count completed files; dicom_metrics.TimedResult rows add their open / read vs. total time."""
+        self._files += attempted
+        for timed in timed_results:
+            timings = timed.timings
+            self._io_seconds += timings.get("open", 0.0) + timings.get("read", 0.0)
+            self._file_seconds += timings.get("total", 0.0)
+        elapsed = time.monotonic() - self._window_start
+        if elapsed >= self.window_seconds and self._files >= AUTOTUNE_WINDOW_FILES:
+            self._adjust(self._files / elapsed)
+            self._reset_window()
+
+    def io_share(self):
+        """Share of per-file time spent opening / reading in the current window (None without timings)."""
+        return self._io_seconds / self._file_seconds if self._file_seconds > 0 else None
+
+    def _adjust(self, rate):
+        io_share = self.io_share()
+        io_bound = io_share is not None and io_share > IO_BOUND_SHARE
+        self.rates[self.limit] = rate
+        detail = f"{rate:.0f} files/sec" + (f", I/O {io_share:.0%} of file time" if io_share is not None else "")
+        if self.settled:
+            if abs(rate - self._settled_rate) <= AUTOTUNE_DRIFT * self._settled_rate:
+                return
+            print(f"[{datetime.now()}] Autotune: throughput moved from {self._settled_rate:.0f} to {detail} "
+                  f"at {self.limit} workers, resuming")
+            self.settled = False
+            self.rates = {self.limit: rate} # earlier measurements no longer apply
+            self._step = max(1, self.limit // 2)
+            self._expanding = True
+            self._direction = 1 if io_bound else -1
+        elif self._previous_rate is None:
+            # First window: I/O-bound files want more concurrency, parse-bound ones less
+            self._direction = 1 if io_bound else -1
+        elif rate > self._previous_rate * (1 + AUTOTUNE_TOLERANCE):
+            if self._expanding:
+                self._step *= 2
+        elif self._step == 1:
+            # A step of one worker no longer helps: local optimum
+            self._settle()
+            return
+        else:
+            self._expanding = False
+            self._step //= 2
+            if rate < self._previous_rate * (1 - AUTOTUNE_TOLERANCE):
+                self._direction = -self._direction
+            else:
+                # No clear change: the extra workers buy nothing, try the cheaper side
+                self._direction = -1
+        self._previous_rate = rate
+        target = self.limit + self._direction * self._step
+        new_limit = self._clamp(target)
+        if new_limit != target:
+            self._expanding = False
+        if new_limit == self.limit:
+            # At a bound: turn around
+            self._expanding = False
+            self._direction = -self._direction
+            self._step = max(1, self._step // 2)
+            new_limit = self._clamp(self.limit + self._direction * self._step)
+        if new_limit == self.limit:
+            self._settle()
+            return
+        print(f"[{datetime.now()}] Autotune: {self.limit} -> {new_limit} workers ({detail} at {self.limit})")
+        self.limit = new_limit
+
+    def _clamp(self, workers):
+        return min(max(workers, self.min_workers), self.max_workers)
+
+    def _settle(self):
+        """Pick the fewest workers within AUTOTUNE_TOLERANCE of the best measured rate and stop climbing."""
+        best_rate = max(self.rates.values())
+        self.limit = min(workers for workers, rate in self.rates.items()
+                         if rate >= best_rate * (1 - AUTOTUNE_TOLERANCE))
+        self._settled_rate = self.rates[self.limit]
+        self.settled = True
+        self._previous_rate = None
+        self._expanding = False
+        self._step = 1
+        print(f"[{datetime.now()}] Autotune: settled on {self.limit} workers ({self._settled_rate:.0f} files/sec); "
+              f"pin it with -w {self.limit}")
+
+    def describe(self):
+        """One-line summary for the end of the run."""
+        tried = ", ".join(f"{workers}: {rate:.0f}" for workers, rate in sorted(self.rates.items()))
+        state = "settled on" if self.settled else "still climbing, last setting"
+        return f"Autotune {state} {self.limit} workers (files/sec per setting: {tried or 'no full window'})"
@@ -0,0 +1,497 @@
+# dicom_bench.py
+# Benchmark harness: reproducible synthetic DICOM corpora + per-phase throughput reports
+#
+# Usage:
+#   python dicom_bench.py generate /tmp/corpus --files 20000 --files-per-series 200 --broken 0.02
+#   python dicom_bench.py run /tmp/corpus -w 8 -e process -o bench_$(git rev-parse --short HEAD).json
+#   python dicom_bench.py compare bench_old.json bench_new.json
+#
+# `run` times each phase on its own (scan, filter, extract, insert) and the whole
+# pipeline (dicom_metadata2.main) against scratch databases, then writes one JSON
+# report (files/sec, MB/s, p50/p99 latency, peak RSS) that can be diffed across commits.
+# Each phase runs in its own freshly spawned process, so its peak RSS is its own
+# (inputs included; the worker processes of the process / hybrid engines are not).
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, generate_uid
+
+import dicom_ingest as ingest
+import dicom_metadata2
+from dicom_engine import ENGINES, DEFAULT_ENGINE, DEFAULT_CHUNK_SIZE, DEFAULT_IO_THREADS, iter_extracted
+from dicom_filter import filter_unprocessed_files
+from dicom_writer import DbWriter, configure_connection
+
+# --- 設定 ---
+PHASES = ("scan", "filter", "extract", "insert", "e2e")
+CORPUS_INFO_FILE = "corpus.json"
+DEFAULT_SEED = 1234
+MODALITIES = ("CT", "MR", "PT", "CR", "US")
+SOP_CLASSES = {
+    "CT": "1.2.840.10008.5.1.4.1.1.2", "MR": "1.2.840.10008.5.1.4.1.1.4", "PT": "1.2.840.10008.5.1.4.1.1.128",
+    "CR": "1.2.840.10008.5.1.4.1.1.1", "US": "1.2.840.10008.5.1.4.1.1.6.1",
+}
+BROKEN_KINDS = ("truncated", "not_dicom", "no_sop_class")
+
+
+# --- Corpus generator ---
+
+def _uid(seed, *parts):
+    # Deterministic UIDs: the same seed always produces the same corpus
+    # (one delimited source: generate_uid concatenates its sources, so ("instance", 1, 14) would equal ("instance", 11, 4))
+    return generate_uid(entropy_srcs=["|".join([str(seed)] + [str(p) for p in parts])])
+
+
+def _instance(rng, seed, series_key, study, series, number, header_bytes, private_items):
+    ds = Dataset()
+    ds.SOPClassUID = SOP_CLASSES[series["modality"]]
+    ds.SOPInstanceUID = _uid(seed, "instance", series_key, number)
+    ds.StudyDate = study["date"]
+    ds.SeriesDate = study["date"]
+    ds.AcquisitionDate = study["date"]
+    ds.ContentDate = study["date"]
+    ds.StudyTime = study["time"]
+    ds.SeriesTime = series["time"]
+    ds.AcquisitionTime = f"{series['time'][:4]}{number % 60:02d}.{number:06d}"
+    ds.Modality = series["modality"]
+    ds.Manufacturer = "BENCH"
+    ds.InstitutionName = "Synthetic Hospital"
+    ds.StudyDescription = study["description"]
+    ds.SeriesDescription = series["description"]
+    ds.PatientID = study["patient_id"]
+    ds.PatientSex = study["sex"]
+    ds.PatientAge = study["age"]
+    ds.SliceThickness = series["thickness"]
+    ds.StudyInstanceUID = study["uid"]
+    ds.SeriesInstanceUID = series["uid"]
+    ds.InstanceNumber = number
+    if header_bytes or private_items:
+        ds.add_new((0x0009, 0x0010), "LO", "BENCH PRIVATE")
+    if header_bytes:
+        ds.add_new((0x0009, 0x1001), "OB", bytes(rng.getrandbits(8) for _ in range(16)) * (header_bytes // 16))
+    if private_items:
+        # Private sequence of nested items (the kind vendor headers carry before the standard tags)
+        items = []
+        for i in range(private_items):
+            item = Dataset()
+            item.add_new((0x0009, 0x0010), "LO", "BENCH PRIVATE")
+            item.add_new((0x0009, 0x1010), "LO", f"item {i}")
+            item.ReferencedSOPInstanceUID = _uid(seed, "ref", series_key, number, i)
+            items.append(item)
+        ds.add_new((0x0009, 0x1002), "SQ", Sequence(items))
+    return ds
+
+
+def _save(ds, path, transfer_syntax, pixel_bytes):
+    ds.PixelData = b"\0" * pixel_bytes
+    ds["PixelData"].VR = "OB"
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = ds.get("SOPClassUID", "1.2.840.10008.1.3.10")
+    meta.MediaStorageSOPInstanceUID = ds.get("SOPInstanceUID", generate_uid())
+    meta.TransferSyntaxUID = transfer_syntax
+    ds.file_meta = meta
+    ds.save_as(path, enforce_file_format=True)
+
+
+def generate_corpus(out_dir, files=10000, files_per_series=100, depth=3, header_bytes=2048,
+                    private_items=4, pixel_bytes=1024, broken=0.01, seed=DEFAULT_SEED):
+    """Write a reproducible synthetic corpus under out_dir (root/<depth-2 levels>/patient/study/series/IMn.dcm)."""
+    rng = random.Random(seed)
+    print(f"[{datetime.now()}] Generating {files} files in {out_dir} (seed {seed})...")
+    start_time = time.time()
+    written = 0
+    broken_count = 0
+    series_index = 0
+    while written < files:
+        patient = series_index // 4
+        study_index = series_index // 2
+        study = {
+            "uid": _uid(seed, "study", study_index),
+            "date": f"20{rng.randint(10, 24):02d}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}",
+            "time": f"{rng.randint(7, 19):02d}{rng.randint(0, 59):02d}{rng.randint(0, 59):02d}",
+            "description": rng.choice(("BRAIN", "CHEST", "ABDOMEN", "KNEE")),
+            "patient_id": f"BENCH{patient:07d}",
+            "sex": rng.choice("MF"),
+            "age": f"{rng.randint(1, 95):03d}Y",
+        }
+        modality = rng.choice(MODALITIES)
+        series = {
+            "uid": _uid(seed, "series", series_index),
+            "modality": modality,
+            "time": f"{rng.randint(7, 19):02d}{rng.randint(0, 59):02d}{rng.randint(0, 59):02d}",
+            "description": f"{modality} series {series_index}",
+            "thickness": rng.choice(("0.625", "1.0", "2.5", "5.0")),
+        }
+        # Spread series over depth-2 levels of bucket directories above patient/study/series
+        buckets = [f"d{(series_index >> (4 * level)) % 16:x}" for level in range(max(0, depth - 3))]
+        series_dir = os.path.join(out_dir, *buckets, f"patient{patient}", f"study{study_index}", f"series{series_index}")
+        os.makedirs(series_dir, exist_ok=True)
+        for number in range(min(files_per_series, files - written)):
+            path = os.path.join(series_dir, f"IM{number}.dcm")
+            transfer_syntax = ExplicitVRLittleEndian if rng.random() < 0.8 else ImplicitVRLittleEndian
+            if rng.random() < broken:
+                kind = rng.choice(BROKEN_KINDS)
+                broken_count += 1
+                if kind == "not_dicom":
+                    with open(path, "wb") as f:
+                        f.write(bytes(rng.getrandbits(8) for _ in range(512)))
+                else:
+                    ds = _instance(rng, seed, series_index, study, series, number, header_bytes, private_items)
+                    if kind == "no_sop_class":
+                        del ds.SOPClassUID
+                    _save(ds, path, transfer_syntax, pixel_bytes)
+                    if kind == "truncated":
+                        with open(path, "r+b") as f:
+                            f.truncate(200)
+            else:
+                ds = _instance(rng, seed, series_index, study, series, number, header_bytes, private_items)
+                _save(ds, path, transfer_syntax, pixel_bytes)
+            written += 1
+        series_index += 1
+    info = {"files": files, "files_per_series": files_per_series, "depth": depth, "header_bytes": header_bytes,
+            "private_items": private_items, "pixel_bytes": pixel_bytes, "broken": broken, "seed": seed,
+            "broken_files": broken_count, "series": series_index}
+    with open(os.path.join(out_dir, CORPUS_INFO_FILE), "w") as f:
+        json.dump(info, f, indent=2)
+    print(f"[{datetime.now()}] Generated {written} files ({broken_count} broken, {series_index} series) "
+          f"in {time.time() - start_time:.2f} seconds.")
+    return info
+
+
+# --- Measurements ---
+
+def timed_extract(file_path):
+    """Engine task for the extract phase: (seconds, file size, extract_metadata_row result)."""
+    start = time.perf_counter()
+    result = ingest.extract_metadata_row(file_path)
+    elapsed = time.perf_counter() - start
+    try:
+        size = os.path.getsize(file_path)
+    except OSError:
+        size = 0
+    return elapsed, size, result
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _phase_child(func, args):
+    """Runs in the phase's own process: (func's report, the process's peak RSS in MB)."""
+    report = func(*args)
+    # ru_maxrss is in KiB on Linux; it is a high-water mark that never goes down
+    return report, round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _run_phase(func, *args):
+    """Run a bench_* phase in a freshly spawned process and add its peak RSS to the report.
+
+    Measured in this process, the peak would be that of the largest earlier
+    phase; inputs are passed as files in the work directory instead.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        report, peak_rss = pool.submit(_phase_child, func, args).result()
+    report["peak_rss_mb"] = peak_rss
+    return report
+
+
+def _read_paths(paths_file):
+    with open(paths_file, encoding="utf-8", errors="surrogateescape") as f:
+        return f.read().splitlines()
+
+
+def _phase_report(files, seconds, nbytes=None, latencies=None, latency_unit="file"):
+    report = {
+        "files": files,
+        "seconds": round(seconds, 4),
+        "files_per_sec": round(files / seconds, 1) if seconds > 0 else None,
+        "mb_per_sec": round(nbytes / 1e6 / seconds, 2) if nbytes is not None and seconds > 0 else None,
+    }
+    if latencies:
+        report[f"p50_ms_per_{latency_unit}"] = round(_percentile(latencies, 0.50) * 1000, 3)
+        report[f"p99_ms_per_{latency_unit}"] = round(_percentile(latencies, 0.99) * 1000, 3)
+    return report
+
+
+def _fresh_db(work_dir, name):
+    db_file = os.path.join(work_dir, name)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+    conn = sqlite3.connect(db_file, timeout=30.0)
+    configure_connection(conn)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ingest.create_db_table(conn)
+        ingest.create_manifest_table(conn)
+        ingest.create_failure_table(conn)
+    return db_file, conn
+
+
+def bench_scan(corpus_dir, scan_threads, paths_file):
+    """Scan phase; the path list the later phases work on goes to paths_file."""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        paths = list(dicom_metadata2.scan_all_dicom_files([corpus_dir], scan_threads))
+    report = _phase_report(len(paths), time.perf_counter() - start)
+    with open(paths_file, "w", encoding="utf-8", errors="surrogateescape") as f:
+        f.writelines(p + "\n" for p in paths)
+    return report
+
+
+def bench_filter(paths_file, work_dir, known_fraction):
+    """Filter phase against a DB that already holds known_fraction of the paths."""
+    paths = _read_paths(paths_file)
+    db_file, conn = _fresh_db(work_dir, "bench_filter.db")
+    known = paths[::max(1, round(1 / known_fraction))] if known_fraction > 0 else []
+    conn.executemany("INSERT INTO dicom_metadata (file_path) VALUES (?)", ((p,) for p in known))
+    conn.commit()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        new_paths = sum(1 for _ in filter_unprocessed_files(iter(paths), conn))
+    report = _phase_report(len(paths), time.perf_counter() - start)
+    report["already_processed"] = len(paths) - new_paths
+    conn.close()
+    return report
+
+
+def bench_extract(paths_file, engine, workers, chunk_size, io_threads, results_file=None):
+    """Extract phase; with results_file the extracted rows are pickled there for the insert phase."""
+    paths = _read_paths(paths_file)
+    latencies = []
+    results = []
+    nbytes = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _, rows in iter_extracted(timed_extract, paths, engine, workers, chunk_size, io_threads):
+            for elapsed, size, result in rows:
+                latencies.append(elapsed)
+                nbytes += size
+                if result is not None:
+                    results.append(result)
+    report = _phase_report(len(paths), time.perf_counter() - start, nbytes, latencies)
+    report["failed"] = sum(1 for r in results if isinstance(r, ingest.FailedFile))
+    if results_file:
+        with open(results_file, "wb") as f:
+            pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return report
+
+
+def bench_insert(results_file, work_dir, batch_size, commit_rows, commit_seconds):
+    with open(results_file, "rb") as f:
+        results = pickle.load(f)
+    db_file, conn = _fresh_db(work_dir, "bench_insert.db")
+    conn.close()
+    latencies = []
+
+    def timed_insert(conn, batch):
+        batch_start = time.perf_counter()
+        inserted = ingest.insert_batch(conn, batch)
+        latencies.append(time.perf_counter() - batch_start)
+        return inserted
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        writer = DbWriter(db_file, timed_insert, commit_rows, commit_seconds).start()
+        try:
+            for i in range(0, len(results), batch_size):
+                writer.submit(results[i:i + batch_size])
+        finally:
+            writer.close()
+    report = _phase_report(len(results), time.perf_counter() - start, latencies=latencies, latency_unit="batch")
+    report["commits"] = writer.commit_count
+    return report
+
+
+def bench_e2e(corpus_dir, work_dir, args, nbytes):
+    db_file, conn = _fresh_db(work_dir, "bench_e2e.db")
+    conn.close()
+    os.remove(db_file) # main() creates it like a first run would
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        options = ingest.IngestOptions(max_workers=args.workers, batch_size=args.batchsize, engine=args.engine,
+                                       chunk_size=args.chunksize, io_threads=args.io_threads,
+                                       scan_threads=args.scan_threads, commit_rows=args.commit_rows,
+                                       commit_seconds=args.commit_seconds, schema=args.schema,
+                                       series_sample=args.series_sample)
+        dicom_metadata2.main([corpus_dir], db_file, options)
+    seconds = time.perf_counter() - start
+    conn = sqlite3.connect(db_file)
+    files = conn.execute("SELECT COUNT(*) FROM file_manifest").fetchone()[0]
+    failed = conn.execute("SELECT COUNT(*) FROM file_failures").fetchone()[0]
+    conn.close()
+    report = _phase_report(files + failed, seconds, nbytes)
+    report["ingested"] = files
+    report["failed"] = failed
+    return report
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    corpus_dir = os.path.abspath(args.corpus)
+    phases = args.phases.split(",")
+    unknown = [p for p in phases if p not in PHASES]
+    if unknown:
+        print(f"Error: unknown phase(s) {', '.join(unknown)} (expected {', '.join(PHASES)})")
+        sys.exit(1)
+    corpus_info = None
+    info_file = os.path.join(corpus_dir, CORPUS_INFO_FILE)
+    if os.path.exists(info_file):
+        with open(info_file) as f:
+            corpus_info = json.load(f)
+
+    work_dir = tempfile.mkdtemp(prefix="dicom_bench_", dir=args.work_dir)
+    report = {
+        "revision": _git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "corpus": {"path": corpus_dir, "info": corpus_info},
+        "params": {"engine": args.engine, "workers": args.workers, "batch_size": args.batchsize,
+                   "chunk_size": args.chunksize, "io_threads": args.io_threads, "scan_threads": args.scan_threads,
+                   "commit_rows": args.commit_rows, "commit_seconds": args.commit_seconds,
+                   "schema": args.schema, "series_sample": args.series_sample},
+        "phases": {},
+    }
+    try:
+        # The scan always runs: the later phases work on its path list
+        print(f"[{datetime.now()}] Phase scan...")
+        paths_file = os.path.join(work_dir, "paths.txt")
+        report["phases"]["scan"] = _run_phase(bench_scan, corpus_dir, args.scan_threads, paths_file)
+        paths = _read_paths(paths_file)
+        nbytes = sum(os.path.getsize(p) for p in paths)
+        report["corpus"]["files"] = len(paths)
+        report["corpus"]["bytes"] = nbytes
+        del paths
+        if "scan" not in phases:
+            del report["phases"]["scan"]
+        if "filter" in phases:
+            print(f"[{datetime.now()}] Phase filter...")
+            report["phases"]["filter"] = _run_phase(bench_filter, paths_file, work_dir, args.known_fraction)
+        results_file = os.path.join(work_dir, "results.pickle") if "insert" in phases else None
+        if "extract" in phases or "insert" in phases:
+            print(f"[{datetime.now()}] Phase extract...")
+            extract_report = _run_phase(bench_extract, paths_file, args.engine, args.workers, args.chunksize,
+                                        args.io_threads, results_file)
+            if "extract" in phases:
+                report["phases"]["extract"] = extract_report
+        if "insert" in phases:
+            print(f"[{datetime.now()}] Phase insert...")
+            report["phases"]["insert"] = _run_phase(bench_insert, results_file, work_dir, args.batchsize,
+                                                    args.commit_rows, args.commit_seconds)
+        if "e2e" in phases:
+            print(f"[{datetime.now()}] Phase e2e (dicom_metadata2.main)...")
+            report["phases"]["e2e"] = _run_phase(bench_e2e, corpus_dir, work_dir, args, nbytes)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for phase, values in report["phases"].items():
+        print(f"{phase:<8} " + " | ".join(f"{k}: {v}" for k, v in values.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    return report
+
+
+def compare_reports(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print(f"{'':<8} {'metric':<22} {old.get('revision') or old_file:>14} {new.get('revision') or new_file:>14} {'change':>9}")
+    for phase, new_values in new["phases"].items():
+        old_values = old["phases"].get(phase, {})
+        for metric, new_value in new_values.items():
+            old_value = old_values.get(metric)
+            if not isinstance(new_value, (int, float)) or not isinstance(old_value, (int, float)):
+                continue
+            change = f"{(new_value - old_value) / old_value * 100:+.1f}%" if old_value else ""
+            print(f"{phase:<8} {metric:<22} {old_value:>14} {new_value:>14} {change:>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DICOM ingestion benchmark harness.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_gen = sub.add_parser("generate", help="Write a reproducible synthetic DICOM corpus.")
+    p_gen.add_argument("out_dir", type=str, help="Directory to create the corpus in.")
+    p_gen.add_argument("--files", type=int, default=10000, help="Number of files (default: 10000).")
+    p_gen.add_argument("--files-per-series", type=int, default=100, help="Files per series directory (default: 100).")
+    p_gen.add_argument("--depth", type=int, default=3,
+                       help="Directory levels per file, at least 3 (patient/study/series) (default: 3).")
+    p_gen.add_argument("--header-bytes", type=int, default=2048,
+                       help="Size of a private OB element placed before the standard tags (default: 2048).")
+    p_gen.add_argument("--private-items", type=int, default=4,
+                       help="Items in a private sequence per file, 0 for none (default: 4).")
+    p_gen.add_argument("--pixel-bytes", type=int, default=1024, help="Pixel data size (default: 1024).")
+    p_gen.add_argument("--broken", type=float, default=0.01,
+                       help="Fraction of broken files: truncated, not DICOM, no SOPClassUID (default: 0.01).")
+    p_gen.add_argument("--seed", type=int, default=DEFAULT_SEED, help=f"Random seed (default: {DEFAULT_SEED}).")
+
+    p_run = sub.add_parser("run", help="Time scan / filter / extract / insert separately and end to end.")
+    p_run.add_argument("corpus", type=str, help="Corpus directory (e.g. from 'generate').")
+    p_run.add_argument("--phases", type=str, default=",".join(PHASES),
+                       help=f"Comma-separated phases to run (default: {','.join(PHASES)}).")
+    p_run.add_argument("-o", "--output", type=str, default=None, help="Write the JSON report here.")
+    p_run.add_argument("-w", "--workers", type=int, default=ingest.DEFAULT_MAX_WORKERS,
+                       help=f"Extraction workers (default: {ingest.DEFAULT_MAX_WORKERS}).")
+    p_run.add_argument("-b", "--batchsize", type=int, default=ingest.DB_BATCH_SIZE,
+                       help=f"Insert batch size (default: {ingest.DB_BATCH_SIZE}).")
+    p_run.add_argument("-e", "--engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                       help=f"Extraction engine (default: {DEFAULT_ENGINE}).")
+    p_run.add_argument("--chunksize", type=int, default=DEFAULT_CHUNK_SIZE,
+                       help=f"Files per worker task for the process/hybrid engines (default: {DEFAULT_CHUNK_SIZE}).")
+    p_run.add_argument("--io-threads", type=int, default=DEFAULT_IO_THREADS,
+                       help=f"I/O threads per worker process for the hybrid engine (default: {DEFAULT_IO_THREADS}).")
+    p_run.add_argument("-s", "--scan-threads", type=int, default=ingest.DEFAULT_SCAN_THREADS,
+                       help=f"Directory scan threads (default: {ingest.DEFAULT_SCAN_THREADS}).")
+    p_run.add_argument("--commit-rows", type=int, default=ingest.DEFAULT_COMMIT_ROWS,
+                       help=f"Commit after this many rows (default: {ingest.DEFAULT_COMMIT_ROWS}).")
+    p_run.add_argument("--commit-seconds", type=float, default=ingest.DEFAULT_COMMIT_SECONDS,
+                       help=f"Commit at least this often (default: {ingest.DEFAULT_COMMIT_SECONDS}).")
+    p_run.add_argument("--schema", choices=("flat", "normalized"), default="flat",
+                       help="Schema for the end-to-end run (default: flat).")
+    p_run.add_argument("--series-sample", type=int, default=0, metavar="N",
+                       help="Run the end-to-end phase in series-sampling mode with N files per directory.")
+    p_run.add_argument("--known-fraction", type=float, default=0.5,
+                       help="Fraction of paths already in the DB for the filter phase (default: 0.5).")
+    p_run.add_argument("--work-dir", type=str, default=None,
+                       help="Where the scratch databases go (default: system temp dir).")
+
+    p_cmp = sub.add_parser("compare", help="Compare two JSON reports (e.g. from two commits).")
+    p_cmp.add_argument("old", type=str)
+    p_cmp.add_argument("new", type=str)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate_corpus(os.path.abspath(args.out_dir), args.files, args.files_per_series, max(3, args.depth),
+                        args.header_bytes, args.private_items, args.pixel_bytes, args.broken, args.seed)
+    elif args.command == "run":
+        run_benchmark(args)
+    elif args.command == "compare":
+        compare_reports(args.old, args.new)
@@ -0,0 +1,137 @@
+# dicom_crawler.py
+# Parallel os.scandir crawler that streams paths into the filter / extraction stages
+#
+# Directory listing on deep PACS export trees over NFS is latency bound, so
+# several threads list directories concurrently. Each listed directory is
+# handed to the consumer as soon as it is read (bounded queue = backpressure),
+# which lets crawling overlap with filtering and parsing.
+import os
+import queue
+import threading
+
+# --- 設定 ---
+DEFAULT_SCAN_THREADS = 16
+# Listed directories buffered between the crawler threads and the consumer
+OUTPUT_QUEUE_SIZE = 1024
+
+_DONE = object()
+
+
+def dcm_suffix_filter(name):
+    """Default file filter: names ending in .dcm (case-insensitive), like the find -iname wrapper."""
+    return name.lower().endswith(".dcm")
+
+
+class _Crawler:
+    def __init__(self, roots, threads, name_filter, with_stat, dir_filter=None):
+        self.name_filter = name_filter
+        self.dir_filter = dir_filter
+        self.with_stat = with_stat
+        self.threads = threads
+        self.dir_queue = queue.SimpleQueue()
+        self.out_queue = queue.Queue(maxsize=OUTPUT_QUEUE_SIZE)
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = len(roots) # directories queued or being listed
+        for root in roots:
+            self.dir_queue.put(root)
+
+    def _put(self, item):
+        # Block while the consumer is behind, but give up if it went away
+        while not self.stop.is_set():
+            try:
+                self.out_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _list(self, directory):
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        # Same semantics as os.walk(followlinks=False): symlinked dirs are not entered
+                        if entry.is_dir():
+                            if not entry.is_symlink() and (self.dir_filter is None or self.dir_filter(entry.path)):
+                                subdirs.append(entry.path)
+                        elif self.name_filter(entry.name):
+                            # DirEntry caches what scandir already returned; stat only when asked for
+                            files.append((entry.path, entry.stat() if self.with_stat else None))
+                    except OSError as e:
+                        print(f"Warning: Could not stat {entry.path}: {e}")
+        except OSError as e:
+            print(f"Warning: Could not list {directory}: {e}")
+        return files, subdirs
+
+    def _worker(self):
+        while not self.stop.is_set():
+            directory = self.dir_queue.get()
+            if directory is None:
+                return
+            try:
+                files, subdirs = self._list(directory)
+                with self.lock:
+                    self.pending += len(subdirs)
+                for subdir in subdirs:
+                    self.dir_queue.put(subdir)
+                if files:
+                    self._put((directory, files))
+            except Exception as e:
+                # e.g. from a name / dir filter: raised again by run() rather than leaving the consumer waiting
+                self._put(e)
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                    finished = self.pending == 0
+                if finished:
+                    for _ in range(self.threads):
+                        self.dir_queue.put(None)
+                    self._put(_DONE)
+
+    def run(self):
+        if self.pending == 0:
+            return
+        workers = [threading.Thread(target=self._worker, daemon=True, name=f"crawler-{i}")
+                   for i in range(self.threads)]
+        for t in workers:
+            t.start()
+        try:
+            while True:
+                item = self.out_queue.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Also reached when the consumer stops early: release blocked workers
+            self.stop.set()
+            for _ in range(self.threads):
+                self.dir_queue.put(None)
+
+
+def iter_crawl_dirs(dicom_dirs, threads=DEFAULT_SCAN_THREADS, name_filter=dcm_suffix_filter, with_stat=False,
+                    dir_filter=None):
+    """Yield (directory, [(path, stat_or_None), ...]) for every directory with matching files.
+
+    Directories are listed by `threads` threads in parallel and yielded in
+    completion order. stat results come from DirEntry.stat() and are only
+    collected when with_stat=True. Subdirectories for which dir_filter(path)
+    is false are not entered (--shard-by top prunes other shards' trees).
+    """
+    roots = []
+    for directory in dicom_dirs:
+        if os.path.isdir(directory):
+            roots.append(directory)
+        else:
+            print(f"Warning: Directory not found or is not a directory, skipping: {directory}")
+    yield from _Crawler(roots, max(1, threads), name_filter, with_stat, dir_filter).run()
+
+
+def iter_crawl(dicom_dirs, threads=DEFAULT_SCAN_THREADS, name_filter=dcm_suffix_filter, with_stat=False,
+               dir_filter=None):
+    """Flat version of iter_crawl_dirs: yield (path, stat_or_None)."""
+    for _, files in iter_crawl_dirs(dicom_dirs, threads, name_filter, with_stat, dir_filter):
+        yield from files
@@ -0,0 +1,252 @@
+# dicom_dedup.py
+# Duplicate instances: the same SOP Instance UID stored under several paths
+#
+# Re-exports and teaching-folder copies put the same image under many paths.
+# With --dedup (dicom_metadata2.py / dicom_metadata3.py) new files first get a
+# UID probe: the header is read only up to SOP Instance UID (0008,0018), a few
+# hundred bytes in, and the UID is looked up in the indexed sop_instance_uid
+# column. A known UID links the path to the existing instance: the instance's
+# row is handed to the DB writer under the new path (with the file's own stat
+# in the manifest), so the file is never fully parsed.
+# Files with unknown UIDs go on to extraction. Two copies that are both new in
+# the same run are both parsed (neither row is committed when the other is
+# probed); the report below still groups them.
+#
+# Usage:
+#   python dicom_dedup.py report dicom_metadata.db [--limit N]
+import argparse
+import heapq
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import groupby
+
+from dicom_fastread import FastReadUnsupported, compile_wanted_tags, read_tags
+from dicom_fields import COLUMNS, SOP_CLASS_UID, SOP_INSTANCE_UID, SOP_UID_COLUMN
+from dicom_manifest import manifest_entry
+from dicom_paths import LOOKUP_BATCH, has_directories, is_member_path
+from dicom_schema import COMPAT_SELECT_SQL
+from dicom_writer import PendingResults
+
+# --- 設定 ---
+DEFAULT_DEDUP_THREADS = 16
+# Paths per probe task (and per UID lookup / link transaction)
+DEDUP_BATCH_SIZE = 256
+# Batches in flight per thread (read-ahead)
+DEDUP_BATCHES_PER_THREAD = 4
+# Stops the header read right after SOP Instance UID
+UID_TAGS = compile_wanted_tags([SOP_CLASS_UID, SOP_INSTANCE_UID])
+
+
+def probe_uid(path):
+    """Targeted header read -> (stat, SOP Instance UID), or None (left to the full parse)."""
+    if is_member_path(path):
+        return None # archive members are read inside their archive task
+    try:
+        st = os.stat(path)
+        ds = read_tags(path, UID_TAGS)
+    except (OSError, FastReadUnsupported, ValueError):
+        return None
+    if SOP_CLASS_UID not in ds or SOP_INSTANCE_UID not in ds:
+        return None
+    uid = str(ds[SOP_INSTANCE_UID].value).strip()
+    return (st, uid) if uid else None
+
+
+def _probe_batch(paths):
+    return [(path, probe_uid(path)) for path in paths]
+
+
+def has_uid_column(conn):
+    """True if the instance table stores SOP Instance UIDs (normalized, or a flat table with the column)."""
+    table = "instances" if has_directories(conn) else "dicom_metadata"
+    return any(row[1] == SOP_UID_COLUMN for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def find_instances(conn, uids):
+    """{SOP Instance UID: [(path, row key), ...]} for the UIDs already in the DB.
+
+    The row key is instance_pk (normalized) or file_path (flat table).
+    """
+    uids = list(uids)
+    if has_directories(conn):
+        sql = ("SELECT i.sop_instance_uid, d.path || i.file_name, i.instance_pk FROM instances i "
+               "JOIN directories d ON d.directory_pk = i.directory_pk WHERE i.sop_instance_uid IN ({})")
+    else:
+        sql = f"SELECT {SOP_UID_COLUMN}, file_path, file_path FROM dicom_metadata WHERE {SOP_UID_COLUMN} IN ({{}})"
+    found = {}
+    for i in range(0, len(uids), LOOKUP_BATCH):
+        batch = uids[i:i + LOOKUP_BATCH]
+        for uid, path, key in conn.execute(sql.format(", ".join(["?"] * len(batch))), batch):
+            found.setdefault(uid, []).append((path, key))
+    return found
+
+
+def fetch_rows(conn, keys, columns=COLUMNS):
+    """{path: row in `columns` order} for instance row keys from find_instances().
+
+    Normalized rows come from the compat view's SELECT (typed values, NULL
+    for missing); columns the view lacks are None.
+    """
+    keys = list(keys)
+    if has_directories(conn):
+        view_columns = {row[1] for row in conn.execute("PRAGMA table_info(dicom_metadata)")}
+        select = ", ".join(column if column in view_columns else "NULL" for column in columns)
+        sql = f"SELECT {select} FROM ({COMPAT_SELECT_SQL} WHERE i.instance_pk IN ({{}}))"
+    else:
+        sql = f"SELECT {', '.join(columns)} FROM dicom_metadata WHERE file_path IN ({{}})"
+    path_index = columns.index("file_path")
+    rows = {}
+    for i in range(0, len(keys), LOOKUP_BATCH):
+        batch = keys[i:i + LOOKUP_BATCH]
+        for row in conn.execute(sql.format(", ".join(["?"] * len(batch))), batch):
+            rows[row[path_index]] = row
+    return rows
+
+
+class LinkedResults(PendingResults):
+    """Rows copied from known instances, handed to the ingest's DB writer like parsed rows.
+
+    process_files_parallel_and_insert attaches its DbWriter before the
+    pipeline starts pulling paths; the writer's insert_batch then inserts the
+    rows, records the manifest and (with --rollups) keeps the summaries
+    (dicom_rollup.py) up to date, without the main connection waiting for
+    the writer's lock.
+    """
+
+
+def iter_deduplicated(paths, conn, linked, threads=DEFAULT_DEDUP_THREADS, batch_size=DEDUP_BATCH_SIZE,
+                      counts=None, verbose=True):
+    """Phase 2 (streaming, --dedup): link files whose SOP Instance UID is already known, yield the rest.
+
+    Linked files go to `linked` (a LinkedResults) as (row, manifest entry)
+    results carrying the known instance's values under the new path. Order
+    is preserved. A counts dict, if given, receives checked / linked / passed totals.
+    """
+    if counts is None:
+        counts = {}
+    for key in ("checked", "linked", "passed"):
+        counts.setdefault(key, 0)
+    if verbose:
+        print(f"[{datetime.now()}] Phase 2: Probing SOP Instance UIDs of new files ({threads} threads)...")
+    start_time = time.time()
+
+    def collect(future):
+        probed = future.result()
+        known = find_instances(conn, {probe[1] for _, probe in probed if probe is not None})
+        links = []
+        for path, probe in probed:
+            counts["checked"] += 1
+            existing = [(other, key) for other, key in known.get(probe[1], ()) if other != path] if probe else ()
+            if existing:
+                links.append((path, existing[0], probe[0], probe[1]))
+            else:
+                counts["passed"] += 1
+                yield path
+        if links:
+            rows = fetch_rows(conn, [key for _, (_, key), _, _ in links])
+            results = []
+            for path, (other, _), st, uid in links:
+                row = rows.get(other)
+                if row is None: # gone since the lookup
+                    counts["passed"] += 1
+                    yield path
+                else:
+                    results.append(((path,) + row[1:], manifest_entry(path, st, uid)))
+            linked.add(results)
+            counts["linked"] += len(results)
+
+    max_in_flight = max(1, threads) * DEDUP_BATCHES_PER_THREAD
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="dedup") as pool:
+        batch = []
+        for path in paths:
+            batch.append(path)
+            if len(batch) >= batch_size:
+                in_flight.append(pool.submit(_probe_batch, batch))
+                batch = []
+                while len(in_flight) >= max_in_flight:
+                    yield from collect(in_flight.popleft())
+        if batch:
+            in_flight.append(pool.submit(_probe_batch, batch))
+        while in_flight:
+            yield from collect(in_flight.popleft())
+    if verbose:
+        print(f"[{datetime.now()}] Phase 2: UID probe complete in {time.time() - start_time:.2f} seconds. "
+              f"Checked: {counts['checked']} | Linked to known instances: {counts['linked']} | "
+              f"To parse: {counts['passed']}")
+
+
+# --- Report ---
+
+def _iter_uid_paths(conn):
+    """(UID, path, manifest size or None) for every UID stored under more than one path, grouped by UID."""
+    if has_directories(conn):
+        return conn.execute(
+            "SELECT i.sop_instance_uid, d.path || i.file_name, m.size FROM instances i "
+            "JOIN directories d ON d.directory_pk = i.directory_pk "
+            "LEFT JOIN file_manifest m ON m.directory_pk = i.directory_pk AND m.file_name = i.file_name "
+            "WHERE i.sop_instance_uid IN (SELECT sop_instance_uid FROM instances WHERE sop_instance_uid IS NOT NULL "
+            "GROUP BY sop_instance_uid HAVING COUNT(*) > 1) ORDER BY i.sop_instance_uid")
+    return conn.execute(
+        f"SELECT d.{SOP_UID_COLUMN}, d.file_path, m.size FROM dicom_metadata d "
+        "LEFT JOIN file_manifest m ON m.file_path = d.file_path "
+        f"WHERE d.{SOP_UID_COLUMN} IN (SELECT {SOP_UID_COLUMN} FROM dicom_metadata "
+        f"WHERE {SOP_UID_COLUMN} IS NOT NULL AND {SOP_UID_COLUMN} != 'N/A' "
+        f"GROUP BY {SOP_UID_COLUMN} HAVING COUNT(*) > 1) ORDER BY d.{SOP_UID_COLUMN}")
+
+
+def report(db_file, limit=20):
+    conn = sqlite3.connect(db_file, timeout=30.0)
+    try:
+        if not has_uid_column(conn):
+            print(f"{db_file} has no {SOP_UID_COLUMN} column yet; run an ingest (or 'dicom_schema.py migrate') first.")
+            return
+        groups = copies = wasted = unsized = 0
+        top = [] # (wasted bytes, UID, [(path, size)]) heap of the `limit` largest groups
+        for uid, rows in groupby(_iter_uid_paths(conn), key=lambda row: row[0]):
+            files = [(path, size) for _, path, size in rows]
+            # Archive members carry the archive's size, so they are counted but not sized
+            sizes = [size for path, size in files if size is not None and not is_member_path(path)]
+            unsized += len(files) - len(sizes)
+            group_wasted = sum(sizes) - max(sizes) if sizes else 0
+            groups += 1
+            copies += len(files) - 1
+            wasted += group_wasted
+            entry = (group_wasted, uid, files)
+            if len(top) < limit:
+                heapq.heappush(top, entry)
+            elif limit:
+                heapq.heappushpop(top, entry)
+        print(f"[{datetime.now()}] Duplicate instances in {db_file}")
+        print(f"Duplicate groups (SOP Instance UID under more than one path): {groups}")
+        print(f"Redundant copies: {copies} | Bytes wasted: {wasted / 1e6:.1f} MB "
+              f"(all but the largest copy per group; {unsized} archive members / unstat'ed files not sized)")
+        if top:
+            print(f"\nLargest groups by wasted bytes (top {limit}):")
+            for group_wasted, uid, files in sorted(top, reverse=True):
+                print(f"{uid}  {len(files)} copies, {group_wasted / 1e6:.2f} MB wasted")
+                for path, size in files:
+                    print(f"    {path}" + (f" ({size} bytes)" if size is not None and not is_member_path(path) else ""))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Duplicate DICOM instance tools (same SOP Instance UID, several paths).")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_report = sub.add_parser("report", help="List duplicate groups and the bytes they waste.")
+    p_report.add_argument("db_file", type=str, help="Path to the SQLite database file.")
+    p_report.add_argument("--limit", type=int, default=20, help="Largest groups to list (default: 20).")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        db_file = os.path.abspath(args.db_file)
+        if not os.path.exists(db_file):
+            print(f"Error: {db_file} not found.")
+            sys.exit(1)
+        report(db_file, args.limit)
@@ -0,0 +1,150 @@
+# dicom_engine.py
+# Extraction engines shared by dicom_metadata2.py / dicom_metadata3.py
+import multiprocessing
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# --- 設定 ---
+ENGINES = ("thread", "process", "hybrid")
+DEFAULT_ENGINE = "thread"
+# Files per task sent to a worker process (process / hybrid engines)
+DEFAULT_CHUNK_SIZE = 256
+# I/O threads inside each worker process (hybrid engine only)
+DEFAULT_IO_THREADS = 4
+# Tasks kept in flight per worker; bounds memory no matter how many paths the source yields
+IN_FLIGHT_PER_WORKER = 4
+# Start method of the worker processes: forked from a clean server process, not from the
+# ingest process (which by then runs the crawler, writer and checkpoint threads)
+PROCESS_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Per-process thread pool used by the hybrid engine (created by the pool initializer)
+_io_pool = None
+
+def _init_io_pool(io_threads):
+    """Process-pool initializer: start the I/O threads for this worker process."""
+    global _io_pool
+    _io_pool = ThreadPoolExecutor(max_workers=io_threads)
+
+def io_map(func, items):
+    """map() for grouped tasks: on this worker process's I/O threads (hybrid engine), else in order inline."""
+    if _io_pool is None:
+        return map(func, items)
+    return _io_pool.map(func, items)
+
+def _extract_chunk(row_func, paths):
+    """Worker task: run row_func over a chunk of paths, return (attempted, rows)."""
+    rows = []
+    for path in paths:
+        row = row_func(path)
+        if row is not None:
+            rows.append(row)
+    return len(paths), rows
+
+def _extract_chunk_threaded(row_func, paths):
+    """Worker task (hybrid): same as _extract_chunk but overlaps file reads on _io_pool."""
+    rows = [row for row in _io_pool.map(row_func, paths) if row is not None]
+    return len(paths), rows
+
+def _chunked(files, chunk_size):
+    """Yield successive lists of chunk_size paths."""
+    chunk = []
+    for path in files:
+        chunk.append(path)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def make_executor(engine, max_workers, io_threads=DEFAULT_IO_THREADS):
+    """Pool for the engine; pass it to iter_extracted(executor=...) to reuse it across runs (dicom_watch.py)."""
+    if engine == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers)
+    mp_context = multiprocessing.get_context(PROCESS_START_METHOD)
+    if engine == "process":
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+    if engine == "hybrid":
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context,
+                                   initializer=_init_io_pool, initargs=(io_threads,))
+    raise ValueError(f"Unknown engine: {engine} (expected one of {', '.join(ENGINES)})")
+
+def iter_extracted(row_func, files, engine=DEFAULT_ENGINE, max_workers=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE, io_threads=DEFAULT_IO_THREADS,
+                   max_in_flight=None, grouped=False, stats=None, tuner=None, executor=None):
+    """Run row_func over files with the selected engine.
+
+    files may be any iterable (typically a generator from the scan/filter
+    stages); it is consumed lazily so that at most max_in_flight tasks are
+    queued at once. Yields (attempted, rows) as tasks complete. row_func must
+    be a module-level function (it is pickled by reference for the process
+    engines) that returns a result tuple, or None for files that should be
+    skipped.
+
+    With grouped=True, files yields lists of paths (e.g. one directory each)
+    and row_func takes a whole list and returns (attempted, rows) itself;
+    it can spread the group's reads over the hybrid engine's I/O threads with io_map().
+    If a stats dict is given, stats["in_flight"] tracks the tasks in flight.
+
+    With a dicom_autotune.AutoTuner the pool is sized for tuner.max_workers
+    and the window is tuner.limit tasks, re-read at every top-up, so only
+    that many tasks run at once (threads are started on demand; worker
+    processes beyond the limit sit idle).
+
+    executor, if given, is a pool from make_executor() for the same engine;
+    it is used instead of a new one and left running for the caller.
+    """
+    max_workers = max_workers or os.cpu_count() or 4
+    max_in_flight = max_in_flight or max_workers * IN_FLIGHT_PER_WORKER
+    if tuner is not None:
+        max_workers = tuner.max_workers
+    if grouped:
+        # One task per group on every engine; the group is the unit of work
+        tasks = ((row_func, (group,), len(group)) for group in files)
+    elif engine == "thread":
+        # One task per file: threads share the interpreter, so there is
+        # nothing to gain from chunking here.
+        tasks = ((row_func, (path,), 1) for path in files)
+    else:
+        task = _extract_chunk if engine == "process" else _extract_chunk_threaded
+        tasks = ((task, (row_func, chunk), len(chunk)) for chunk in _chunked(files, chunk_size))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = make_executor(engine, max_workers, io_threads)
+    try:
+        done_queue = queue.SimpleQueue() # Futures land here as they finish
+        future_to_size = {}
+        exhausted = False
+        while True:
+            # Top the window up; the path source is only advanced when there is room (backpressure)
+            window = tuner.limit if tuner is not None else max_in_flight
+            while not exhausted and len(future_to_size) < window:
+                try:
+                    func, args, size = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(func, *args)
+                future_to_size[future] = size
+                future.add_done_callback(done_queue.put)
+            if stats is not None:
+                stats["in_flight"] = len(future_to_size)
+            if not future_to_size:
+                break
+
+            future = done_queue.get()
+            size = future_to_size.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error in {engine} extraction task ({size} files): {e}")
+                yield size, []
+                continue
+            if engine == "thread" and not grouped:
+                yield 1, ([result] if result is not None else [])
+            else:
+                yield result
+    finally:
+        if own_executor:
+            executor.shutdown()
@@ -0,0 +1,286 @@
+# dicom_export.py
+# Columnar export of the metadata DB to a partitioned Parquet dataset (optional pyarrow)
+#
+# SELECT * into pandas materializes every TEXT value as its own Python string.
+# The Parquet dataset stores the same rows column by column: repeated strings
+# (modality, manufacturer, descriptions, UIDs shared by a series) are
+# dictionary-encoded, DA / TM / DS columns get real types (date32, time32,
+# float64, 'N/A' -> null), and files are hive-partitioned, by default by
+# modality and study year. Readers then load only the columns and partitions
+# they need:
+#   pyarrow.dataset.dataset(out_dir, partitioning="hive").to_table(
+#       columns=["file_path", "study_date"], filter=pc.field("modality") == "CT")
+#   pandas.read_parquet(out_dir, columns=[...], memory_map=True)
+#
+# Rows are streamed from SQLite in record batches, so memory stays flat. The
+# same writer is used as an optional ingest sink (dicom_metadata2.py / dicom_metadata3.py
+# --parquet-dir) that appends every ingested row next to the SQLite insert.
+#
+# Usage:
+#   python dicom_export.py parquet dicom_metadata.db out_dir [--partition-by modality,study_date:year]
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from datetime import date, datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as pa_dataset
+except ImportError: # optional: only needed for the Parquet export / sink
+    pa = None
+
+from pydicom.datadict import dictionary_VR
+
+from dicom_fields import FIELDS
+from dicom_schema import to_date_int, to_real, to_text, to_time_int
+
+# --- 設定 ---
+EXPORT_BATCH_ROWS = 100000
+# Rows the ingest sink buffers before writing a part file per partition
+DEFAULT_SINK_ROWS = 200000
+# Comma-separated partition keys; "column:year" / "column:month" partition a date column by year / YYYYMM
+DEFAULT_PARTITION_BY = "modality,study_date:year"
+PARQUET_COMPRESSION = "zstd"
+MIN_ROWS_PER_GROUP = 65536
+MAX_ROWS_PER_GROUP = 1048576
+MAX_OPEN_FILES = 512
+
+
+def require_pyarrow():
+    if pa is None:
+        print("Fatal: the Parquet export needs pyarrow (pip install pyarrow).")
+        sys.exit(1)
+
+
+# --- Value conversion (flat TEXT or normalized view values -> Arrow values) ---
+
+def _to_date(value):
+    value = to_date_int(value)
+    if value is None:
+        return None
+    try:
+        return date(value // 10000, value // 100 % 100, value % 100)
+    except ValueError:
+        return None
+
+
+def _to_seconds(value):
+    value = to_time_int(value)
+    if value is None:
+        return None
+    hours, minutes, seconds = value // 10000, value // 100 % 100, value % 100
+    if hours > 23 or minutes > 59 or seconds > 60:
+        return None
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _to_int(value):
+    value = to_text(value)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _column_kind(column):
+    """'date', 'time', 'real', 'int' or 'text' from the VR of the column's tag in dicom_fields.json."""
+    if column == "file_path":
+        return "path" # unique per row: a dictionary would only add overhead
+    for field in FIELDS:
+        if field.column == column:
+            try:
+                vr = dictionary_VR(field.tag)
+            except KeyError: # private tag
+                return "text"
+            return {"DA": "date", "TM": "time", "DS": "real", "FL": "real", "FD": "real",
+                    "IS": "int", "US": "int", "UL": "int", "SS": "int", "SL": "int"}.get(vr, "text")
+    return "text"
+
+
+_CONVERT = {"date": _to_date, "time": _to_seconds, "real": to_real, "int": _to_int}
+
+
+class ParquetLayout:
+    """Arrow schema, per-batch conversion and hive partitioning for a list of DB columns."""
+
+    def __init__(self, columns, partition_by=DEFAULT_PARTITION_BY):
+        require_pyarrow()
+        self.columns = list(columns)
+        self.kinds = [_column_kind(column) for column in self.columns]
+        self.types = {
+            "date": pa.date32(), "time": pa.time32("s"), "real": pa.float64(), "int": pa.int64(),
+            "text": pa.dictionary(pa.int32(), pa.string()), "path": pa.string(),
+        }
+        # Partition keys: (output column, source column index, granularity or None)
+        self.partition_keys = []
+        for key in (k.strip() for k in partition_by.split(",") if k.strip()):
+            column, _, granularity = key.partition(":")
+            if column not in self.columns:
+                raise ValueError(f"partition column {column!r} is not in the table")
+            if granularity and granularity not in ("year", "month"):
+                raise ValueError(f"partition granularity must be year or month, not {granularity!r}")
+            name = f"{column}_{granularity}" if granularity else column
+            self.partition_keys.append((name, self.columns.index(column), granularity or None))
+
+        partition_fields = []
+        for name, i, granularity in self.partition_keys:
+            # Partition values go into directory names: plain (non-dictionary) types
+            kind = "int" if granularity else self.kinds[i]
+            partition_fields.append(pa.field(name, pa.string() if kind in ("text", "path") else self.types[kind]))
+        partition_names = {field.name for field in partition_fields}
+        self.schema = pa.schema(
+            [pa.field(column, self.types[kind]) for column, kind in zip(self.columns, self.kinds)
+             if column not in partition_names] + partition_fields)
+        self.partitioning = pa_dataset.partitioning(pa.schema(partition_fields), flavor="hive")
+
+    def _text_array(self, values, dictionary=True):
+        array = pa.array([v if v is None or type(v) is str else str(v) for v in values], type=pa.string())
+        array = pc.if_else(pc.equal(array, "N/A"), pa.scalar(None, pa.string()), array)
+        return array.dictionary_encode() if dictionary else array
+
+    def record_batch(self, rows):
+        """Rows (tuples in `columns` order) -> RecordBatch matching self.schema."""
+        by_column = list(zip(*rows)) if rows else [()] * len(self.columns)
+        partition_names = {name for name, _, _ in self.partition_keys}
+        arrays = []
+        for column, kind, values in zip(self.columns, self.kinds, by_column):
+            if column in partition_names:
+                continue
+            if kind == "text":
+                arrays.append(self._text_array(values))
+            elif kind == "path":
+                arrays.append(pa.array(values, type=pa.string()))
+            else:
+                convert = _CONVERT[kind]
+                arrays.append(pa.array([convert(v) for v in values], type=self.types[kind]))
+        for name, i, granularity in self.partition_keys:
+            values = by_column[i]
+            if granularity:
+                divisor = 10000 if granularity == "year" else 100
+                dates = (to_date_int(v) for v in values)
+                arrays.append(pa.array([d // divisor if d is not None else None for d in dates], type=pa.int64()))
+            elif self.kinds[i] in ("text", "path"):
+                arrays.append(self._text_array(values, dictionary=False))
+            else:
+                convert = _CONVERT[self.kinds[i]]
+                arrays.append(pa.array([convert(v) for v in values], type=self.types[self.kinds[i]]))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def write(self, out_dir, batches, basename_template, existing_data_behavior="overwrite_or_ignore"):
+        """Stream record batches into out_dir (hive partitions, zstd, dictionary pages)."""
+        file_options = pa_dataset.ParquetFileFormat().make_write_options(
+            compression=PARQUET_COMPRESSION, use_dictionary=True)
+        pa_dataset.write_dataset(
+            batches, out_dir, schema=self.schema, format="parquet", partitioning=self.partitioning,
+            basename_template=basename_template, file_options=file_options,
+            existing_data_behavior=existing_data_behavior, max_open_files=MAX_OPEN_FILES,
+            min_rows_per_group=MIN_ROWS_PER_GROUP, max_rows_per_group=MAX_ROWS_PER_GROUP)
+
+
+class ParquetSink:
+    """Ingest sink: buffers inserted rows and appends them to a Parquet dataset (writer thread only).
+
+    The dataset is an append log of what each run ingested; rows re-parsed by
+    --rescan show up again. Use the export command for a snapshot of the DB.
+    """
+
+    def __init__(self, out_dir, columns, partition_by=DEFAULT_PARTITION_BY, flush_rows=DEFAULT_SINK_ROWS):
+        self.out_dir = out_dir
+        self.layout = ParquetLayout(columns, partition_by)
+        self.flush_rows = flush_rows
+        self.rows_written = 0
+        self._run_id = datetime.now().strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+        self._part = 0
+        self._pending = []
+
+    def add(self, rows):
+        self._pending.extend(rows)
+        if len(self._pending) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        self.layout.write(self.out_dir, [self.layout.record_batch(rows)],
+                          f"ingest-{self._run_id}-{self._part:05d}-{{i}}.parquet")
+        self._part += 1
+        self.rows_written += len(rows)
+
+    def close(self):
+        self.flush()
+
+
+# --- Export ---
+
+def iter_record_batches(cursor, layout, batch_rows=EXPORT_BATCH_ROWS):
+    while True:
+        rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            return
+        yield layout.record_batch(rows)
+
+
+def export_parquet(db_file, out_dir, partition_by=DEFAULT_PARTITION_BY, batch_rows=EXPORT_BATCH_ROWS,
+                   overwrite=False):
+    """Stream dicom_metadata (the flat table or the normalized compat view) into a Parquet dataset."""
+    require_pyarrow()
+    if os.path.isdir(out_dir) and os.listdir(out_dir) and not overwrite:
+        print(f"Error: {out_dir} is not empty (use --overwrite to replace it).")
+        sys.exit(1)
+    # write_dataset pulls the batches from its own thread; the cursor is only ever used by one thread at a time
+    conn = sqlite3.connect(db_file, timeout=30.0, check_same_thread=False)
+    try:
+        cursor = conn.execute("SELECT * FROM dicom_metadata")
+        columns = [d[0] for d in cursor.description]
+        try:
+            layout = ParquetLayout(columns, partition_by)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print(f"[{datetime.now()}] Exporting {db_file} -> {out_dir} "
+              f"(partitioned by {', '.join(name for name, _, _ in layout.partition_keys) or 'nothing'})")
+        start = time.time()
+        exported = 0
+
+        def counted(batches):
+            nonlocal exported
+            for batch in batches:
+                exported += batch.num_rows
+                yield batch
+
+        layout.write(out_dir, counted(iter_record_batches(cursor, layout, batch_rows)), "part-{i}.parquet",
+                     "delete_matching" if overwrite else "overwrite_or_ignore")
+    finally:
+        conn.close()
+    size = sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(out_dir) for name in names)
+    print(f"[{datetime.now()}] Exported {exported} rows in {time.time() - start:.2f} seconds "
+          f"({size / 1e6:.1f} MB on disk).")
+    return exported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the DICOM metadata DB to columnar formats.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_parquet = sub.add_parser("parquet", help="Stream dicom_metadata into a partitioned Parquet dataset.")
+    p_parquet.add_argument("db_file", type=str, help="Path to the SQLite database file.")
+    p_parquet.add_argument("out_dir", type=str, help="Output dataset directory.")
+    p_parquet.add_argument("--partition-by", type=str, default=DEFAULT_PARTITION_BY,
+                           help="Comma-separated partition columns; 'column:year' or 'column:month' partitions a "
+                                f"date column coarser (default: {DEFAULT_PARTITION_BY}; '' for none).")
+    p_parquet.add_argument("--batch-rows", type=int, default=EXPORT_BATCH_ROWS,
+                           help=f"Rows per record batch read from SQLite (default: {EXPORT_BATCH_ROWS}).")
+    p_parquet.add_argument("--overwrite", action="store_true",
+                           help="Replace the partitions of an existing dataset in out_dir.")
+    args = parser.parse_args()
+
+    if args.command == "parquet":
+        db_file = os.path.abspath(args.db_file)
+        if not os.path.exists(db_file):
+            print(f"Error: {db_file} not found.")
+            sys.exit(1)
+        export_parquet(db_file, os.path.abspath(args.out_dir), args.partition_by, args.batch_rows, args.overwrite)
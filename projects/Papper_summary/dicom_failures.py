@@ -0,0 +1,220 @@
+# dicom_failures.py
+# Failure ledger: files that could not be ingested are recorded instead of being re-parsed every run
+#
+# Extraction returns a FailedFile marker (path, stat, error class, message)
+# instead of None. The writer thread records it in file_failures, and the next
+# run drops ledger entries from the work list unless the file changed since it
+# failed or its retry backoff has expired. Permanent failures (not DICOM, no
+# SOPClassUID: DICOMDIR, broken exports) are only retried when the file changes.
+#
+# Usage:
+#   python dicom_failures.py report dicom_metadata.db [--list CLASS] [--limit N]
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from dicom_paths import stat_path
+
+# --- 設定 ---
+# Paths looked up in the ledger per query
+FAILURE_LOOKUP_BATCH = 500
+# Error classes and their retry policy: first backoff in seconds (doubled per
+# attempt, capped at MAX_RETRY_BACKOFF), or None = retry only when the file changes
+INVALID_DICOM = "invalid_dicom"         # pydicom InvalidDicomError
+MISSING_SOP_CLASS = "missing_sop_class" # parsed, but no SOPClassUID (DICOMDIR, some SR / exports)
+READ_ERROR = "read_error"               # OSError: vanished, permissions, NFS hiccups
+PARSE_ERROR = "parse_error"             # anything else raised while parsing
+RETRY_BACKOFF = {
+    INVALID_DICOM: None,
+    MISSING_SOP_CLASS: None,
+    READ_ERROR: 3600,
+    PARSE_ERROR: 86400,
+}
+MAX_RETRY_BACKOFF = 30 * 86400
+
+# Worker -> collection loop -> writer marker (module level, so it pickles for the process engines).
+# stat is (size, mtime_ns, inode, device) or None when the file could not be stat'ed.
+FailedFile = namedtuple("FailedFile", "file_path stat error_class message")
+
+FAILURE_COLUMNS = ("file_path", "size", "mtime_ns", "inode", "device", "error_class", "error_message",
+                   "attempts", "first_failed", "last_failed", "next_retry")
+FAILURE_UPSERT_SQL = (f"INSERT OR REPLACE INTO file_failures ({', '.join(FAILURE_COLUMNS)}) "
+                      f"VALUES ({', '.join(['?'] * len(FAILURE_COLUMNS))})")
+
+
+def create_failure_table(conn):
+    """Creates the file_failures ledger if it doesn't exist."""
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS file_failures (
+    file_path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    device INTEGER,
+    error_class TEXT,
+    error_message TEXT,
+    attempts INTEGER,
+    first_failed REAL,
+    last_failed REAL,
+    next_retry REAL
+)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_failures_class ON file_failures(error_class);")
+    conn.commit()
+
+
+def failed_file(file_path, st, error_class, message):
+    """Build a FailedFile from an os.stat_result (or None)."""
+    stat = (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev) if st is not None else None
+    return FailedFile(file_path, stat, error_class, str(message)[:500])
+
+
+def _next_retry(error_class, attempts, now):
+    backoff = RETRY_BACKOFF.get(error_class, RETRY_BACKOFF[PARSE_ERROR])
+    if backoff is None:
+        return None
+    return now + min(backoff * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+
+
+def record_failures(conn, failures):
+    """Writer side: upsert FailedFile markers, counting attempts and scheduling the next retry."""
+    if not failures:
+        return
+    c = conn.cursor()
+    now = time.time()
+    rows = []
+    for start in range(0, len(failures), FAILURE_LOOKUP_BATCH):
+        chunk = failures[start:start + FAILURE_LOOKUP_BATCH]
+        previous = {row[0]: row[1:] for row in c.execute(
+            f"SELECT file_path, attempts, first_failed FROM file_failures "
+            f"WHERE file_path IN ({', '.join(['?'] * len(chunk))})", [f.file_path for f in chunk])}
+        for f in chunk:
+            attempts, first_failed = previous.get(f.file_path, (0, now))
+            attempts += 1
+            size, mtime_ns, inode, device = f.stat or (None, None, None, None)
+            rows.append((f.file_path, size, mtime_ns, inode, device, f.error_class, f.message,
+                         attempts, first_failed, now, _next_retry(f.error_class, attempts, now)))
+    c.executemany(FAILURE_UPSERT_SQL, rows)
+
+
+def clear_failures(conn, paths):
+    """Writer side: drop ledger entries for files that have now been ingested."""
+    conn.executemany("DELETE FROM file_failures WHERE file_path = ?", ((p,) for p in paths))
+
+
+def split_results(results):
+    """Separate (row, manifest entry) results from FailedFile markers."""
+    rows = []
+    failures = []
+    for result in results:
+        if isinstance(result, FailedFile):
+            failures.append(result)
+        else:
+            rows.append(result)
+    return rows, failures
+
+
+def _still_failing(entry, now):
+    """True if a ledger entry should be skipped: file unchanged and its retry is not due."""
+    file_path, size, mtime_ns, inode, device, next_retry = entry
+    try:
+        st = stat_path(file_path) # archive members: the archive's stat
+        unchanged = (size, mtime_ns, inode, device) == (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+    except OSError:
+        unchanged = size is None # still cannot be stat'ed
+    return unchanged and (next_retry is None or next_retry > now)
+
+
+def skip_known_failures(paths, conn, retry_failed=False, verbose=True):
+    """Phase 2 (streaming, after the processed-file filter): drop paths the ledger says will fail again.
+
+    Only paths found in the ledger are stat'ed. With retry_failed every path
+    is passed through (the ledger is still updated by this run).
+    """
+    c = conn.cursor()
+    # Entries the writer adds during this run are for paths already passed on, so an empty ledger stays irrelevant
+    if retry_failed or c.execute("SELECT 1 FROM file_failures LIMIT 1").fetchone() is None:
+        conn.commit()
+        yield from paths
+        return
+    skipped = 0
+    batch = []
+
+    def check(batch):
+        nonlocal skipped
+        known = {row[0]: row for row in c.execute(
+            f"SELECT file_path, size, mtime_ns, inode, device, next_retry FROM file_failures "
+            f"WHERE file_path IN ({', '.join(['?'] * len(batch))})", batch)}
+        conn.commit() # Do not keep a read snapshot open (WAL)
+        now = time.time()
+        for path in batch:
+            entry = known.get(path)
+            if entry is not None and _still_failing(entry, now):
+                skipped += 1
+            else:
+                yield path
+
+    for path in paths:
+        batch.append(path)
+        if len(batch) >= FAILURE_LOOKUP_BATCH:
+            yield from check(batch)
+            batch = []
+    if batch:
+        yield from check(batch)
+    if verbose:
+        print(f"Known failures skipped (unchanged, retry not due): {skipped}")
+
+
+# --- Report ---
+
+def report(db_file, list_class=None, limit=20):
+    conn = sqlite3.connect(db_file, timeout=30.0)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_failures'").fetchone() is None:
+            print(f"{db_file} has no failure ledger yet.")
+            return
+        now = time.time()
+        total = conn.execute("SELECT COUNT(*) FROM file_failures").fetchone()[0]
+        print(f"[{datetime.now()}] Failure ledger of {db_file}: {total} files")
+        print(f"{'error class':<20} {'files':>10} {'attempts':>10} {'retry due':>10} {'on change only':>14}")
+        for error_class, files, attempts, due, permanent in conn.execute(
+                "SELECT error_class, COUNT(*), SUM(attempts), "
+                "SUM(next_retry IS NOT NULL AND next_retry <= ?), SUM(next_retry IS NULL) "
+                "FROM file_failures GROUP BY error_class ORDER BY COUNT(*) DESC", (now,)):
+            print(f"{error_class:<20} {files:>10} {attempts:>10} {due:>10} {permanent:>14}")
+
+        print(f"\nMost common messages (top {limit}):")
+        for error_class, message, files in conn.execute(
+                "SELECT error_class, error_message, COUNT(*) FROM file_failures "
+                "GROUP BY error_class, error_message ORDER BY COUNT(*) DESC LIMIT ?", (limit,)):
+            print(f"{files:>10}  {error_class:<20} {message}")
+
+        if list_class:
+            print(f"\nFiles failing with {list_class} (first {limit}):")
+            for file_path, attempts, message in conn.execute(
+                    "SELECT file_path, attempts, error_message FROM file_failures "
+                    "WHERE error_class = ? ORDER BY file_path LIMIT ?", (list_class, limit)):
+                print(f"{file_path} (attempts: {attempts}) {message}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DICOM ingestion failure ledger tools.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_report = sub.add_parser("report", help="Summarize recorded failures by error class.")
+    p_report.add_argument("db_file", type=str, help="Path to the SQLite database file.")
+    p_report.add_argument("--list", dest="list_class", type=str, default=None,
+                          help=f"Also list files of this error class ({', '.join(RETRY_BACKOFF)}).")
+    p_report.add_argument("--limit", type=int, default=20, help="Rows per listing (default: 20).")
+    args = parser.parse_args()
+
+    if args.command == "report":
+        db_file = os.path.abspath(args.db_file)
+        if not os.path.exists(db_file):
+            print(f"Error: {db_file} not found.")
+            sys.exit(1)
+        report(db_file, args.list_class, args.limit)
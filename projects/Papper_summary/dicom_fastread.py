@@ -0,0 +1,329 @@
+# dicom_fastread.py
+# Minimal tag-targeted DICOM header reader (fast path for extract_metadata_only)
+#
+# pydicom.dcmread(stop_before_pixels=True) still parses every element up to the
+# pixel data (private sequences, icons, overlays ...). read_tags() walks the raw
+# element headers instead, decodes only the wanted tags, skips everything else
+# by length and stops right after the highest wanted tag. Anything it does not
+# understand raises FastReadUnsupported so the caller can fall back to dcmread.
+import os
+import struct
+from pydicom.datadict import dictionary_VR
+from pydicom.valuerep import DSfloat, IS
+
+# --- 設定 ---
+READ_BUFFER_SIZE = 16 * 1024
+
+IMPLICIT_VR_LE = "1.2.840.10008.1.2"
+EXPLICIT_VR_LE = "1.2.840.10008.1.2.1"
+# Transfer syntaxes we cannot walk without decoding (fall back to dcmread)
+UNSUPPORTED_TRANSFER_SYNTAXES = {
+    "1.2.840.10008.1.2.1.99", # Deflated Explicit VR Little Endian
+    "1.2.840.10008.1.2.2",    # Explicit VR Big Endian (retired)
+}
+# Explicit VRs with a 2-byte reserved field and a 4-byte length
+LONG_LENGTH_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV",
+                   b"UC", b"UN", b"UR", b"UT", b"UV"}
+ALL_VRS = LONG_LENGTH_VRS | {b"AE", b"AS", b"AT", b"CS", b"DA", b"DS", b"DT", b"FD", b"FL", b"IS", b"LO",
+                             b"LT", b"PN", b"SH", b"SL", b"SS", b"ST", b"TM", b"UI", b"UL", b"US"}
+# Bytes looked_like_dicom() needs: 128-byte preamble + "DICM"
+SNIFF_BYTES = 132
+# Largest first-element length accepted for a file without preamble (implicit VR)
+SNIFF_MAX_FIRST_LENGTH = 0x10000
+# VRs decoded as plain strings (other VRs are not expected in the field map)
+TEXT_VRS = {"AE", "AS", "CS", "DA", "DT", "LO", "LT", "SH", "ST", "TM", "UC", "UI", "UR", "UT"}
+# Specific Character Set (0008,0005) -> Python codec; anything else falls back
+CHARSET_CODECS = {
+    "": "latin-1", "ISO_IR 6": "latin-1", "ISO_IR 100": "latin-1",
+    "ISO_IR 192": "utf-8", "GB18030": "gb18030", "GBK": "gbk",
+}
+
+TAG_SPECIFIC_CHARSET = 0x00080005
+TAG_ITEM = 0xFFFEE000
+TAG_ITEM_DELIMITER = 0xFFFEE00D
+TAG_SEQUENCE_DELIMITER = 0xFFFEE0DD
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+_unpack_tag = struct.Struct("<HH").unpack
+_unpack_u16 = struct.Struct("<H").unpack
+_unpack_u32 = struct.Struct("<I").unpack
+
+
+class FastReadUnsupported(Exception):
+    """Raised when the fast path cannot handle a file; use pydicom.dcmread instead."""
+
+
+class _Element:
+    """Stand-in for pydicom's DataElement: only .value is used by the extractors."""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class HeaderView(dict):
+    """Dataset-like mapping of (group, element) -> _Element.
+
+    Supports the `tag in ds` / `ds.get(tag)` access used by the compiled
+    extractors (dicom_fields.py), so the same code runs on both read paths.
+    """
+
+
+class _PushbackReader:
+    """Wrap a non-seekable stream (e.g. a tar member) so peeked bytes can be put back."""
+
+    def __init__(self, f):
+        self._f = f
+        self._pending = b""
+
+    def read(self, size):
+        if not self._pending:
+            return self._f.read(size)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        if len(data) < size:
+            data += self._f.read(size - len(data))
+        return data
+
+    def unread(self, data):
+        self._pending = data + self._pending
+
+    def seekable(self):
+        return False
+
+
+def _unread(f, data):
+    if isinstance(f, _PushbackReader):
+        f.unread(data)
+    else:
+        f.seek(-len(data), 1)
+
+
+def _tag_int(tag):
+    return (tag[0] << 16) | tag[1]
+
+
+def _skip(f, length):
+    """Skip length bytes; seek when possible, read through otherwise (stream sources)."""
+    if f.seekable():
+        f.seek(length, 1)
+        return
+    while length > 0:
+        data = f.read(min(length, READ_BUFFER_SIZE))
+        if not data:
+            raise FastReadUnsupported("unexpected end of file while skipping")
+        length -= len(data)
+
+
+def _read_exact(f, length):
+    data = f.read(length)
+    if len(data) != length:
+        raise FastReadUnsupported("unexpected end of file")
+    return data
+
+
+def _read_element_header(f, explicit):
+    """Return (tag, vr, length) or None at end of file. vr is None for implicit VR and item tags."""
+    raw = f.read(4)
+    if len(raw) < 4:
+        if raw:
+            raise FastReadUnsupported("truncated element header")
+        return None
+    group, elem = _unpack_tag(raw)
+    tag = (group << 16) | elem
+    if not explicit or group == 0xFFFE:
+        return tag, None, _unpack_u32(_read_exact(f, 4))[0]
+    vr = _read_exact(f, 2)
+    if not (65 <= vr[0] <= 90 and 65 <= vr[1] <= 90):
+        raise FastReadUnsupported(f"invalid VR at tag {tag:08X}")
+    if vr in LONG_LENGTH_VRS:
+        _read_exact(f, 2) # reserved
+        return tag, vr, _unpack_u32(_read_exact(f, 4))[0]
+    return tag, vr, _unpack_u16(_read_exact(f, 2))[0]
+
+
+def _skip_undefined_length(f, explicit):
+    """Skip the items of an undefined-length sequence (or encapsulated pixel data) up to its delimiter."""
+    while True:
+        header = _read_element_header(f, False)
+        if header is None:
+            raise FastReadUnsupported("missing sequence delimiter")
+        tag, _, length = header
+        if tag == TAG_SEQUENCE_DELIMITER:
+            return
+        if tag != TAG_ITEM:
+            raise FastReadUnsupported(f"unexpected tag {tag:08X} inside sequence")
+        if length == UNDEFINED_LENGTH:
+            _skip_item_dataset(f, explicit)
+        else:
+            _skip(f, length)
+
+
+def _skip_item_dataset(f, explicit):
+    """Skip the elements of an undefined-length item up to its item delimiter."""
+    while True:
+        header = _read_element_header(f, explicit)
+        if header is None:
+            raise FastReadUnsupported("missing item delimiter")
+        tag, vr, length = header
+        if tag == TAG_ITEM_DELIMITER:
+            return
+        if length == UNDEFINED_LENGTH:
+            # An undefined-length UN element is encoded as implicit VR
+            _skip_undefined_length(f, explicit and vr != b"UN")
+        else:
+            _skip(f, length)
+
+
+def _text(raw, codec):
+    """bytes -> str; undecodable bytes are left to dcmread, which substitutes replacement characters."""
+    try:
+        return raw.decode(codec)
+    except (UnicodeDecodeError, LookupError) as e:
+        raise FastReadUnsupported(f"cannot decode value as {codec}: {e}")
+
+
+def _decode(raw, vr, codec):
+    """Convert a raw value the way pydicom would for the VRs in the field map."""
+    text = _text(raw, codec).rstrip(" \x00")
+    if "\\" in text:
+        raise FastReadUnsupported("multi-valued element") # pydicom returns a MultiValue
+    if vr == "DS":
+        return DSfloat(text.strip()) if text.strip() else None
+    if vr == "IS":
+        return IS(text.strip()) if text.strip() else None
+    return text
+
+
+def _read_file_meta(f):
+    """Parse the group 0002 file meta (always explicit VR LE), return the transfer syntax UID."""
+    transfer_syntax = None
+    while True:
+        raw = f.read(2)
+        if len(raw) < 2:
+            raise FastReadUnsupported("no dataset after file meta")
+        _unread(f, raw)
+        if _unpack_u16(raw)[0] != 0x0002:
+            return transfer_syntax
+        tag, _, length = _read_element_header(f, True)
+        if length == UNDEFINED_LENGTH:
+            raise FastReadUnsupported("undefined length in file meta")
+        if tag == 0x00020010:
+            transfer_syntax = _text(_read_exact(f, length), "ascii").rstrip(" \x00")
+        else:
+            _skip(f, length)
+
+
+def _detect_dataset_encoding(f):
+    """No file meta: guess explicit vs implicit VR LE from the first element header."""
+    head = f.read(8)
+    _unread(f, head)
+    if len(head) < 8:
+        raise FastReadUnsupported("file too short")
+    group = _unpack_u16(head[:2])[0]
+    if group not in (0x0008, 0x0010, 0x0018, 0x0020):
+        raise FastReadUnsupported("no DICM marker and no plausible dataset start")
+    return 65 <= head[4] <= 90 and 65 <= head[5] <= 90
+
+
+def _read_dataset(f, explicit, wanted, stop_tag):
+    """Walk top-level elements, decode wanted tags, stop after stop_tag."""
+    view = HeaderView()
+    codec = "latin-1"
+    while True:
+        header = _read_element_header(f, explicit)
+        if header is None:
+            break # dataset ended before stop_tag
+        tag, vr, length = header
+        if tag > stop_tag:
+            break
+        if length == UNDEFINED_LENGTH:
+            if tag in wanted:
+                raise FastReadUnsupported(f"undefined length for wanted tag {tag:08X}")
+            _skip_undefined_length(f, explicit and vr != b"UN")
+            continue
+        if tag == TAG_SPECIFIC_CHARSET:
+            charset = _text(_read_exact(f, length), "ascii").strip(" \x00")
+            if charset not in CHARSET_CODECS:
+                raise FastReadUnsupported(f"character set {charset!r}")
+            codec = CHARSET_CODECS[charset]
+        elif tag in wanted:
+            vr_name = _text(vr, "ascii") if vr else wanted[tag]
+            if vr_name not in TEXT_VRS and vr_name not in ("DS", "IS"):
+                raise FastReadUnsupported(f"VR {vr_name} for tag {tag:08X}")
+            view[(tag >> 16, tag & 0xFFFF)] = _Element(_decode(_read_exact(f, length), vr_name, codec))
+        else:
+            _skip(f, length)
+        if tag == stop_tag:
+            break
+    return view
+
+
+def looks_like_dicom(head):
+    """Content check on the first SNIFF_BYTES of a file (no extension needed).
+
+    True for the preamble + 'DICM' marker, for file meta (group 0002) written
+    without preamble, and for a bare dataset starting with a group 0008
+    element whose header is valid explicit or implicit VR little endian.
+    """
+    if len(head) >= SNIFF_BYTES and head[128:132] == b"DICM":
+        return True
+    if len(head) < 8:
+        return False
+    group = _unpack_u16(head[:2])[0]
+    if group == 0x0002:
+        return head[4:6] in ALL_VRS # file meta is always explicit VR
+    if group != 0x0008:
+        return False
+    if head[4:6] in ALL_VRS:
+        return True
+    length = _unpack_u32(head[4:8])[0]
+    return length < SNIFF_MAX_FIRST_LENGTH and length % 2 == 0
+
+
+def sniff_dicom(file_path):
+    """One SNIFF_BYTES read (unbuffered) + looks_like_dicom(); unreadable files count as DICOM.
+
+    Unreadable files are passed on so the extraction stage records them in
+    the failure ledger like any other read error.
+    """
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return True
+    try:
+        return looks_like_dicom(os.read(fd, SNIFF_BYTES))
+    except OSError:
+        return True
+    finally:
+        os.close(fd)
+
+
+def compile_wanted_tags(tags):
+    """Return {tag_int: dictionary VR} for a collection of (group, element) tags."""
+    return {_tag_int(tag): dictionary_VR(tag) for tag in tags}
+
+
+def read_tags(source, wanted_tags):
+    """Read only wanted_tags from a DICOM file (path or binary file object).
+
+    wanted_tags is the dict returned by compile_wanted_tags(). Returns a
+    HeaderView; raises FastReadUnsupported for encodings handled only by dcmread.
+    """
+    if isinstance(source, (str, bytes)) or hasattr(source, "__fspath__"):
+        with open(source, "rb", buffering=READ_BUFFER_SIZE) as f:
+            return read_tags(f, wanted_tags)
+    f = source if source.seekable() else _PushbackReader(source)
+    stop_tag = max(wanted_tags)
+    preamble = f.read(132)
+    if len(preamble) == 132 and preamble[128:132] == b"DICM":
+        transfer_syntax = _read_file_meta(f)
+    else:
+        _unread(f, preamble)
+        if preamble[:2] == b"\x02\x00":
+            transfer_syntax = _read_file_meta(f) # file meta without preamble
+        else:
+            transfer_syntax = IMPLICIT_VR_LE if not _detect_dataset_encoding(f) else EXPLICIT_VR_LE
+    if transfer_syntax is None or transfer_syntax in UNSUPPORTED_TRANSFER_SYNTAXES:
+        raise FastReadUnsupported(f"transfer syntax {transfer_syntax}")
+    explicit = transfer_syntax != IMPLICIT_VR_LE
+    return _read_dataset(f, explicit, wanted_tags, stop_tag)
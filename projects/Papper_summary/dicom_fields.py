@@ -0,0 +1,176 @@
+# dicom_fields.py
+# Extracted columns, declared once in dicom_fields.json and compiled into extraction functions
+#
+# Each field is (tag, column, SQL type, converter). The field list is compiled
+# into straight-line Python: one ds.get() per tag, the converter applied to the
+# element, and the row tuple built directly (file_path first), so there is no
+# per-field lambda, no intermediate dict and no second stringify pass per file.
+# The shared ingest pipeline (dicom_ingest.py) imports the compiled functions.
+#
+# Another field list can be used by pointing DICOM_FIELDS_CONFIG at a JSON file
+# of the same shape (it is an environment variable so spawned worker processes
+# load the same list). Existing flat tables get missing columns added.
+import json
+import os
+import re
+from collections import namedtuple
+
+from dicom_fastread import compile_wanted_tags
+from dicom_schema import to_date_int, to_real, to_text, to_time_int
+
+# --- 設定 ---
+DEFAULT_FIELDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dicom_fields.json")
+FIELDS_FILE = os.environ.get("DICOM_FIELDS_CONFIG") or DEFAULT_FIELDS_FILE
+SQL_TYPES = ("TEXT", "INTEGER", "REAL")
+# Always read: SOPClassUID (validity check) and SOPInstanceUID (file manifest)
+SOP_CLASS_UID = (0x0008, 0x0016)
+SOP_INSTANCE_UID = (0x0008, 0x0018)
+SERIES_UID_COLUMN = "series_instance_uid"
+# Indexed when configured: duplicate detection (dicom_dedup.py) looks instances up by it
+SOP_UID_COLUMN = "sop_instance_uid"
+
+Field = namedtuple("Field", "tag column sql_type converter instance_level")
+
+_TAG = re.compile(r"^([0-9A-Fa-f]{4}),([0-9A-Fa-f]{4})$")
+_COLUMN = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+# --- Converters: DataElement (or None when the tag is missing) -> column value ---
+
+def _plain(value):
+    """pydicom / fast-path value -> a type sqlite3 stores as is (str, int, float, None)."""
+    cls = type(value)
+    if cls is str or cls is int or cls is float or value is None:
+        return value
+    # UID, DSfloat, IS, ...: the builtin value; PersonName, MultiValue, Decimal: their text
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int):
+        return int(value)
+    return str(value)
+
+
+def _text(element):
+    """The original column format: value as stored, 'N/A' when the tag is missing."""
+    return "N/A" if element is None else _plain(element.value)
+
+
+def _typed(convert):
+    def converter(element):
+        return None if element is None else convert(_plain(element.value))
+    return converter
+
+
+def _to_int(value):
+    value = to_text(value)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+CONVERTERS = {
+    "text": _text,
+    "date": _typed(to_date_int), # YYYYMMDD integer
+    "time": _typed(to_time_int), # HHMMSS integer
+    "real": _typed(to_real),
+    "int": _typed(_to_int),
+}
+
+
+def load_fields(fields_file=FIELDS_FILE):
+    """Read and validate a field list; raises ValueError on a malformed file."""
+    with open(fields_file, "r") as f:
+        config = json.load(f)
+    fields = []
+    seen = set()
+    for entry in config.get("fields", []):
+        match = _TAG.match(entry.get("tag", ""))
+        column = entry.get("column", "")
+        sql_type = entry.get("sql_type", "TEXT").upper()
+        converter = entry.get("converter", "text")
+        if not match:
+            raise ValueError(f"{fields_file}: bad tag {entry.get('tag')!r} (expected 'GGGG,EEEE')")
+        if not _COLUMN.match(column) or column == "file_path" or column in seen:
+            raise ValueError(f"{fields_file}: bad or duplicate column name {column!r}")
+        if sql_type not in SQL_TYPES:
+            raise ValueError(f"{fields_file}: {column}: sql_type must be one of {', '.join(SQL_TYPES)}")
+        if converter not in CONVERTERS:
+            raise ValueError(f"{fields_file}: {column}: converter must be one of {', '.join(CONVERTERS)}")
+        seen.add(column)
+        tag = (int(match.group(1), 16), int(match.group(2), 16))
+        fields.append(Field(tag, column, sql_type, converter, bool(entry.get("instance_level", False))))
+    if not fields:
+        raise ValueError(f"{fields_file}: no fields declared")
+    return fields
+
+
+def compile_extractor(fields, with_path):
+    """Build extract(ds[, file_path]) -> tuple of converted values in `fields` order.
+
+    The generated function does exactly one ds.get() per tag; tags are tuple
+    constants, converters are bound as globals of the generated code.
+    """
+    namespace = {}
+    args = "ds, file_path" if with_path else "ds"
+    lines = [f"def extract({args}):", "    get = ds.get"]
+    values = ["file_path"] if with_path else []
+    for i, field in enumerate(fields):
+        namespace[f"_conv{i}"] = CONVERTERS[field.converter]
+        values.append(f"_conv{i}(get({field.tag!r}))")
+    lines.append(f"    return ({', '.join(values)},)")
+    exec("\n".join(lines), namespace)
+    return namespace["extract"]
+
+
+# --- The active field list (module level, so spawned workers compile the same functions) ---
+
+FIELDS = load_fields()
+COLUMNS = ("file_path",) + tuple(field.column for field in FIELDS)
+# Tags read by the fast-path header reader; parsing stops right after the highest one
+FAST_READ_TAGS = compile_wanted_tags([SOP_CLASS_UID, SOP_INSTANCE_UID] + [field.tag for field in FIELDS])
+# extract_row(ds, file_path) -> row tuple in COLUMNS order
+extract_row = compile_extractor(FIELDS, with_path=True)
+
+# --series-sample: the files after the sample only get a targeted read of the series UID
+# (membership check) and the per-instance columns; the rest is copied from the sample
+INSTANCE_FIELDS = tuple(field for field in FIELDS if field.instance_level)
+INSTANCE_COLUMNS = tuple(field.column for field in INSTANCE_FIELDS)
+_SERIES_FIELDS = tuple(field for field in FIELDS if field.column == SERIES_UID_COLUMN)
+PROBE_TAGS = compile_wanted_tags([SOP_CLASS_UID, SOP_INSTANCE_UID]
+                                 + [field.tag for field in _SERIES_FIELDS + INSTANCE_FIELDS])
+# extract_probe(ds) -> (series UID, *per-instance values); only used when the series UID is configured
+extract_probe = compile_extractor(_SERIES_FIELDS + INSTANCE_FIELDS, with_path=False)
+
+INSERT_COLUMNS = ", ".join(COLUMNS)
+INSERT_PLACEHOLDERS = ", ".join(["?"] * len(COLUMNS))
+INSERT_SQL = f"INSERT OR IGNORE INTO dicom_metadata ({INSERT_COLUMNS}) VALUES ({INSERT_PLACEHOLDERS})"
+# Rescan mode re-parses changed files, whose old rows must be overwritten
+REPLACE_SQL = f"INSERT OR REPLACE INTO dicom_metadata ({INSERT_COLUMNS}) VALUES ({INSERT_PLACEHOLDERS})"
+
+
+def create_flat_table(conn):
+    """Create dicom_metadata for the active field list; add columns an older table lacks.
+
+    A sop_instance_uid column added to an existing table is filled from the
+    file manifest, which has recorded the UID of every parsed file all along.
+    """
+    column_defs = ",\n".join(["    file_path TEXT PRIMARY KEY"]
+                             + [f"    {field.column} {field.sql_type}" for field in FIELDS])
+    conn.execute(f"CREATE TABLE IF NOT EXISTS dicom_metadata (\n{column_defs}\n)")
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(dicom_metadata)")}
+    added = []
+    for field in FIELDS:
+        if field.column not in existing:
+            conn.execute(f"ALTER TABLE dicom_metadata ADD COLUMN {field.column} {field.sql_type}")
+            added.append(field.column)
+    if SOP_UID_COLUMN in added and any(
+            row[1] == "file_path" for row in conn.execute("PRAGMA table_info(file_manifest)")):
+        conn.execute("UPDATE dicom_metadata SET sop_instance_uid = (SELECT m.sop_instance_uid FROM file_manifest m "
+                     "WHERE m.file_path = dicom_metadata.file_path)")
+    if SOP_UID_COLUMN in COLUMNS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_metadata_sop_uid ON dicom_metadata({SOP_UID_COLUMN})")
+    conn.commit()
+    return added
@@ -0,0 +1,274 @@
+# dicom_filter.py
+# Phase 2 (already-processed filter) shared by dicom_metadata2.py / dicom_metadata3.py
+#
+# Candidate paths are bulk-loaded into a TEMP table in chunks, and one anti-join
+# per chunk against dicom_metadata (instances in the normalized schema) returns
+# the new ones. The temp table is keyed (sorted) by path, so the probes walk the
+# primary-key index in order instead of jumping around with one SELECT per path.
+# Memory is bounded by the chunk size.
+#
+# In the normalized schema (prefix-compressed paths, see dicom_paths.py) a chunk
+# is held as {directory: [file names]}: each directory is looked up once, the
+# files of directories the DB has never seen are new without any probe, and
+# the rest are anti-joined on (directory_pk, file_name).
+#
+# Optionally, a persistent bloom filter sidecar (--bloom FILE) answers "definitely
+# not processed" without touching the DB; only "maybe processed" paths go
+# through the anti-join, so false positives never drop a new file.
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from datetime import datetime
+
+from dicom_manifest import paths_generation
+from dicom_paths import find_directories, group_by_directory
+from dicom_schema import detect_schema, iter_path_rows, path_at_rowid, path_table
+
+# --- 設定 ---
+FILTER_CHUNK_SIZE = 50000
+FILTER_REPORT_INTERVAL = 1000000
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+BLOOM_MIN_CAPACITY = 1000000
+# Headroom so a growing archive does not force a rebuild every run
+BLOOM_CAPACITY_FACTOR = 2
+
+_BLOOM_MAGIC = b"DCMBLOM2"
+# magic, m_bits, k_hashes, capacity, synced rowid, rows up to it, DB identity, paths generation
+_BLOOM_HEADER = struct.Struct("<8sQQQqqQq")
+_unpack_hash = struct.Struct("<QQ").unpack
+
+
+class PathBloomFilter:
+    """mmap-backed bloom filter over processed file paths, persisted next to the DB.
+
+    The header records the highest rowid of the path table (dicom_metadata,
+    or instances in the normalized schema) already added, so sync() only
+    reads rows inserted since the last run. It also records what the DB
+    looked like at that point (rows up to that rowid, the schema and path
+    of the last one, dicom_manifest.paths_generation()): stale_reason()
+    tells when the sidecar no longer describes the DB (another or migrated
+    DB, relinked or deleted rows) and has to be rebuilt.
+    """
+
+    def __init__(self, path, mm, m_bits, k_hashes, capacity, synced_rowid, synced_count=0, identity=0,
+                 generation=0):
+        self.path = path
+        self._mm = mm
+        self.m_bits = m_bits
+        self.k_hashes = k_hashes
+        self.capacity = capacity
+        self.synced_rowid = synced_rowid
+        self.synced_count = synced_count
+        self.identity = identity
+        self.generation = generation
+
+    @classmethod
+    def create(cls, path, capacity):
+        m_bits = int(-capacity * math.log(BLOOM_FALSE_POSITIVE_RATE) / (math.log(2) ** 2))
+        m_bits = (m_bits + 7) // 8 * 8
+        k_hashes = max(1, round(m_bits / capacity * math.log(2)))
+        with open(path, "wb") as f:
+            f.write(_BLOOM_HEADER.pack(_BLOOM_MAGIC, m_bits, k_hashes, capacity, 0, 0, 0, 0))
+            f.truncate(_BLOOM_HEADER.size + m_bits // 8)
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "r+b") as f:
+            mm = mmap.mmap(f.fileno(), 0)
+        magic, m_bits, k_hashes, capacity, synced_rowid, synced_count, identity, generation = \
+            _BLOOM_HEADER.unpack_from(mm, 0)
+        if magic != _BLOOM_MAGIC or len(mm) != _BLOOM_HEADER.size + m_bits // 8:
+            mm.close()
+            raise ValueError(f"Not a bloom filter sidecar (or an older format): {path}")
+        return cls(path, mm, m_bits, k_hashes, capacity, synced_rowid, synced_count, identity, generation)
+
+    def _positions(self, file_path):
+        h1, h2 = _unpack_hash(hashlib.blake2b(file_path.encode("utf-8", "surrogateescape"), digest_size=16).digest())
+        m = self.m_bits
+        return [(h1 + i * h2) % m for i in range(self.k_hashes)]
+
+    def add(self, file_path):
+        mm = self._mm
+        base = _BLOOM_HEADER.size
+        for pos in self._positions(file_path):
+            mm[base + (pos >> 3)] |= 1 << (pos & 7)
+
+    def __contains__(self, file_path):
+        mm = self._mm
+        base = _BLOOM_HEADER.size
+        for pos in self._positions(file_path):
+            if not mm[base + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def stale_reason(self, conn):
+        """Why the sidecar no longer matches the DB, or None if sync() can catch it up."""
+        if self.generation != paths_generation(conn):
+            return "rows were re-linked or deleted since the last sync"
+        if self.identity != _db_identity(conn, path_at_rowid(conn, self.synced_rowid)):
+            return "it was built for another database, or before a migration"
+        count = conn.execute(f"SELECT COUNT(*) FROM {path_table(conn)} WHERE rowid <= ?",
+                             (self.synced_rowid,)).fetchone()[0]
+        if count != self.synced_count:
+            return f"{self.synced_count} rows were synced, the database now has {count} of them"
+        return None
+
+    def sync(self, conn):
+        """Add rows inserted since the last sync; returns the number of paths added."""
+        added = 0
+        last_path = None
+        for rowid, file_path in iter_path_rows(conn, self.synced_rowid):
+            self.add(file_path)
+            self.synced_rowid = rowid
+            last_path = file_path
+            added += 1
+        self.synced_count += added
+        if added or self.synced_rowid == 0:
+            self.identity = _db_identity(conn, last_path)
+        self.generation = paths_generation(conn)
+        _BLOOM_HEADER.pack_into(self._mm, 0, _BLOOM_MAGIC, self.m_bits, self.k_hashes, self.capacity,
+                                self.synced_rowid, self.synced_count, self.identity, self.generation)
+        self._mm.flush()
+        return added
+
+    def close(self):
+        self._mm.close()
+
+
+def _db_identity(conn, last_path):
+    """Header fingerprint of the DB: its schema and the path of the last synced row."""
+    key = f"{detect_schema(conn)}\0{last_path or ''}".encode("utf-8", "surrogateescape")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def open_bloom_filter(bloom_file, conn):
+    """Open (or build / rebuild when outgrown or stale) the sidecar and catch it up with the DB."""
+    row_count = conn.execute(f"SELECT COUNT(*) FROM {path_table(conn)}").fetchone()[0]
+    bloom = None
+    if os.path.exists(bloom_file):
+        try:
+            bloom = PathBloomFilter.open(bloom_file)
+        except (ValueError, OSError, struct.error) as e:
+            print(f"Warning: Ignoring unreadable bloom filter {bloom_file}: {e}")
+        if bloom is not None and row_count > bloom.capacity:
+            print(f"Bloom filter capacity {bloom.capacity} exceeded by {row_count} rows, rebuilding...")
+            bloom.close()
+            bloom = None
+        if bloom is not None:
+            reason = bloom.stale_reason(conn)
+            if reason is not None:
+                print(f"Bloom filter {bloom_file} is out of date ({reason}), rebuilding...")
+                bloom.close()
+                bloom = None
+    if bloom is None:
+        capacity = max(BLOOM_MIN_CAPACITY, row_count * BLOOM_CAPACITY_FACTOR)
+        print(f"[{datetime.now()}] Building bloom filter {bloom_file} for {row_count} rows (capacity {capacity})...")
+        bloom = PathBloomFilter.create(bloom_file, capacity)
+    start_time = time.time()
+    added = bloom.sync(conn)
+    print(f"Bloom filter synced: {added} new paths added in {time.time() - start_time:.2f} seconds.")
+    return bloom
+
+
+def _anti_join(conn, paths):
+    """Flat schema: return the paths (chunk) that are not in dicom_metadata, via one temp-table anti-join."""
+    c = conn.cursor()
+    c.execute("DELETE FROM temp.filter_candidates")
+    c.executemany("INSERT OR IGNORE INTO temp.filter_candidates (file_path) VALUES (?)", ((p,) for p in paths))
+    new_paths = [row[0] for row in c.execute(
+        "SELECT fc.file_path FROM temp.filter_candidates fc "
+        "WHERE NOT EXISTS (SELECT 1 FROM dicom_metadata dm WHERE dm.file_path = fc.file_path)")]
+    # End the implicit transaction: an open read snapshot would pin the WAL and hide the writer's commits
+    conn.commit()
+    return new_paths
+
+
+def _anti_join_directories(conn, paths):
+    """Normalized schema: the paths (chunk) not in instances, matched on (directory_pk, file_name)."""
+    groups = group_by_directory(paths)
+    known_directories = find_directories(conn, groups)
+    new_paths = []
+    c = conn.cursor()
+    c.execute("DELETE FROM temp.filter_directory_candidates")
+    for directory, names in groups.items():
+        directory_pk = known_directories.get(directory)
+        if directory_pk is None:
+            new_paths.extend(directory + name for name in names) # directory never ingested
+        else:
+            c.executemany("INSERT OR IGNORE INTO temp.filter_directory_candidates (directory_pk, file_name) "
+                          "VALUES (?, ?)", ((directory_pk, name) for name in names))
+    if known_directories:
+        paths_by_key = {pk: directory for directory, pk in known_directories.items()}
+        new_paths.extend(paths_by_key[directory_pk] + name for directory_pk, name in c.execute(
+            "SELECT fc.directory_pk, fc.file_name FROM temp.filter_directory_candidates fc WHERE NOT EXISTS "
+            "(SELECT 1 FROM instances i WHERE i.directory_pk = fc.directory_pk AND i.file_name = fc.file_name)"))
+    conn.commit()
+    return new_paths
+
+
+def filter_unprocessed_files(all_files, conn, bloom_file=None, chunk_size=FILTER_CHUNK_SIZE):
+    """Phase 2 (streaming): yield the paths that are not in the database yet.
+
+    With bloom_file, bloom negatives are yielded straight away and only the
+    possible matches are checked against the DB.
+    """
+    print(f"[{datetime.now()}] Phase 2: Filtering scanned files against database "
+          f"(temp-table anti-join{', bloom filter ' + bloom_file if bloom_file else ''})...")
+    if detect_schema(conn) == "normalized":
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS filter_directory_candidates "
+                     "(directory_pk INTEGER, file_name TEXT, PRIMARY KEY (directory_pk, file_name)) WITHOUT ROWID")
+        anti_join, candidates = _anti_join_directories, "filter_directory_candidates"
+    else:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS filter_candidates (file_path TEXT PRIMARY KEY) WITHOUT ROWID")
+        anti_join, candidates = _anti_join, "filter_candidates"
+    bloom = open_bloom_filter(bloom_file, conn) if bloom_file else None
+    start_time = time.time()
+    checked_count = 0
+    new_count = 0
+    bloom_negatives = 0
+    next_report = FILTER_REPORT_INTERVAL
+    chunk = []
+    try:
+        for file_path in all_files:
+            checked_count += 1
+            if bloom is not None and file_path not in bloom:
+                bloom_negatives += 1
+                new_count += 1
+                yield file_path
+            else:
+                chunk.append(file_path)
+                if len(chunk) >= chunk_size:
+                    new_paths = anti_join(conn, chunk)
+                    chunk = []
+                    new_count += len(new_paths)
+                    yield from new_paths
+            if checked_count >= next_report:
+                next_report += FILTER_REPORT_INTERVAL
+                elapsed = time.time() - start_time
+                rate = checked_count / elapsed if elapsed > 0 else 0
+                print(f"Checked: {checked_count} | New: {new_count} | Rate: {rate:.0f} files/sec")
+        if chunk:
+            new_paths = anti_join(conn, chunk)
+            new_count += len(new_paths)
+            yield from new_paths
+    finally:
+        conn.execute(f"DELETE FROM temp.{candidates}")
+        conn.commit()
+        if bloom is not None:
+            bloom.close()
+
+    end_time = time.time()
+    print(f"[{datetime.now()}] Phase 2: Filtering complete in {end_time - start_time:.2f} seconds (overlapped with Phase 3).")
+    print(f"Total files checked: {checked_count}")
+    print(f"Already processed: {checked_count - new_count}")
+    print(f"Files to process : {new_count}" + (f" ({bloom_negatives} decided by bloom filter)" if bloom is not None else ""))
+
+
+def sync_bloom_file(bloom_file, conn):
+    """After a run: add the rows this run committed (rebuild if it relinked / deleted rows)."""
+    if bloom_file and os.path.exists(bloom_file):
+        open_bloom_filter(bloom_file, conn).close()
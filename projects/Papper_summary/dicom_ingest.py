@@ -0,0 +1,644 @@
+# dicom_ingest.py
+# Ingest pipeline shared by dicom_metadata2.py (directory scan) and dicom_metadata3.py (file list / crawler)
+#
+# The two scripts differ only in where the paths come from. Everything after
+# that lives here: database setup, the processed-file filter (or the rescan
+# comparison against the file manifest), the failure ledger, sniffing, dedup,
+# the extraction engines and the DB writer. A run is described by one
+# IngestOptions (the shared command-line flags, see add_ingest_arguments())
+# plus the script's path source:
+#   iter_paths(shard_filter, name_filter)        -> paths (normal runs)
+#   iter_stat_entries(shard_filter, name_filter) -> (path, stat) pairs (--rescan)
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from functools import partial
+
+import pydicom
+
+from dicom_archive import archive_name_filter, extract_archive_group, iter_expanded, iter_source_groups
+from dicom_autotune import AutoTuner, default_autotune_max
+from dicom_crawler import DEFAULT_SCAN_THREADS, dcm_suffix_filter
+from dicom_dedup import LinkedResults, has_uid_column, iter_deduplicated
+from dicom_engine import DEFAULT_CHUNK_SIZE, DEFAULT_ENGINE, DEFAULT_IO_THREADS, ENGINES, io_map, iter_extracted
+from dicom_export import DEFAULT_PARTITION_BY, ParquetSink, require_pyarrow
+from dicom_failures import (INVALID_DICOM, MISSING_SOP_CLASS, PARSE_ERROR, READ_ERROR, FailedFile,
+                            clear_failures, create_failure_table, failed_file, record_failures,
+                            skip_known_failures, split_results)
+from dicom_fastread import FastReadUnsupported, read_tags
+from dicom_fields import (COLUMNS, FAST_READ_TAGS, INSERT_SQL, INSTANCE_COLUMNS, PROBE_TAGS, REPLACE_SQL,
+                          SERIES_UID_COLUMN, SOP_CLASS_UID, SOP_INSTANCE_UID, create_flat_table,
+                          extract_probe, extract_row)
+from dicom_filter import filter_unprocessed_files, sync_bloom_file
+from dicom_manifest import (Removed, apply_changes, create_manifest_table, iter_changed_files, manifest_entry,
+                            remove_files, split_changes, upsert_manifest)
+from dicom_metrics import (DEFAULT_METRICS_INTERVAL, DEFAULT_SLOW_FILES, Metrics, TimedResult,
+                           read_header_timed, strip_timings, timed_stage)
+from dicom_paths import is_member_path
+from dicom_rollup import open_rollups
+from dicom_sampling import DEFAULT_SAMPLE_FILES, iter_directory_groups, sample_series_group
+from dicom_schema import NormalizedInserter, create_normalized_schema, resolve_schema
+from dicom_shard import DEFAULT_SHARD_BY, SHARD_MODES, ShardFilter, parse_shard
+from dicom_sniff import any_file_filter, iter_sniffed
+from dicom_writer import DEFAULT_COMMIT_ROWS, DEFAULT_COMMIT_SECONDS, DbWriter, PendingResults, configure_connection
+
+# --- 設定 ---
+DEFAULT_MAX_WORKERS = os.cpu_count() or 4
+# Batch size for database insertion (matches user's 5000-10000 range)
+DB_BATCH_SIZE = 8000
+# Progress reporting frequency (every N files processed in parallel phase)
+PROGRESS_REPORT_INTERVAL = 10000
+
+
+class IngestOptions:
+    """Settings of one ingest run; keyword arguments override the defaults below."""
+
+    def __init__(self, **settings):
+        self.max_workers = DEFAULT_MAX_WORKERS
+        self.batch_size = DB_BATCH_SIZE
+        self.engine = DEFAULT_ENGINE
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        self.io_threads = DEFAULT_IO_THREADS
+        self.scan_threads = DEFAULT_SCAN_THREADS
+        self.commit_rows = DEFAULT_COMMIT_ROWS
+        self.commit_seconds = DEFAULT_COMMIT_SECONDS
+        self.rescan = False
+        self.bloom_file = None
+        self.schema = "flat"
+        self.series_sample = 0
+        self.retry_failed = False
+        self.metrics = None # dicom_metrics.Metrics
+        self.parquet_dir = None
+        self.parquet_partition_by = DEFAULT_PARTITION_BY
+        self.shard = None # (index, count) from dicom_shard.parse_shard
+        self.shard_by = DEFAULT_SHARD_BY
+        self.sniff = False
+        self.archives = False
+        self.autotune = False
+        self.autotune_max = None
+        self.dedup = False
+        self.rollups = False
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise TypeError(f"Unknown ingest option: {name}")
+            setattr(self, name, value)
+
+    @classmethod
+    def from_args(cls, args):
+        """Options from the flags added by add_ingest_arguments()."""
+        metrics = None
+        if args.metrics_jsonl or args.metrics_prom:
+            metrics = Metrics(args.metrics_jsonl, args.metrics_prom, args.metrics_interval, args.slow_files)
+        return cls(max_workers=args.workers, batch_size=args.batchsize, engine=args.engine,
+                   chunk_size=args.chunksize, io_threads=args.io_threads, scan_threads=args.scan_threads,
+                   commit_rows=args.commit_rows, commit_seconds=args.commit_seconds, rescan=args.rescan,
+                   bloom_file=os.path.abspath(args.bloom) if args.bloom else None, schema=args.schema,
+                   series_sample=args.series_sample, retry_failed=args.retry_failed, metrics=metrics,
+                   parquet_dir=os.path.abspath(args.parquet_dir) if args.parquet_dir else None,
+                   parquet_partition_by=args.parquet_partition_by, shard=args.shard, shard_by=args.shard_by,
+                   sniff=args.sniff, archives=args.archives, autotune=args.autotune,
+                   autotune_max=args.autotune_max, dedup=args.dedup, rollups=args.rollups)
+
+
+def add_ingest_arguments(parser):
+    """Command-line flags shared by dicom_metadata2.py and dicom_metadata3.py (all but the path source)."""
+    parser.add_argument("-o", "--output", type=str, default="dicom_metadata.db",
+                        help="Path to the output SQLite database file.")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f"Number of worker threads/processes for parallel extraction (default: {DEFAULT_MAX_WORKERS}).")
+    parser.add_argument("-b", "--batchsize", type=int, default=DB_BATCH_SIZE,
+                        help=f"Number of records to insert into DB per batch (default: {DB_BATCH_SIZE}).")
+    parser.add_argument("-e", "--engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="Extraction engine: 'thread' (GIL-bound, fine for slow storage), "
+                             "'process' (one process per core, results returned in chunks), "
+                             "'hybrid' (processes with I/O threads inside each, for slow NFS mounts) "
+                             f"(default: {DEFAULT_ENGINE}).")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"Files per worker task for the process/hybrid engines (default: {DEFAULT_CHUNK_SIZE}).")
+    parser.add_argument("--io-threads", type=int, default=DEFAULT_IO_THREADS,
+                        help=f"I/O threads inside each worker process for the hybrid engine; with --series-sample / --archives "
+                             f"they read a directory's files ahead (archive members are read in stream order) "
+                             f"(default: {DEFAULT_IO_THREADS}).")
+    parser.add_argument("-s", "--scan-threads", type=int, default=DEFAULT_SCAN_THREADS,
+                        help=f"Threads listing directories in parallel while crawling (default: {DEFAULT_SCAN_THREADS}).")
+    parser.add_argument("--commit-rows", type=int, default=DEFAULT_COMMIT_ROWS,
+                        help=f"Commit after this many rows (default: {DEFAULT_COMMIT_ROWS}).")
+    parser.add_argument("--commit-seconds", type=float, default=DEFAULT_COMMIT_SECONDS,
+                        help=f"Commit at least this often while rows are pending (default: {DEFAULT_COMMIT_SECONDS}).")
+    parser.add_argument("--bloom", type=str, default=None,
+                        help="Optional bloom filter sidecar file (built on first use) that lets the filter phase "
+                             "skip the DB lookup for paths that are definitely new.")
+    parser.add_argument("--series-sample", type=int, nargs="?", const=DEFAULT_SAMPLE_FILES, default=0,
+                        metavar="N",
+                        help="Series-sampling mode: fully parse N files per directory (default N: "
+                             f"{DEFAULT_SAMPLE_FILES}) and fill in the other rows after a targeted series UID read. "
+                             "Directories that mix series are parsed file by file.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Parse files in the failure ledger again even if unchanged and not due for a retry "
+                             "(see 'python dicom_failures.py report').")
+    parser.add_argument("--metrics-jsonl", type=str, default=None,
+                        help="Append metric snapshots (phase timers, per-file open/read/parse/convert histograms, "
+                             "queue depths, insert/commit times, slowest files) to this JSON-lines file.")
+    parser.add_argument("--metrics-prom", type=str, default=None,
+                        help="Write the same metrics to this Prometheus textfile-collector file (*.prom).")
+    parser.add_argument("--metrics-interval", type=float, default=DEFAULT_METRICS_INTERVAL,
+                        help=f"Seconds between metric snapshots (default: {DEFAULT_METRICS_INTERVAL}).")
+    parser.add_argument("--slow-files", type=int, default=DEFAULT_SLOW_FILES,
+                        help=f"Number of slowest files to keep in the metrics (default: {DEFAULT_SLOW_FILES}).")
+    parser.add_argument("--schema", choices=("flat", "normalized"), default="flat",
+                        help="Table layout for a new database: 'flat' (single dicom_metadata table) or 'normalized' "
+                             "(typed, indexed patients/studies/series/instances, paths stored once per directory). "
+                             "Existing databases keep their layout; convert a flat one with "
+                             "'python dicom_schema.py migrate'.")
+    parser.add_argument("--parquet-dir", type=str, default=None,
+                        help="Also append every ingested row to a partitioned Parquet dataset in this directory "
+                             "(needs pyarrow; for a snapshot of an existing DB use 'python dicom_export.py parquet').")
+    parser.add_argument("--parquet-partition-by", type=str, default=DEFAULT_PARTITION_BY,
+                        help=f"Partition columns for --parquet-dir (default: {DEFAULT_PARTITION_BY}).")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="I/N",
+                        help="Multi-host ingestion: only process shard I of N (1-based) of the path space and "
+                             "write it to this host's own -o database; combine them with 'python dicom_shard.py merge'.")
+    parser.add_argument("--shard-by", choices=SHARD_MODES, default=DEFAULT_SHARD_BY,
+                        help="Shard key: 'dir' (parent directory, keeps series folders together) or 'top' "
+                             f"(top-level directory below each scan root, other trees are not crawled) (default: {DEFAULT_SHARD_BY}).")
+    parser.add_argument("--sniff", action="store_true",
+                        help="Also find DICOM files without a .dcm extension: every crawled (or listed) file is a "
+                             "candidate and new ones are checked by reading their first 132 bytes (preamble / DICM marker).")
+    parser.add_argument("--archives", action="store_true",
+                        help="Also read DICOM files inside .zip / .tar(.gz|.bz2|.xz) archives (crawled, or listed) "
+                             "without extracting them; members are recorded as 'archive.zip!/member.dcm' and "
+                             "unchanged archives are skipped as a whole.")
+    parser.add_argument("--autotune", action="store_true",
+                        help="Adjust the number of workers running at once while the run progresses (hill-climbing "
+                             "on files/sec, starting at -w); the setting it settles on is logged so it can be pinned with -w.")
+    parser.add_argument("--autotune-max", type=int, default=None,
+                        help="Upper bound for --autotune (default: thread engine "
+                             f"{default_autotune_max('thread')}, process engines {default_autotune_max('process')}).")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Read only up to the SOP Instance UID of each new file first; files whose UID is "
+                             "already in the DB are linked to that instance instead of being parsed "
+                             "(see 'python dicom_dedup.py report').")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Keep the series / study summary tables up to date in every insert transaction "
+                             "(see 'python dicom_rollup.py'); without it existing summaries are marked stale.")
+    parser.add_argument("--rescan", action="store_true",
+                        help="Incremental rescan: compare a stat-only walk (or the stat of each listed path) with "
+                             "the file manifest, parse only new/changed files and re-link moved ones without reading them.")
+
+
+# --- Phase 3 tasks (run in the extraction workers) ---
+
+def extract_metadata_only(file_path, timings=None, source=None):
+    """Phase 3 Task: Read DICOM and extract metadata. No DB interaction.
+
+    Returns (row tuple in COLUMNS order, SOP Instance UID), or a FailedFile
+    (stat filled in by the caller) so the failure ledger can skip the file on
+    the next run. With a timings dict (--metrics), open / read / parse /
+    convert seconds are recorded in it. source, if given, is a seekable binary
+    stream read instead of file_path (--archives: an archive member).
+    """
+    if source is None:
+        source = file_path
+    try:
+        if timings is not None:
+            # Same reads as below, with the open / read / parse split measured
+            ds = read_header_timed(source, FAST_READ_TAGS, timings)
+        else:
+            try:
+                # Fast path: decode only FAST_READ_TAGS and stop after the last one
+                ds = read_tags(source, FAST_READ_TAGS)
+            except FastReadUnsupported:
+                # Odd encodings: use force=True to try reading slightly non-compliant files
+                if source is not file_path:
+                    source.seek(0)
+                ds = pydicom.dcmread(source, stop_before_pixels=True, force=True)
+        # Basic check if it's a DICOM file with some common identifier
+        if SOP_CLASS_UID not in ds:
+            return failed_file(file_path, None, MISSING_SOP_CLASS, "No SOPClassUID")
+
+        convert_start = time.perf_counter()
+        # One lookup per configured tag, values already converted for the database
+        row = extract_row(ds, file_path)
+        # Not a dicom_metadata column: recorded in the file manifest only
+        sop_instance = ds.get(SOP_INSTANCE_UID)
+        sop_instance_uid = str(sop_instance.value) if sop_instance is not None else None
+        if timings is not None:
+            timings["convert"] = time.perf_counter() - convert_start
+        return row, sop_instance_uid
+    except pydicom.errors.InvalidDicomError as e:
+        return failed_file(file_path, None, INVALID_DICOM, e)
+    except OSError as e:
+        print(f"Error reading/extracting {file_path}: {e}")
+        return failed_file(file_path, None, READ_ERROR, e)
+    except Exception as e:
+        print(f"Error reading/extracting {file_path}: {e}")
+        return failed_file(file_path, None, PARSE_ERROR, f"{type(e).__name__}: {e}")
+
+
+def extract_metadata_row(file_path, timings=None):
+    """Phase 3 Task (engine entry point): returns (ordered tuple for INSERT_SQL, file manifest entry) or a FailedFile."""
+    try:
+        # Stat before reading, so a modification during the read shows up on the next rescan
+        st = os.stat(file_path)
+    except OSError as e:
+        print(f"Error reading/extracting {file_path}: {e}")
+        return failed_file(file_path, None, READ_ERROR, e)
+    result = extract_metadata_only(file_path, timings)
+    if isinstance(result, FailedFile):
+        # Recorded in the failure ledger together with the stat, so an unchanged file is skipped next time
+        return failed_file(file_path, st, result.error_class, result.message)
+    row, sop_instance_uid = result
+    return row, manifest_entry(file_path, st, sop_instance_uid)
+
+
+def extract_metadata_row_timed(file_path):
+    """Phase 3 Task with --metrics: extract_metadata_row result plus its per-stage timings."""
+    timings = {}
+    start = time.perf_counter()
+    result = extract_metadata_row(file_path, timings)
+    timings["total"] = time.perf_counter() - start
+    return TimedResult(file_path, timings, result)
+
+
+def probe_series_instance(file_path):
+    """--series-sample: targeted read -> (series UID, per-instance values, stat, SOP Instance UID), or None."""
+    try:
+        st = os.stat(file_path)
+        ds = read_tags(file_path, PROBE_TAGS)
+    except Exception:
+        return None # Not for the cheap path: the full parse handles (and reports) it
+    if SOP_CLASS_UID not in ds:
+        return None
+    values = extract_probe(ds) # (series UID, *INSTANCE_COLUMNS values), converted like the full parse
+    if values[0] in (None, "N/A"):
+        return None
+    sop_instance = ds.get(SOP_INSTANCE_UID)
+    return values[0], values[1:], st, str(sop_instance.value) if sop_instance is not None else None
+
+
+def extract_series_group(paths, sample_files=DEFAULT_SAMPLE_FILES):
+    """Phase 3 Task (--series-sample engine entry point): one directory per task, see dicom_sampling.py."""
+    return sample_series_group(paths, extract_metadata_row, probe_series_instance,
+                               COLUMNS, INSTANCE_COLUMNS, sample_files)
+
+
+def extract_source_group(paths, sample_files=0, sniff=False):
+    """Phase 3 Task (--archives engine entry point): the members of one archive, or one directory's files."""
+    if is_member_path(paths[0]):
+        return extract_archive_group(paths, extract_metadata_only, sniff) # archive opened once, see dicom_archive.py
+    if sample_files:
+        return extract_series_group(paths, sample_files)
+    rows = io_map(extract_metadata_row, paths) # hybrid engine: on the worker's I/O threads
+    return len(paths), [row for row in rows if row is not None]
+
+
+# --- Phase 4 (DB writer thread) ---
+
+def insert_batch(conn, results, insert_sql=INSERT_SQL, normalized=None, sink=None, rollups=None):
+    """Helper to insert batch of (metadata tuple, manifest entry) / FailedFile, returns number of rows attempted.
+
+    With normalized (a dicom_schema.NormalizedInserter) the rows go into the
+    patients / studies / series / instances tables instead of dicom_metadata.
+    With rollups (a dicom_rollup.RollupUpdater) the summaries of the series
+    the batch touches are recomputed in the same transaction. Rescan changes
+    (dicom_manifest Relinked / Adopted / Removed) are applied with the rows,
+    and a file that fails loses the row of its previous version.
+    Each batch runs inside a savepoint: a batch that fails is rolled back as
+    a whole, so the writer's next commit does not carry half of it.
+    """
+    if not results:
+        return 0
+    c = conn.cursor()
+    if not conn.in_transaction:
+        c.execute("BEGIN") # a savepoint opened outside a transaction would commit on RELEASE
+    c.execute("SAVEPOINT insert_batch")
+    try:
+        results, changes = split_changes(results)
+        results, failures = split_results(results)
+        rows = [row for row, _ in results]
+        directories = normalized.directories if normalized is not None else None
+        gone = [change.file_path for change in changes if isinstance(change, Removed)]
+        # A changed file that no longer parses must not keep the row of its previous version
+        removed = gone + [failure.file_path for failure in failures]
+        touched = rollups.touched(conn, rows, removed) if rollups is not None else ()
+        remove_files(conn, removed, directories)
+        if normalized is not None:
+            normalized.insert(conn, rows)
+        else:
+            c.executemany(insert_sql, rows)
+        upsert_manifest(conn, [entry for _, entry in results], directories)
+        apply_changes(conn, changes, directories) # --rescan: re-linked moves, adopted legacy rows
+        if rollups is not None:
+            rollups.refresh(conn, touched) # series / study summaries, committed with the batch (dicom_rollup.py)
+        # Files that failed before and parse (or are gone) now leave the ledger; new failures are recorded
+        clear_failures(conn, [entry[0] for _, entry in results] + gone)
+        record_failures(conn, failures)
+        c.execute("RELEASE SAVEPOINT insert_batch")
+    except sqlite3.Error as e:
+        print(f"Database batch insert error ({len(results)} records rolled back, parsed again next run): {e}")
+        c.execute("ROLLBACK TO SAVEPOINT insert_batch")
+        c.execute("RELEASE SAVEPOINT insert_batch")
+        if normalized is not None:
+            normalized.reset_caches() # keys resolved inside the rolled-back batch no longer exist
+        return 0 # Indicate failure / 0 inserted on error
+    if sink is not None:
+        sink.add(rows) # --parquet-dir: same rows, appended to the Parquet dataset (only once they are in the DB)
+    # Note: executemany doesn't reliably return row count in sqlite3
+    return len(results)
+
+
+def create_db_table(conn):
+    """Creates the database table if it doesn't exist (columns from dicom_fields.json)."""
+    try:
+        added = create_flat_table(conn)
+        if added:
+            print(f"Added columns to 'dicom_metadata' (new in dicom_fields.json): {', '.join(added)}")
+        print("Database table 'dicom_metadata' checked/created successfully.")
+    except sqlite3.Error as e:
+        print(f"Fatal: Could not create database table: {e}")
+        sys.exit(1)
+
+
+def process_files_parallel_and_insert(files_to_process, db_file, options, normalized=None, sink=None,
+                                      tuner=None, rollups=None, pending=()):
+    """Phase 3 & 4: Process files in parallel, collect results, and hand batches to the DB writer thread.
+
+    files_to_process is consumed lazily (scan -> filter -> extract -> batch -> write),
+    with at most a fixed window of tasks in flight, so memory stays flat
+    regardless of corpus size. The writer thread commits every commit_rows
+    rows or commit_seconds seconds; a killed run resumes from the last commit.
+    pending are the dicom_writer.PendingResults queues (dedup links, rescan
+    changes) whose upstream stages feed files_to_process.
+    """
+    engine = options.engine
+    metrics = options.metrics
+    batch_size = options.batch_size
+    print(f"[{datetime.now()}] Phase 3: Starting streaming metadata extraction using {options.max_workers} workers ({engine} engine)...")
+    start_time = time.time()
+    completed_count = 0
+    processed_count = 0
+    failed_count = 0
+    next_report = PROGRESS_REPORT_INTERVAL
+    batch_results = [] # Accumulate results for batch insertion
+
+    insert_func = partial(insert_batch, insert_sql=REPLACE_SQL if options.rescan else INSERT_SQL,
+                          normalized=normalized, sink=sink, rollups=rollups)
+    writer = DbWriter(db_file, insert_func, options.commit_rows, options.commit_seconds, metrics=metrics).start()
+    for queue in pending:
+        queue.attach(writer) # dedup links / rescan changes go through the same writer as parsed rows
+    try:
+        # Workers send back (ordered tuple, manifest entry) pairs (one per file for the thread engine,
+        # one list per chunk for the process / hybrid engines)
+        grouped = bool(options.series_sample or options.archives)
+        if options.archives:
+            # One task per archive (opened once), regular files grouped by directory
+            row_func = partial(extract_source_group, sample_files=options.series_sample, sniff=options.sniff)
+            files_to_process = iter_source_groups(files_to_process)
+        elif options.series_sample:
+            # One task per directory: parse series_sample files, confirm the rest with a targeted read
+            row_func = partial(extract_series_group, sample_files=options.series_sample)
+            files_to_process = iter_directory_groups(files_to_process)
+        else:
+            # --metrics / --autotune: workers also send back per-file open / read / parse / convert timings
+            row_func = extract_metadata_row_timed if metrics is not None or tuner is not None else extract_metadata_row
+        timed = not grouped and (metrics is not None or tuner is not None)
+        engine_stats = {}
+        extracted = iter_extracted(row_func, files_to_process, engine, options.max_workers, options.chunk_size,
+                                   options.io_threads, grouped=grouped, stats=engine_stats, tuner=tuner)
+        # Time blocked on workers, excluding the upstream scan / filter stages
+        for attempted, rows in timed_stage(metrics, "extract_wait", extracted):
+            if tuner is not None:
+                tuner.observe(attempted, rows if timed else ()) # may change the window for the next top-up
+            if timed:
+                rows = metrics.unwrap(rows) if metrics is not None else strip_timings(rows)
+            completed_count += attempted
+            failed = sum(1 for row in rows if isinstance(row, FailedFile))
+            failed_count += failed
+            processed_count += len(rows) - failed # Count successful extractions
+            batch_results.extend(rows)
+
+            # Check if batch is ready to be inserted
+            if len(batch_results) >= batch_size:
+                submit_start = time.perf_counter()
+                writer.submit(batch_results) # Only blocks if the writer is several batches behind
+                batch_results = [] # Start a new batch
+                if metrics is not None:
+                    metrics.add_phase_time("writer_backpressure", time.perf_counter() - submit_start)
+
+            if metrics is not None:
+                metrics.inc("files_completed", attempted)
+                metrics.inc("files_ok", len(rows) - failed)
+                metrics.inc("files_failed", failed)
+                metrics.set_gauge("extract_in_flight", engine_stats.get("in_flight", 0))
+                if tuner is not None:
+                    metrics.set_gauge("extract_workers", tuner.limit)
+                metrics.set_gauge("writer_queue_batches", writer.queue_depth())
+                metrics.maybe_emit()
+
+            # Progress reporting
+            if completed_count >= next_report:
+                next_report += PROGRESS_REPORT_INTERVAL
+                elapsed = time.time() - start_time
+                rate = completed_count / elapsed if elapsed > 0 else 0
+                print(f"Progress: {completed_count} files completed | Successful: {processed_count} | "
+                      f"Rate: {rate:.0f} files/sec | Committed: {writer.committed_count} | Writer queue: {writer.queue_depth()}")
+
+        # Insert any remaining results after the loop finishes
+        if batch_results:
+            print(f"[{datetime.now()}] Inserting final batch of {len(batch_results)} records...")
+            writer.submit(batch_results)
+        for queue in pending:
+            queue.flush()
+    finally:
+        # Flush and commit whatever was handed over, even when interrupted
+        writer.close()
+        if sink is not None:
+            sink.close() # rows still buffered after the last writer batch
+            print(f"[{datetime.now()}] Parquet sink: {sink.rows_written} rows written to {sink.out_dir}")
+        if writer.error is not None:
+            # Also replaces the RuntimeError of a submit() that found the writer stopped
+            print(f"Fatal: Database writer stopped ({writer.error}); {writer.committed_count} rows were committed, "
+                  f"the rest are parsed again on the next run.")
+            sys.exit(1)
+
+    end_time = time.time()
+    if completed_count == 0:
+        print(f"[{datetime.now()}] Phase 3 & 4: No new files to process.")
+        return 0
+    print(f"[{datetime.now()}] Phase 3 & 4: Processing and Insertion complete in {end_time - start_time:.2f} seconds.")
+    print(f"Successfully extracted metadata for: {processed_count}/{completed_count} files.")
+    print(f"Failed (recorded in the failure ledger): {failed_count}")
+    if tuner is not None:
+        print(tuner.describe())
+    print(f"Attempted to insert records: {writer.inserted_count} (due to INSERT OR IGNORE, actual new rows might be slightly less if duplicates somehow occurred)")
+    return processed_count
+
+
+# --- Whole run ---
+
+def _open_db(db_file, options):
+    """Main-thread connection with every table the run needs; returns (conn, schema, RollupUpdater or None)."""
+    conn = None
+    try:
+        # Main-thread connection (scan/filter reads); inserts go through the DbWriter thread's own connection
+        conn = sqlite3.connect(db_file, timeout=30.0)
+        configure_connection(conn)
+        print(f"Connected to database: {db_file}")
+        schema = resolve_schema(conn, options.schema) # existing databases keep their layout
+        if options.schema == "normalized" and schema == "flat":
+            print(f"Fatal: {db_file} uses the flat dicom_metadata table; run 'python dicom_schema.py migrate {db_file}' first.")
+            conn.close()
+            sys.exit(1)
+        if schema == "normalized":
+            create_normalized_schema(conn)
+            print("Normalized tables (patients / studies / series / instances) checked/created successfully.")
+        else:
+            create_db_table(conn)
+        create_manifest_table(conn)
+        create_failure_table(conn)
+        rollups = open_rollups(conn, COLUMNS, schema == "normalized", replace=options.rescan, enabled=options.rollups)
+        if options.dedup and not has_uid_column(conn):
+            print("Fatal: --dedup needs the sop_instance_uid column in the field list (dicom_fields.json).")
+            conn.close()
+            sys.exit(1)
+    except sqlite3.Error as e:
+        print(f"Fatal: Could not connect to or initialize database {db_file}: {e}")
+        if conn:
+            conn.close()
+        sys.exit(1)
+    return conn, schema, rollups
+
+
+def run_ingest(db_file, options, roots, iter_paths, iter_stat_entries):
+    """Set up the DB and run the pipeline over the script's path source; returns the files processed.
+
+    roots are the crawled directories (None for a file list; --shard-by top
+    needs them). iter_paths / iter_stat_entries(shard_filter, name_filter)
+    produce the paths of a normal run / the (path, stat) pairs of a rescan.
+    """
+    metrics = options.metrics
+    print(f"Database file: {db_file}")
+    print(f"Max workers: {options.max_workers} ({options.engine} engine)")
+    if options.engine != "thread":
+        print(f"Files per worker task: {options.chunk_size}")
+    if options.engine == "hybrid":
+        print(f"I/O threads per worker process: {options.io_threads}")
+    tuner = None
+    if options.autotune:
+        # -w is the starting point; the number of workers running at once then follows the measured throughput
+        tuner = AutoTuner(options.max_workers, options.autotune_max or default_autotune_max(options.engine))
+        print(f"Autotune: {tuner.min_workers}-{tuner.max_workers} workers, starting at {tuner.limit}")
+    print(f"Database batch size: {options.batch_size}")
+    print(f"Commit every: {options.commit_rows} rows or {options.commit_seconds} seconds (WAL mode)")
+    if options.rescan:
+        print("Mode: incremental rescan against the file manifest")
+    if options.sniff:
+        print("Mode: content sniffing (every file name is a candidate, DICOM recognised by its first 132 bytes)")
+    if options.dedup:
+        print("Mode: deduplication (new files whose SOP Instance UID is already known are linked, not parsed)")
+    name_filter = any_file_filter if options.sniff else dcm_suffix_filter
+    member_filter = name_filter
+    if options.archives:
+        print("Mode: archive sources (.zip / .tar members read in place, unchanged archives skipped as a whole)")
+        name_filter = archive_name_filter(name_filter) # crawler; a file list may name archives directly
+    if options.series_sample:
+        if SERIES_UID_COLUMN not in COLUMNS:
+            print(f"Fatal: --series-sample needs the {SERIES_UID_COLUMN} column in the field list (dicom_fields.json).")
+            sys.exit(1)
+        print(f"Mode: series sampling ({options.series_sample} file(s) parsed per directory, the rest confirmed by series UID)")
+    shard_filter = None
+    if options.shard:
+        try:
+            shard_filter = ShardFilter(options.shard[0], options.shard[1], options.shard_by, roots)
+        except ValueError as e:
+            print(f"Fatal: {e}")
+            sys.exit(1)
+        print(f"Shard: {shard_filter.describe()}")
+    sink = None
+    if options.parquet_dir:
+        require_pyarrow()
+        try:
+            sink = ParquetSink(options.parquet_dir, COLUMNS, options.parquet_partition_by)
+        except ValueError as e:
+            print(f"Fatal: --parquet-partition-by: {e}")
+            sys.exit(1)
+        print(f"Parquet sink: {options.parquet_dir} (partitioned by {options.parquet_partition_by or 'nothing'})")
+    overall_start_time = datetime.now()
+
+    conn, schema, rollups = _open_db(db_file, options)
+    successfully_processed_count = 0
+    dedup_counts = {}
+    pending = []
+    try:
+        # Phase 1 & 2 are generators: paths flow into Phase 3 as they are scanned and filtered
+        # (timed_stage: per-phase timers when --metrics-* is given, no-op otherwise)
+        if options.rescan:
+            # Stat-only pass compared against the manifest: only new / changed files are parsed
+            stat_entries = timed_stage(metrics, "scan", iter_stat_entries(shard_filter, name_filter))
+            if options.archives:
+                stat_entries = timed_stage(metrics, "archive_list",
+                                           iter_expanded(stat_entries, conn, member_filter, with_stat=True,
+                                                         skip_unchanged=not options.retry_failed))
+            changes = PendingResults(options.batch_size)
+            pending.append(changes)
+            files_to_process = timed_stage(metrics, "rescan_compare",
+                                           iter_changed_files(conn, stat_entries, changes, roots=roots))
+        else:
+            all_files = timed_stage(metrics, "scan", iter_paths(shard_filter, name_filter))
+            if options.archives:
+                # Archive paths become member paths before the processed-file filter
+                all_files = timed_stage(metrics, "archive_list",
+                                        iter_expanded(all_files, conn, member_filter,
+                                                      skip_unchanged=not options.retry_failed))
+            files_to_process = timed_stage(metrics, "filter",
+                                           filter_unprocessed_files(all_files, conn, options.bloom_file))
+
+        # Files that failed before are skipped unless they changed or their retry is due
+        files_to_process = timed_stage(metrics, "failure_filter",
+                                       skip_known_failures(files_to_process, conn, options.retry_failed))
+        if options.sniff:
+            # Only files that are neither in the DB nor known failures get their header sniffed
+            files_to_process = timed_stage(metrics, "sniff", iter_sniffed(files_to_process, options.scan_threads))
+        if options.dedup:
+            # Copies of known instances are linked here (UID probe + indexed lookup) instead of being parsed
+            linked = LinkedResults(options.batch_size)
+            pending.append(linked)
+            files_to_process = timed_stage(metrics, "dedup",
+                                           iter_deduplicated(files_to_process, conn, linked, options.scan_threads,
+                                                             counts=dedup_counts))
+
+        # Phase 3 & 4: Process in parallel and insert results
+        successfully_processed_count = process_files_parallel_and_insert(
+            files_to_process, db_file, options,
+            NormalizedInserter(COLUMNS, replace=options.rescan) if schema == "normalized" else None,
+            sink, tuner, rollups, pending)
+        # Catch the bloom filter sidecar up with the rows committed in this run
+        sync_bloom_file(options.bloom_file, conn)
+
+    except Exception as e:
+        print(f"An unexpected error occurred during processing: {e}")
+    finally:
+        # Ensure connection is closed
+        if conn:
+            try:
+                conn.close()
+                print(f"Database connection closed.")
+            except sqlite3.Error as e:
+                print(f"Error closing database connection: {e}")
+
+    if metrics is not None:
+        metrics.emit(final=True)
+        metrics.print_slow_files()
+
+    overall_end_time = datetime.now()
+    print("=" * 50)
+    print(f"[{datetime.now()}] Overall process finished.")
+    print(f"Total execution time: {overall_end_time - overall_start_time}")
+    print(f"Processed and attempted insert for {successfully_processed_count} new files in this run.")
+    if options.dedup:
+        # Inserted by the same writer, but never parsed
+        print(f"Linked to known instances and attempted insert for {dedup_counts.get('linked', 0)} more files.")
+    print("=" * 50)
+    return successfully_processed_count
@@ -0,0 +1,400 @@
+# dicom_manifest.py
+# File manifest (stat info + SOP Instance UID per path) for incremental rescans
+#
+# Every parsed file gets a row in file_manifest. A rescan compares a stat-only
+# walk against it: unchanged files are skipped, changed / new files are parsed,
+# files that were moved (same inode, size and mtime under a new path while
+# the old path is gone) are re-linked without being read, and files gone from
+# disk are removed. The comparison itself only reads: relinks, adoptions and
+# removals travel to the DB writer with the parsed rows (apply_changes()).
+#
+# In the normalized schema the manifest is keyed by (directory_pk, file_name)
+# like instances (see dicom_paths.py); callers still pass and get full paths.
+# Archive members (--archives) carry the stat of their archive, so one
+# manifest row per member is enough to tell that the whole archive is unchanged.
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from dicom_paths import (ARCHIVE_SEP, find_directories, group_by_directory, has_directories, is_member_path,
+                         split_member_path, stat_path)
+
+# --- 設定 ---
+# Paths looked up in the manifest per query
+MANIFEST_LOOKUP_BATCH = 500
+RESCAN_REPORT_INTERVAL = 100000
+
+MANIFEST_COLUMNS = ("file_path", "size", "mtime_ns", "inode", "device", "sop_instance_uid")
+MANIFEST_UPSERT_SQL = (f"INSERT OR REPLACE INTO file_manifest ({', '.join(MANIFEST_COLUMNS)}) "
+                       f"VALUES ({', '.join(['?'] * len(MANIFEST_COLUMNS))})")
+# Prefix-compressed layout: (directory_pk, file_name) instead of file_path
+DIRECTORY_MANIFEST_COLUMNS = ("directory_pk", "file_name") + MANIFEST_COLUMNS[1:]
+DIRECTORY_MANIFEST_UPSERT_SQL = (f"INSERT OR REPLACE INTO file_manifest ({', '.join(DIRECTORY_MANIFEST_COLUMNS)}) "
+                                 f"VALUES ({', '.join(['?'] * len(DIRECTORY_MANIFEST_COLUMNS))})")
+# Prefix-compressed layout of the table itself (normalized DBs)
+DIRECTORY_MANIFEST_SQL = '''CREATE TABLE IF NOT EXISTS file_manifest (
+    directory_pk INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    device INTEGER,
+    sop_instance_uid TEXT,
+    PRIMARY KEY (directory_pk, file_name)
+) WITHOUT ROWID'''
+# Full path of a manifest row (alias m) in the prefix-compressed layout
+DIRECTORY_PATH_SQL = "(SELECT d.path FROM directories d WHERE d.directory_pk = m.directory_pk) || m.file_name"
+
+# Rescan results handed to the DB writer next to the parsed rows (see apply_changes / remove_files)
+Relinked = namedtuple("Relinked", "old_path new_path")  # moved file: its rows follow it
+Adopted = namedtuple("Adopted", "entry")                # manifest_entry() of a row written before the manifest
+Removed = namedtuple("Removed", "file_path")            # file gone from disk: its rows are deleted
+MANIFEST_CHANGES = (Relinked, Adopted, Removed)
+
+
+def create_manifest_table(conn):
+    """Creates the file_manifest table and its lookup indexes if they don't exist.
+
+    Normalized DBs (directories table) get the (directory_pk, file_name)
+    layout; dicom_schema.py migrate converts the manifest of a flat DB.
+    """
+    c = conn.cursor()
+    if has_directories(conn):
+        c.execute(DIRECTORY_MANIFEST_SQL)
+    else:
+        c.execute('''CREATE TABLE IF NOT EXISTS file_manifest (
+    file_path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    device INTEGER,
+    sop_instance_uid TEXT
+)''')
+    # paths_generation: bumped whenever rows are re-linked or deleted (see paths_generation())
+    c.execute("CREATE TABLE IF NOT EXISTS manifest_meta (name TEXT PRIMARY KEY, value INTEGER)")
+    # Used to recognise moved files (same inode/device under a new path)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_manifest_inode ON file_manifest(inode, device);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_manifest_sop_uid ON file_manifest(sop_instance_uid);")
+    conn.commit()
+
+
+def manifest_entry(file_path, st, sop_instance_uid=None):
+    """Build a file_manifest row from an os.stat_result."""
+    return (file_path, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev, sop_instance_uid)
+
+
+def upsert_manifest(conn, entries, directories=None):
+    """Write manifest_entry() rows; `directories` (a dicom_paths.DirectoryKeys) selects the compressed layout."""
+    c = conn.cursor()
+    if directories is None:
+        c.executemany(MANIFEST_UPSERT_SQL, entries)
+    else:
+        c.executemany(DIRECTORY_MANIFEST_UPSERT_SQL,
+                      [directories.split(c, entry[0]) + tuple(entry[1:]) for entry in entries])
+
+
+def _same_file(st, size, mtime_ns, inode, device):
+    return (st.st_size == size and st.st_mtime_ns == mtime_ns
+            and st.st_ino == inode and st.st_dev == device)
+
+
+def iter_stat_paths(paths):
+    """Stat-only pass over a path list: yield (path, stat), or (path, None) for a file that is gone.
+
+    iter_changed_files() removes the rows of gone files; paths that cannot be
+    stat-ed for any other reason are skipped. Directory scans get (path, stat)
+    pairs from dicom_crawler.iter_crawl(with_stat=True) instead.
+    """
+    for path in paths:
+        try:
+            yield path, stat_path(path)
+        except (FileNotFoundError, NotADirectoryError):
+            yield path, None
+        except OSError:
+            pass
+
+
+def archive_unchanged(conn, archive_path, st):
+    """True if the manifest has a member of this archive recorded with the archive's current stat."""
+    # Member paths sort between 'archive!/' and 'archive!0' ('0' follows '/')
+    low, high = archive_path + ARCHIVE_SEP, archive_path + ARCHIVE_SEP[:-1] + "0"
+    if has_directories(conn):
+        row = conn.execute("SELECT m.size, m.mtime_ns, m.inode, m.device FROM directories d "
+                           "JOIN file_manifest m ON m.directory_pk = d.directory_pk "
+                           "WHERE d.path >= ? AND d.path < ? LIMIT 1", (low, high)).fetchone()
+    else:
+        row = conn.execute("SELECT size, mtime_ns, inode, device FROM file_manifest "
+                           "WHERE file_path >= ? AND file_path < ? LIMIT 1", (low, high)).fetchone()
+    return row is not None and _same_file(st, *row)
+
+
+def _relink(conn, old_path, new_path, directories=None):
+    """Point the metadata and manifest rows of a moved file at its new path."""
+    c = conn.cursor()
+    if directories is None:
+        c.execute("UPDATE dicom_metadata SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+        c.execute("UPDATE file_manifest SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+        return
+    old_key = directories.split(c, old_path)
+    new_key = directories.split(c, new_path)
+    for table in ("instances", "file_manifest"):
+        c.execute(f"UPDATE {table} SET directory_pk = ?, file_name = ? WHERE directory_pk = ? AND file_name = ?",
+                  new_key + old_key)
+
+
+def paths_generation(conn):
+    """Number of writer batches that re-linked or deleted rows of the path table (0 for older DBs)."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'manifest_meta'").fetchone() is None:
+        return 0
+    row = conn.execute("SELECT value FROM manifest_meta WHERE name = 'paths_generation'").fetchone()
+    return row[0] if row else 0
+
+
+def _bump_paths_generation(conn):
+    # Bloom filter sidecars (dicom_filter.py) only sync new rowids: this tells them to rebuild
+    conn.execute("INSERT OR IGNORE INTO manifest_meta (name, value) VALUES ('paths_generation', 0)")
+    conn.execute("UPDATE manifest_meta SET value = value + 1 WHERE name = 'paths_generation'")
+
+
+def split_changes(results):
+    """Separate Relinked / Adopted / Removed changes from the other results of a writer batch."""
+    others = []
+    changes = []
+    for result in results:
+        if isinstance(result, MANIFEST_CHANGES):
+            changes.append(result)
+        else:
+            others.append(result)
+    return others, changes
+
+
+def apply_changes(conn, changes, directories=None):
+    """Writer side: re-link moved files and adopt legacy rows (Removed: see remove_files())."""
+    adopted = []
+    relinked = False
+    for change in changes:
+        if isinstance(change, Relinked):
+            _relink(conn, change.old_path, change.new_path, directories)
+            relinked = True
+        elif isinstance(change, Adopted):
+            adopted.append(change.entry)
+    if adopted:
+        upsert_manifest(conn, adopted, directories)
+    if relinked:
+        _bump_paths_generation(conn)
+
+
+def remove_files(conn, paths, directories=None):
+    """Writer side: delete the metadata and manifest rows of these paths; no commit."""
+    c = conn.cursor()
+    deleted = 0
+    if directories is None:
+        for i in range(0, len(paths), MANIFEST_LOOKUP_BATCH):
+            batch = paths[i:i + MANIFEST_LOOKUP_BATCH]
+            marks = ", ".join(["?"] * len(batch))
+            deleted += c.execute(f"DELETE FROM dicom_metadata WHERE file_path IN ({marks})", batch).rowcount
+            c.execute(f"DELETE FROM file_manifest WHERE file_path IN ({marks})", batch)
+    else:
+        groups = group_by_directory(paths)
+        for directory, directory_pk in find_directories(conn, groups).items():
+            names = groups[directory]
+            for i in range(0, len(names), MANIFEST_LOOKUP_BATCH):
+                batch = names[i:i + MANIFEST_LOOKUP_BATCH]
+                marks = ", ".join(["?"] * len(batch))
+                deleted += c.execute(f"DELETE FROM instances WHERE directory_pk = ? AND file_name IN ({marks})",
+                                     [directory_pk] + batch).rowcount
+                c.execute(f"DELETE FROM file_manifest WHERE directory_pk = ? AND file_name IN ({marks})",
+                          [directory_pk] + batch)
+    if deleted:
+        _bump_paths_generation(conn)
+
+
+def _gone(path):
+    """True only if the file (for a member: its archive) certainly no longer exists.
+
+    Any other stat error (permissions, an NFS timeout) keeps its rows.
+    """
+    try:
+        os.lstat(split_member_path(path)[0])
+    except (FileNotFoundError, NotADirectoryError):
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def _find_moved_from(conn, st, compressed=False, relinked=()):
+    """Return the manifest path this file was moved from, or None (paths in relinked are already taken)."""
+    rows = conn.execute(
+        f"SELECT {DIRECTORY_PATH_SQL if compressed else 'm.file_path'} FROM file_manifest m "
+        "WHERE m.inode = ? AND m.device = ? AND m.size = ? AND m.mtime_ns = ?",
+        (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns)).fetchall()
+    for (old_path,) in rows:
+        if old_path not in relinked and not is_member_path(old_path) and not os.path.lexists(old_path):
+            return old_path
+    return None
+
+
+def _empty_root(root):
+    try:
+        with os.scandir(root) as entries:
+            return next(entries, None) is None
+    except OSError:
+        return True
+
+
+def _prefix_range(prefix):
+    """(low, high) bounds of the strings that start with prefix."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _manifest_paths_under(conn, prefix, compressed, unseen=False):
+    """Manifest paths that start with prefix; with unseen, only those missing from temp.rescan_seen."""
+    low, high = _prefix_range(prefix)
+    if compressed:
+        sql = ("SELECT d.path || m.file_name AS file_path FROM directories d "
+               "JOIN file_manifest m ON m.directory_pk = d.directory_pk WHERE d.path >= ? AND d.path < ?")
+    else:
+        sql = "SELECT file_path FROM file_manifest WHERE file_path >= ? AND file_path < ?"
+    if unseen:
+        sql = f"SELECT file_path FROM ({sql}) WHERE file_path NOT IN (SELECT file_path FROM temp.rescan_seen)"
+    return [path for path, in conn.execute(sql, (low, high))]
+
+
+def _lookup(conn, table, columns, paths, compressed):
+    """{path: (columns...)} for the paths (at most MANIFEST_LOOKUP_BATCH) that have a row in table."""
+    c = conn.cursor()
+    if not compressed:
+        return {row[0]: row[1:] for row in c.execute(
+            f"SELECT {', '.join(('file_path',) + columns)} FROM {table} "
+            f"WHERE file_path IN ({', '.join(['?'] * len(paths))})", paths)}
+    found = {}
+    groups = group_by_directory(paths)
+    for directory, directory_pk in find_directories(conn, groups).items():
+        names = groups[directory]
+        for row in c.execute(f"SELECT {', '.join(('file_name',) + columns)} FROM {table} "
+                             f"WHERE directory_pk = ? AND file_name IN ({', '.join(['?'] * len(names))})",
+                             [directory_pk] + names):
+            found[directory + row[0]] = row[1:]
+    return found
+
+
+def iter_changed_files(conn, stat_entries, changes, counts=None, verbose=True, roots=None):
+    """Rescan filter: compare (path, stat) pairs with file_manifest and yield the paths that need parsing.
+
+    Unchanged files are skipped. Moved files are re-linked, and paths
+    already in dicom_metadata but missing from the manifest (DBs written
+    before the manifest existed) are adopted, both without parsing. Entries
+    whose stat is None (listed files that are gone) are removed, with the
+    members of an archive of that name. With roots (the crawled directories),
+    manifest rows under them that the walk did not see and whose file is gone
+    are removed as well. Nothing is written here: the changes go to the DB
+    writer through changes (a dicom_writer.PendingResults), flushed by the
+    caller once this generator is exhausted. A counts dict, if given,
+    receives the per-category totals (the watch daemon logs them itself with
+    verbose=False).
+    """
+    if verbose:
+        print(f"[{datetime.now()}] Phase 2: Comparing stat-only walk against file manifest...")
+    if counts is None:
+        counts = {}
+    for key in ("checked", "unchanged", "changed", "new", "moved", "adopted", "removed"):
+        counts.setdefault(key, 0)
+    start_time = time.time()
+    next_report = RESCAN_REPORT_INTERVAL
+    compressed = has_directories(conn)
+    table = "instances" if compressed else "dicom_metadata"
+    relinked = set() # old paths taken by a relink of this run: neither a second move source nor removed
+    batch = []
+    if roots:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS rescan_seen (file_path TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM temp.rescan_seen")
+        conn.commit()
+
+    def remove(paths):
+        paths = [path for path in paths if path not in relinked]
+        counts["removed"] += len(paths)
+        changes.add([Removed(path) for path in paths])
+
+    def classify(batch):
+        """Paths of the batch that need parsing; the other outcomes are queued for the writer."""
+        present = [(path, st) for path, st in batch if st is not None]
+        paths = [path for path, _ in present]
+        if roots:
+            conn.executemany("INSERT OR IGNORE INTO temp.rescan_seen (file_path) VALUES (?)",
+                             ((path,) for path in paths))
+            conn.commit() # temp table only; no read snapshot stays open while the paths are parsed
+        gone = [path for path, st in batch if st is None]
+        if gone:
+            known_gone = set(_lookup(conn, "file_manifest", (), gone, compressed))
+            known_gone.update(_lookup(conn, table, (), gone, compressed))
+            for path in gone:
+                known_gone.update(_manifest_paths_under(conn, path + ARCHIVE_SEP, compressed))
+            remove(sorted(known_gone))
+        if not present:
+            return []
+        known = _lookup(conn, "file_manifest", ("size", "mtime_ns", "inode", "device"), paths, compressed)
+        unknown = [path for path in paths if path not in known]
+        legacy = set()
+        if unknown:
+            legacy = set(_lookup(conn, table, (), unknown, compressed))
+        to_parse = []
+        found = []
+        for path, st in present:
+            if path in known:
+                if _same_file(st, *known[path]):
+                    counts["unchanged"] += 1
+                else:
+                    counts["changed"] += 1
+                    to_parse.append(path)
+            elif path in legacy:
+                counts["adopted"] += 1
+                found.append(Adopted(manifest_entry(path, st)))
+            elif is_member_path(path):
+                # Members share the archive's inode: never re-linked, a moved archive is read again
+                counts["new"] += 1
+                to_parse.append(path)
+            else:
+                old_path = _find_moved_from(conn, st, compressed, relinked)
+                if old_path is not None:
+                    counts["moved"] += 1
+                    relinked.add(old_path)
+                    found.append(Relinked(old_path, path))
+                else:
+                    counts["new"] += 1
+                    to_parse.append(path)
+        changes.add(found)
+        return to_parse
+
+    for entry in stat_entries:
+        batch.append(entry)
+        counts["checked"] += 1
+        if len(batch) >= MANIFEST_LOOKUP_BATCH:
+            yield from classify(batch)
+            batch = []
+        if verbose and counts["checked"] >= next_report:
+            next_report += RESCAN_REPORT_INTERVAL
+            elapsed = time.time() - start_time
+            rate = counts["checked"] / elapsed if elapsed > 0 else 0
+            print(f"Checked: {counts['checked']} | Unchanged: {counts['unchanged']} | Rate: {rate:.0f} files/sec")
+    if batch:
+        yield from classify(batch)
+
+    for root in roots or ():
+        if _empty_root(root):
+            # More likely an unmounted share than a deleted tree
+            print(f"Warning: {root} is empty or unreadable; its manifest rows are kept.")
+            continue
+        remove([path for path in _manifest_paths_under(conn, os.path.join(root, ""), compressed, unseen=True)
+                if _gone(path)])
+    if roots:
+        conn.execute("DELETE FROM temp.rescan_seen")
+        conn.commit()
+
+    if not verbose:
+        return
+    print(f"[{datetime.now()}] Phase 2: Rescan comparison complete in {time.time() - start_time:.2f} seconds.")
+    print(f"Checked: {counts['checked']} | Unchanged: {counts['unchanged']} | Changed: {counts['changed']} | "
+          f"New: {counts['new']} | Moved (re-linked): {counts['moved']} | Adopted from DB: {counts['adopted']} | "
+          f"Removed (gone from disk): {counts['removed']}")
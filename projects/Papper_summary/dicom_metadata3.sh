@@ -11,6 +11,11 @@ LOG_FILE="dicom_metadata_run.log"
 TEMP_FILE_LIST="dicom_paths_temp.txt" # <--- find 命令輸出的臨時檔名
 # WORKER_COUNT=8 # 可選
 # BATCH_SIZE=8000 # 可選
+# USE_BUILTIN_CRAWLER=1 # 可選: 跳過 find, 由 Python 平行爬目錄 (掃描與解析同時進行, 不產生臨時檔)
+# SNIFF=1 # 可選: 也收錄沒有 .dcm 副檔名的 DICOM (find 不限檔名, Python 只讀前 132 bytes 判斷)
+# ARCHIVES=1 # 可選: 也直接讀取 .zip / .tar(.gz) 壓縮檔內的 DICOM (不解壓到磁碟, 未變動的壓縮檔整個略過)
+# AUTOTUNE=1 # 可選: 執行中依 files/sec 自動調整同時執行的 worker 數 (WORKER_COUNT 為起始值, 結果寫入 log 以便之後用 -w 固定)
+# DEDUP=1 # 可選: 先只讀到 SOP Instance UID, 資料庫已有相同 UID 的檔案直接連結到既有 instance 而不完整解析
 
 # --- 功能函數 ---
 log_message() {
@@ -32,11 +37,19 @@ if [ ! -f "$PYTHON_SCRIPT_PATH" ]; then
   exit 1
 fi
 
-# --- 步驟 1: 使用 find 命令產生檔案列表 ---
+# --- 步驟 1: 使用 find 命令產生檔案列表 (USE_BUILTIN_CRAWLER 時略過) ---
+if [ -z "$USE_BUILTIN_CRAWLER" ]; then
 log_message "Phase 1: Generating file list using 'find' for directories: $TARGET_DICOM_DIRS"
-# 使用 -iname 進行不區分大小寫的 .dcm 匹配
+# 使用 -iname 進行不區分大小寫的 .dcm 匹配 (SNIFF 時列出所有檔案, 由 --sniff 依內容篩選)
 # 將 TARGET_DICOM_DIRS 作為參數傳遞給 find
-find $TARGET_DICOM_DIRS -iname '*.dcm' -type f > "$TEMP_FILE_LIST"
+if [ -z "$SNIFF" ] && [ -z "$ARCHIVES" ]; then
+  find $TARGET_DICOM_DIRS -iname '*.dcm' -type f > "$TEMP_FILE_LIST"
+elif [ -z "$SNIFF" ]; then
+  find $TARGET_DICOM_DIRS -type f \( -iname '*.dcm' -o -iname '*.zip' -o -iname '*.tar' -o -iname '*.tar.gz' \
+    -o -iname '*.tgz' -o -iname '*.tar.bz2' -o -iname '*.tbz2' -o -iname '*.tar.xz' -o -iname '*.txz' \) > "$TEMP_FILE_LIST"
+else
+  find $TARGET_DICOM_DIRS -type f > "$TEMP_FILE_LIST"
+fi
 FIND_EXIT_CODE=$?
 if [ ${FIND_EXIT_CODE} -ne 0 ]; then
     log_message "Error: 'find' command failed with exit code ${FIND_EXIT_CODE}."
@@ -50,17 +63,23 @@ if [ ! -s "$TEMP_FILE_LIST" ]; then
     # exit 0
 fi
 log_message "Phase 1: File list generated: $TEMP_FILE_LIST"
+fi
 # --- find 命令結束 ---
 
 
 # --- 步驟 2: 使用 conda run 執行 Python 腳本 ---
 log_message "Executing Python script with environment: $CONDA_ENV_NAME"
-log_message "Input file list: $TEMP_FILE_LIST"
 log_message "Output database: $DB_FILE_PATH"
 
 # 準備 Python 命令參數
-# !! 新增 --input-list 參數 !!
-PYTHON_ARGS="\"$PYTHON_SCRIPT_PATH\" --input-list \"$TEMP_FILE_LIST\" -o \"$DB_FILE_PATH\"" # <--- 修改點
+if [ -z "$USE_BUILTIN_CRAWLER" ]; then
+  log_message "Input file list: $TEMP_FILE_LIST"
+  # !! 新增 --input-list 參數 !!
+  PYTHON_ARGS="\"$PYTHON_SCRIPT_PATH\" --input-list \"$TEMP_FILE_LIST\" -o \"$DB_FILE_PATH\"" # <--- 修改點
+else
+  log_message "Using built-in crawler for: $TARGET_DICOM_DIRS"
+  PYTHON_ARGS="\"$PYTHON_SCRIPT_PATH\" --dicom-dirs $TARGET_DICOM_DIRS -o \"$DB_FILE_PATH\""
+fi
 # 添加可選參數
 if [ ! -z "$WORKER_COUNT" ]; then
   PYTHON_ARGS="$PYTHON_ARGS -w $WORKER_COUNT"
@@ -68,6 +87,18 @@ fi
 if [ ! -z "$BATCH_SIZE" ]; then
   PYTHON_ARGS="$PYTHON_ARGS -b $BATCH_SIZE"
 fi
+if [ ! -z "$SNIFF" ]; then
+  PYTHON_ARGS="$PYTHON_ARGS --sniff"
+fi
+if [ ! -z "$ARCHIVES" ]; then
+  PYTHON_ARGS="$PYTHON_ARGS --archives"
+fi
+if [ ! -z "$AUTOTUNE" ]; then
+  PYTHON_ARGS="$PYTHON_ARGS --autotune"
+fi
+if [ ! -z "$DEDUP" ]; then
+  PYTHON_ARGS="$PYTHON_ARGS --dedup"
+fi
 
 # 使用 conda run 執行命令
 CONDA_RUN_CMD="conda run -n \"$CONDA_ENV_NAME\" python $PYTHON_ARGS"
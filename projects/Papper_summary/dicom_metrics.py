@@ -0,0 +1,271 @@
+# dicom_metrics.py
+# Structured metrics for long ingestion runs (--metrics-jsonl / --metrics-prom)
+#
+# Answers "is it the storage, the parser or SQLite?" during a 12-hour run:
+#   - phase timers: time the pipeline spends producing paths (scan, filter, ...)
+#     versus extracting, measured exclusively for nested generator stages
+#   - per-file histograms split into open / read / parse / convert
+#   - gauges for queue depths (extraction window, writer queue)
+#   - writer histograms for batch inserts and commits
+#   - top-N slowest files with their stage breakdown
+# Snapshots are appended to a JSON-lines file and written to a Prometheus
+# textfile-collector file (atomic rename, so the collector never reads half a file).
+import bisect
+import heapq
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+import pydicom
+
+from dicom_fastread import READ_BUFFER_SIZE, FastReadUnsupported, read_tags
+
+# --- 設定 ---
+DEFAULT_METRICS_INTERVAL = 30.0
+DEFAULT_SLOW_FILES = 20
+METRIC_PREFIX = "dicom_ingest"
+# Histogram bucket upper bounds in seconds (Prometheus "le")
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FILE_STAGES = ("open", "read", "parse", "convert", "total")
+
+# Worker -> collection loop: result of extract_metadata_row plus its per-stage timings
+TimedResult = namedtuple("TimedResult", "file_path timings result")
+
+
+def strip_timings(rows):
+    """TimedResults -> plain extraction results, when only the autotuner (not --metrics) wanted the timings."""
+    return [timed.result for timed in rows if timed.result is not None]
+
+
+class _TimedReader:
+    """File proxy that adds the time spent in read() to read_seconds."""
+
+    def __init__(self, f):
+        self._f = f
+        self.read_seconds = 0.0
+
+    def read(self, *args):
+        start = time.perf_counter()
+        data = self._f.read(*args)
+        self.read_seconds += time.perf_counter() - start
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def read_header_timed(source, wanted_tags, timings):
+    """Fast-path read (dcmread fallback) that records open / read / parse seconds in timings.
+
+    source is a path, or a seekable binary stream (--archives: an archive member; "open" is then 0).
+    """
+    start = time.perf_counter()
+    f = open(source, "rb", buffering=READ_BUFFER_SIZE) if isinstance(source, (str, bytes)) else None
+    timings["open"] = time.perf_counter() - start
+    reader = _TimedReader(f if f is not None else source)
+    try:
+        start = time.perf_counter()
+        try:
+            ds = read_tags(reader, wanted_tags)
+        except FastReadUnsupported:
+            reader.seek(0)
+            ds = pydicom.dcmread(reader, stop_before_pixels=True, force=True)
+        elapsed = time.perf_counter() - start
+    finally:
+        if f is not None:
+            f.close()
+    timings["read"] = reader.read_seconds
+    timings["parse"] = elapsed - reader.read_seconds
+    return ds
+
+
+def timed_stage(metrics, phase, iterable):
+    """metrics.timed_iter() when metrics are enabled, else the iterable unchanged."""
+    return metrics.timed_iter(phase, iterable) if metrics is not None else iterable
+
+
+class _Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last slot: +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Approximate quantile (bucket upper bound); None when empty or beyond the last bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else None
+        return None
+
+
+class Metrics:
+    """Thread-safe metric registry; the collection loop calls maybe_emit() regularly."""
+
+    def __init__(self, jsonl_file=None, prom_file=None, interval=DEFAULT_METRICS_INTERVAL,
+                 slow_files=DEFAULT_SLOW_FILES):
+        self.jsonl_file = jsonl_file
+        self.prom_file = prom_file
+        self.interval = interval
+        self.slow_files = slow_files
+        self.start_time = time.time()
+        self._last_emit = self.start_time
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.phase_seconds = {}
+        self.histograms = {} # (name, label) -> _Histogram
+        self._slowest = []   # min-heap of (seconds, file_path, timings)
+        self._child_time = [] # phase timer stack (main thread only)
+
+    # --- recording ---
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, label, seconds):
+        with self._lock:
+            hist = self.histograms.get((name, label))
+            if hist is None:
+                hist = self.histograms[(name, label)] = _Histogram()
+            hist.observe(seconds)
+
+    def observe_file(self, file_path, timings):
+        for stage in FILE_STAGES:
+            if stage in timings:
+                self.observe("file_stage_seconds", stage, timings[stage])
+        total = timings.get("total", 0.0)
+        with self._lock:
+            entry = (total, file_path, timings)
+            if len(self._slowest) < self.slow_files:
+                heapq.heappush(self._slowest, entry)
+            elif total > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def unwrap(self, rows):
+        """Collection loop: record TimedResults, return the plain extraction results."""
+        results = []
+        for timed in rows:
+            self.observe_file(timed.file_path, timed.timings)
+            if timed.result is not None:
+                results.append(timed.result)
+        return results
+
+    def timed_iter(self, phase, iterable):
+        """Wrap a pipeline stage; its exclusive production time is added to phase_seconds[phase]."""
+        it = iter(iterable)
+        while True:
+            self._child_time.append(0.0)
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                elapsed = time.perf_counter() - start
+                child = self._child_time.pop()
+                with self._lock:
+                    self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + elapsed - child
+                if self._child_time:
+                    self._child_time[-1] += elapsed
+            yield item
+
+    def add_phase_time(self, phase, seconds):
+        with self._lock:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    # --- output ---
+
+    def snapshot(self, final=False):
+        with self._lock:
+            snap = {
+                "ts": time.time(),
+                "elapsed": round(time.time() - self.start_time, 3),
+                "final": final,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "phase_seconds": {k: round(v, 3) for k, v in self.phase_seconds.items()},
+                "histograms": {
+                    f"{name}{{{label}}}": {
+                        "count": h.count, "sum": round(h.sum, 6),
+                        "p50": h.quantile(0.50), "p99": h.quantile(0.99),
+                    } for (name, label), h in self.histograms.items()
+                },
+                "slow_files": [
+                    {"file_path": path, "seconds": round(total, 6),
+                     "stages": {k: round(v, 6) for k, v in timings.items()}}
+                    for total, path, timings in sorted(self._slowest, reverse=True)
+                ],
+            }
+        return snap
+
+    def _prometheus_text(self):
+        p = METRIC_PREFIX
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {p}_{name}_total counter")
+                lines.append(f"{p}_{name}_total {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {p}_{name} gauge")
+                lines.append(f"{p}_{name} {value}")
+            lines.append(f"# TYPE {p}_phase_seconds_total counter")
+            for phase, seconds in sorted(self.phase_seconds.items()):
+                lines.append(f'{p}_phase_seconds_total{{phase="{phase}"}} {seconds:.6f}')
+            typed = set()
+            for (name, label), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {p}_{name} histogram")
+                    typed.add(name)
+                label_key = "stage" if name == "file_stage_seconds" else "op"
+                cumulative = 0
+                for bound, n in zip(h.buckets + (float("inf"),), h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{p}_{name}_bucket{{{label_key}="{label}",le="{le}"}} {cumulative}')
+                lines.append(f'{p}_{name}_sum{{{label_key}="{label}"}} {h.sum:.6f}')
+                lines.append(f'{p}_{name}_count{{{label_key}="{label}"}} {h.count}')
+            lines.append(f"# TYPE {p}_last_update_timestamp_seconds gauge")
+            lines.append(f"{p}_last_update_timestamp_seconds {time.time():.3f}")
+        return "\n".join(lines) + "\n"
+
+    def emit(self, final=False):
+        if self.jsonl_file:
+            with open(self.jsonl_file, "a") as f:
+                f.write(json.dumps(self.snapshot(final)) + "\n")
+        if self.prom_file:
+            tmp_file = f"{self.prom_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(self._prometheus_text())
+            os.replace(tmp_file, self.prom_file)
+        self._last_emit = time.time()
+
+    def maybe_emit(self):
+        if time.time() - self._last_emit >= self.interval:
+            self.emit()
+
+    def print_slow_files(self):
+        if not self._slowest:
+            return
+        print(f"Slowest {len(self._slowest)} files:")
+        for total, path, timings in sorted(self._slowest, reverse=True):
+            stages = " ".join(f"{k}={v * 1000:.1f}ms" for k, v in timings.items() if k != "total")
+            print(f"  {total * 1000:8.1f} ms  {path}  ({stages})")
@@ -0,0 +1,125 @@
+# dicom_paths.py
+# Prefix-compressed file paths: a directories table plus (directory_pk, file_name) keys
+#
+# A series folder holds hundreds of files, so storing the full path per row
+# repeats the same directory prefix hundreds of times (in the table, in its
+# UNIQUE index and again in the file manifest). The normalized schema stores
+# every directory once, with its trailing separator, and the per-file tables
+# keep only the directory key and the file name:
+#   /archive/p1/st1/se1/IM0001.dcm -> directories.path '/archive/p1/st1/se1/' + file_name 'IM0001.dcm'
+# directories.path || file_name is the original path, so views (and the
+# bloom filter, which hashes full paths) see exactly the same strings.
+#
+# Files read from inside a ZIP / TAR archive (--archives, dicom_archive.py)
+# are recorded under a virtual path 'archive.zip!/member.dcm'; their stat
+# is the archive's own (stat_path). In the compressed layout the directory
+# part is then '/a/archive.zip!/...', so all members of one archive share a
+# directory prefix.
+import os
+
+# --- 設定 ---
+# Directory keys cached per connection; the cache is dropped when it grows past this
+DIRECTORY_CACHE_LIMIT = 1000000
+# Bound parameters per IN (...) lookup (stays below SQLite's default variable limit)
+LOOKUP_BATCH = 500
+# Separator between an archive path and a member name
+ARCHIVE_SEP = "!/"
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+def split_path(file_path):
+    """'/a/b/c.dcm' -> ('/a/b/', 'c.dcm'); the directory keeps its trailing separator."""
+    cut = file_path.rfind(os.sep) + 1
+    return file_path[:cut], file_path[cut:]
+
+
+def is_archive_name(name):
+    """True for the file names --archives opens (ARCHIVE_SUFFIXES, case-insensitive)."""
+    return name.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def member_path(archive_path, member):
+    """Virtual path of an archive member: '/a/b.zip' + 'x/1.dcm' -> '/a/b.zip!/x/1.dcm'."""
+    return archive_path + ARCHIVE_SEP + member
+
+
+def split_member_path(file_path):
+    """'/a/b.zip!/x/1.dcm' -> ('/a/b.zip', 'x/1.dcm'); (file_path, None) for a regular file."""
+    cut = file_path.find(ARCHIVE_SEP)
+    while cut != -1:
+        if is_archive_name(file_path[:cut]):
+            return file_path[:cut], file_path[cut + len(ARCHIVE_SEP):]
+        cut = file_path.find(ARCHIVE_SEP, cut + 1)
+    return file_path, None
+
+
+def is_member_path(file_path):
+    """True for an 'archive!/member' virtual path."""
+    return split_member_path(file_path)[1] is not None
+
+
+def stat_path(file_path):
+    """os.stat() of a file, or of the archive that holds it for a member path."""
+    return os.stat(split_member_path(file_path)[0])
+
+
+def register_path_functions(conn):
+    """path_directory(p) / path_file_name(p) SQL functions, for converting file_path columns in bulk."""
+    conn.create_function("path_directory", 1, lambda p: split_path(p)[0], deterministic=True)
+    conn.create_function("path_file_name", 1, lambda p: split_path(p)[1], deterministic=True)
+
+
+def group_by_directory(paths):
+    """Paths -> {directory: [file names]}, each directory string stored once."""
+    groups = {}
+    for path in paths:
+        directory, name = split_path(path)
+        names = groups.get(directory)
+        if names is None:
+            groups[directory] = [name]
+        else:
+            names.append(name)
+    return groups
+
+
+def has_directories(conn, schema="main"):
+    """True if the DB stores prefix-compressed paths (normalized schema)."""
+    return conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = 'directories'"
+                        ).fetchone() is not None
+
+
+def find_directories(conn, directories):
+    """{directory path: directory_pk} for the directories already in the DB (no inserts)."""
+    directories = list(directories)
+    found = {}
+    for i in range(0, len(directories), LOOKUP_BATCH):
+        batch = directories[i:i + LOOKUP_BATCH]
+        found.update(conn.execute(
+            f"SELECT path, directory_pk FROM directories WHERE path IN ({', '.join(['?'] * len(batch))})", batch))
+    return found
+
+
+class DirectoryKeys:
+    """directory path -> directory_pk, inserting unknown directories; one instance per connection."""
+
+    def __init__(self):
+        self._cache = {}
+
+    def get(self, c, directory):
+        pk = self._cache.get(directory)
+        if pk is None:
+            c.execute("INSERT OR IGNORE INTO directories (path) VALUES (?)", (directory,))
+            pk = c.execute("SELECT directory_pk FROM directories WHERE path = ?", (directory,)).fetchone()[0]
+            if len(self._cache) >= DIRECTORY_CACHE_LIMIT:
+                self._cache.clear()
+            self._cache[directory] = pk
+        return pk
+
+    def split(self, c, file_path):
+        """Full path -> (directory_pk, file_name)."""
+        directory, name = split_path(file_path)
+        return self.get(c, directory), name
+
+    def clear(self):
+        """Forget cached keys (after a rollback, cached rows may no longer exist)."""
+        self._cache.clear()
@@ -0,0 +1,502 @@
+# dicom_rollup.py
+# Series / study summary tables maintained at insert time, plus a small cohort query CLI
+#
+# "Series per study with instance counts, date ranges and slice thickness" is
+# a GROUP BY over every instance row. The rollup tables keep that answer
+# precomputed: series_summary has one row per series (instance count,
+# acquisition date range, slice thickness range, study-level columns) and
+# study_summary one row per study, aggregated from its series.
+#
+# The summaries are opt-in (--rollups on the ingest scripts and the watch
+# daemon). With it, the DB writer refreshes them in the transaction of every
+# batch it inserts: the series touched by the batch (and, in replace mode, the
+# series the overwritten rows belonged to) are recomputed from their instance
+# rows through an index, then their studies from series_summary. The work per
+# batch depends on the series it touches, not on the size of the DB, and the
+# tables are exact after every commit. Rows copied by --dedup are refreshed
+# the same way. A DB that already has rows when the tables are first created
+# gets them built in full once; 'rebuild' does the same on demand (after
+# merging shards, or after editing rows by hand).
+# A run without --rollups leaves existing summaries as they are but marks them
+# stale (a row in rollup_meta); the query commands then warn, and 'rebuild' or
+# the next run with --rollups rebuilds them in full and clears the mark. Bulk
+# loads can so skip the per-batch work and rebuild once at the end.
+#
+# Dates are YYYYMMDD integers and slice thickness is REAL in both schemas
+# (flat TEXT values go through the dicom_schema converters; 'N/A' -> NULL).
+# Rows without a series UID are not counted.
+#
+# Usage:
+#   python dicom_rollup.py rebuild dicom_metadata.db
+#   python dicom_rollup.py studies dicom_metadata.db [--patient ID] [--modality CT] [--from 20240101] [--to 20241231]
+#   python dicom_rollup.py series dicom_metadata.db [--study UID] [--modality CT] [--max-thickness 1.5] [--min-instances 50]
+#   python dicom_rollup.py totals dicom_metadata.db
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from dicom_fields import SERIES_UID_COLUMN
+from dicom_paths import LOOKUP_BATCH, find_directories, group_by_directory, has_directories
+from dicom_schema import to_date_int, to_real, to_text
+
+# --- 設定 ---
+DEFAULT_QUERY_LIMIT = 100
+
+ROLLUP_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS series_summary (
+    series_instance_uid TEXT PRIMARY KEY,
+    study_instance_uid TEXT,
+    patient_id TEXT,
+    modality TEXT,
+    series_description TEXT,
+    series_date INTEGER,
+    study_date INTEGER,
+    study_description TEXT,
+    instance_count INTEGER NOT NULL,
+    first_acquisition_date INTEGER,
+    last_acquisition_date INTEGER,
+    min_slice_thickness REAL,
+    max_slice_thickness REAL
+);
+CREATE TABLE IF NOT EXISTS study_summary (
+    study_instance_uid TEXT PRIMARY KEY,
+    patient_id TEXT,
+    study_date INTEGER,
+    study_description TEXT,
+    modalities TEXT,
+    series_count INTEGER NOT NULL,
+    instance_count INTEGER NOT NULL,
+    first_acquisition_date INTEGER,
+    last_acquisition_date INTEGER,
+    min_slice_thickness REAL,
+    max_slice_thickness REAL
+);
+CREATE INDEX IF NOT EXISTS idx_series_summary_study ON series_summary(study_instance_uid);
+CREATE INDEX IF NOT EXISTS idx_series_summary_modality ON series_summary(modality);
+CREATE INDEX IF NOT EXISTS idx_study_summary_patient ON study_summary(patient_id);
+CREATE INDEX IF NOT EXISTS idx_study_summary_date ON study_summary(study_date);
+CREATE TABLE IF NOT EXISTS rollup_meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+SERIES_SUMMARY_COLUMNS = ("series_instance_uid", "study_instance_uid", "patient_id", "modality", "series_description",
+                          "series_date", "study_date", "study_description", "instance_count",
+                          "first_acquisition_date", "last_acquisition_date", "min_slice_thickness", "max_slice_thickness")
+
+# Normalized schema: already typed, NULL for missing values
+NORMALIZED_SERIES_SELECT = """
+SELECT se.series_instance_uid, st.study_instance_uid, p.patient_id, se.modality, se.series_description,
+       se.series_date, st.study_date, st.study_description, COUNT(*),
+       MIN(i.acquisition_date), MAX(i.acquisition_date), MIN(i.slice_thickness), MAX(i.slice_thickness)
+FROM series se
+JOIN instances i ON i.series_pk = se.series_pk
+LEFT JOIN studies st ON st.study_pk = se.study_pk
+LEFT JOIN patients p ON p.patient_pk = st.patient_pk
+{where}
+GROUP BY se.series_pk
+"""
+
+STUDY_SUMMARY_SELECT = """
+SELECT study_instance_uid, MAX(patient_id), MAX(study_date), MAX(study_description),
+       GROUP_CONCAT(DISTINCT modality), COUNT(*), SUM(instance_count),
+       MIN(first_acquisition_date), MAX(last_acquisition_date), MIN(min_slice_thickness), MAX(max_slice_thickness)
+FROM series_summary
+WHERE study_instance_uid IS NOT NULL {where}
+GROUP BY study_instance_uid
+"""
+
+
+def rollups_exist(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'series_summary'"
+                        ).fetchone() is not None
+
+
+def stale_since(conn):
+    """When a run without --rollups first left the summaries behind, or None if they are current."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_meta'").fetchone() is None:
+        return None
+    row = conn.execute("SELECT value FROM rollup_meta WHERE name = 'stale_since'").fetchone()
+    return row[0] if row else None
+
+
+def mark_stale(conn):
+    """Record that rows may change without the summaries following (kept at the first such run)."""
+    conn.executescript(ROLLUP_SCHEMA_SQL) # rollup_meta for tables created before it existed
+    conn.execute("INSERT OR IGNORE INTO rollup_meta (name, value) VALUES ('stale_since', ?)",
+                 (datetime.now().isoformat(sep=" ", timespec="seconds"),))
+    conn.commit()
+
+
+def _flat_columns(conn):
+    return {row[1] for row in conn.execute("PRAGMA table_info(dicom_metadata)")}
+
+
+def register_rollup_functions(conn):
+    """rollup_date / rollup_real SQL functions: the dicom_schema converters, for flat TEXT columns."""
+    conn.create_function("rollup_date", 1, to_date_int, deterministic=True)
+    conn.create_function("rollup_real", 1, to_real, deterministic=True)
+
+
+def _flat_text(column):
+    """SQL for dicom_schema.to_text() (stripped, '' / 'N/A' -> NULL) without a Python call per row."""
+    return f"NULLIF(NULLIF(TRIM({column}), ''), 'N/A')"
+
+
+def _flat_series_select(conn, where):
+    """Series aggregate over the flat table; columns missing from the field list come back NULL.
+
+    The inner GROUP BY collapses each series to its distinct raw date /
+    thickness values first, so the Python converters run once per distinct
+    value instead of once per instance row.
+    """
+    available = _flat_columns(conn)
+    converted = [name for name in ("series_date", "study_date", "acquisition_date", "slice_thickness")
+                 if name in available]
+    text = [name for name in ("study_instance_uid", "patient_id", "modality", "series_description",
+                              "study_description") if name in available]
+    inner = ", ".join([f"{SERIES_UID_COLUMN} AS uid"] + converted
+                      + [f"MAX({_flat_text(name)}) AS {name}" for name in text] + ["COUNT(*) AS n"])
+    group = ", ".join([SERIES_UID_COLUMN] + converted)
+
+    def col(func, name):
+        if name not in available:
+            return "NULL"
+        return name if func is None else f"{func}({name})"
+
+    return (f"SELECT {_flat_text('uid')}, MAX({col(None, 'study_instance_uid')}), "
+            f"MAX({col(None, 'patient_id')}), MAX({col(None, 'modality')}), "
+            f"MAX({col(None, 'series_description')}), MAX({col('rollup_date', 'series_date')}), "
+            f"MAX({col('rollup_date', 'study_date')}), MAX({col(None, 'study_description')}), SUM(n), "
+            f"MIN({col('rollup_date', 'acquisition_date')}), MAX({col('rollup_date', 'acquisition_date')}), "
+            f"MIN({col('rollup_real', 'slice_thickness')}), MAX({col('rollup_real', 'slice_thickness')}) "
+            f"FROM (SELECT {inner} FROM dicom_metadata {where} GROUP BY {group}) GROUP BY uid")
+
+
+def create_rollup_tables(conn):
+    """Create the summary tables (built in full if the DB already has rows); False if the DB cannot have them.
+
+    The flat table needs the series UID column (dicom_fields.json); it gets an
+    index on it, which the per-batch refresh looks series up by.
+    """
+    normalized = has_directories(conn)
+    if not normalized and SERIES_UID_COLUMN not in _flat_columns(conn):
+        print(f"Warning: no {SERIES_UID_COLUMN} column in dicom_metadata; series / study summaries are not kept.")
+        return False
+    if not normalized:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_series_uid ON dicom_metadata({SERIES_UID_COLUMN})")
+    created = not rollups_exist(conn)
+    conn.executescript(ROLLUP_SCHEMA_SQL)
+    conn.commit()
+    table = "instances" if normalized else "dicom_metadata"
+    if created and conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None:
+        print(f"[{datetime.now()}] New series / study summary tables: building them from the existing rows (once)...")
+        rebuild_rollups(conn)
+    elif stale_since(conn) is not None:
+        print(f"[{datetime.now()}] Series / study summaries stale since {stale_since(conn)} "
+              "(rows ingested without --rollups): rebuilding them in full...")
+        rebuild_rollups(conn)
+    return True
+
+
+def rebuild_rollups(conn):
+    """Regenerate both summary tables from the instance rows in one transaction (clears the stale mark)."""
+    start_time = time.time()
+    normalized = has_directories(conn)
+    if not normalized:
+        register_rollup_functions(conn)
+    columns = ", ".join(SERIES_SUMMARY_COLUMNS)
+    conn.executescript(ROLLUP_SCHEMA_SQL) # also rollup_meta, for tables created before it existed
+    c = conn.cursor()
+    c.execute("BEGIN")
+    try:
+        c.execute("DELETE FROM series_summary")
+        c.execute("DELETE FROM study_summary")
+        if normalized:
+            select = NORMALIZED_SERIES_SELECT.format(where="WHERE se.series_instance_uid IS NOT NULL")
+        else:
+            select = _flat_series_select(conn, f"WHERE {_flat_text(SERIES_UID_COLUMN)} IS NOT NULL")
+        c.execute(f"INSERT OR REPLACE INTO series_summary ({columns}) {select}")
+        c.execute(f"INSERT INTO study_summary {STUDY_SUMMARY_SELECT.format(where='')}")
+        c.execute("DELETE FROM rollup_meta WHERE name = 'stale_since'")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    series, studies = (conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("series_summary", "study_summary"))
+    print(f"[{datetime.now()}] Summaries rebuilt in {time.time() - start_time:.2f} seconds: "
+          f"{series} series, {studies} studies.")
+
+
+def open_rollups(conn, columns, normalized, replace=False, enabled=False):
+    """RollupUpdater for an ingest run with --rollups, else None (existing summaries are marked stale)."""
+    if not enabled:
+        if rollups_exist(conn) and stale_since(conn) is None:
+            print("Series / study summaries marked stale (this run does not maintain them without --rollups); "
+                  "'python dicom_rollup.py rebuild' or the next run with --rollups rebuilds them.")
+            mark_stale(conn)
+        return None
+    if not create_rollup_tables(conn):
+        return None
+    return RollupUpdater(columns, normalized, replace)
+
+
+class RollupUpdater:
+    """Per-batch refresh of the summary tables; used by insert_batch on the writer connection.
+
+    touched() is called before the batch is inserted (in replace mode it also
+    picks up the series the overwritten rows belonged to), refresh() after.
+    """
+
+    def __init__(self, columns, normalized, replace=False):
+        self.series_index = columns.index(SERIES_UID_COLUMN) if SERIES_UID_COLUMN in columns else None
+        self.path_index = columns.index("file_path")
+        self.normalized = normalized
+        self.replace = replace
+
+    def touched(self, conn, rows, removed=()):
+        """Series UIDs (as stored in the instance table) a batch of flat rows and removed paths affects."""
+        uids = set()
+        if self.series_index is not None:
+            for row in rows:
+                uid = row[self.series_index]
+                if to_text(uid) is not None:
+                    # Normalized rows store the cleaned UID, flat rows the value as extracted
+                    uids.add(to_text(uid) if self.normalized else uid)
+        if self.replace:
+            uids.update(series_of_paths(conn, [row[self.path_index] for row in rows]))
+        if removed:
+            uids.update(series_of_paths(conn, removed)) # read before the rows are deleted
+        return uids
+
+    def refresh(self, conn, uids):
+        refresh_series(conn, uids)
+
+
+def series_of_paths(conn, paths):
+    """Series UIDs (as stored) of the instance rows at these paths."""
+    uids = set()
+    if has_directories(conn):
+        groups = group_by_directory(paths)
+        for directory, directory_pk in find_directories(conn, groups).items():
+            names = groups[directory]
+            for i in range(0, len(names), LOOKUP_BATCH):
+                batch = names[i:i + LOOKUP_BATCH]
+                uids.update(uid for uid, in conn.execute(
+                    "SELECT se.series_instance_uid FROM instances i JOIN series se ON se.series_pk = i.series_pk "
+                    f"WHERE i.directory_pk = ? AND i.file_name IN ({', '.join(['?'] * len(batch))})",
+                    [directory_pk] + batch))
+    else:
+        for i in range(0, len(paths), LOOKUP_BATCH):
+            batch = paths[i:i + LOOKUP_BATCH]
+            uids.update(uid for uid, in conn.execute(
+                f"SELECT {SERIES_UID_COLUMN} FROM dicom_metadata WHERE file_path IN ({', '.join(['?'] * len(batch))})",
+                batch))
+    uids.discard(None)
+    return uids
+
+
+def refresh_series(conn, uids):
+    """Recompute the summary rows of these series (UIDs as stored) and of their studies; no commit."""
+    uids = list(uids)
+    if not uids:
+        return
+    normalized = has_directories(conn)
+    if not normalized:
+        register_rollup_functions(conn)
+    columns = ", ".join(SERIES_SUMMARY_COLUMNS)
+    c = conn.cursor()
+    studies = set()
+    for i in range(0, len(uids), LOOKUP_BATCH):
+        batch = uids[i:i + LOOKUP_BATCH]
+        keys = [to_text(uid) for uid in batch] # series_summary stores cleaned UIDs
+        marks = ", ".join(["?"] * len(batch))
+        studies.update(uid for uid, in c.execute(
+            f"SELECT study_instance_uid FROM series_summary WHERE series_instance_uid IN ({marks})", keys))
+        c.execute(f"DELETE FROM series_summary WHERE series_instance_uid IN ({marks})", keys)
+        if normalized:
+            select = NORMALIZED_SERIES_SELECT.format(where=f"WHERE se.series_instance_uid IN ({marks})")
+        else:
+            select = _flat_series_select(conn, f"WHERE {SERIES_UID_COLUMN} IN ({marks})")
+        c.execute(f"INSERT OR REPLACE INTO series_summary ({columns}) {select}", batch)
+        studies.update(uid for uid, in c.execute(
+            f"SELECT study_instance_uid FROM series_summary WHERE series_instance_uid IN ({marks})", keys))
+    studies.discard(None)
+    studies = list(studies)
+    for i in range(0, len(studies), LOOKUP_BATCH):
+        batch = studies[i:i + LOOKUP_BATCH]
+        marks = ", ".join(["?"] * len(batch))
+        c.execute(f"DELETE FROM study_summary WHERE study_instance_uid IN ({marks})", batch)
+        c.execute(f"INSERT INTO study_summary {STUDY_SUMMARY_SELECT.format(where=f'AND study_instance_uid IN ({marks})')}",
+                  batch)
+
+
+# --- Query CLI ---
+
+def _date_range(first, last):
+    if first is None:
+        return ""
+    return str(first) if first == last else f"{first}-{last}"
+
+
+def _thickness_range(low, high):
+    if low is None:
+        return ""
+    return f"{low:g}" if low == high else f"{low:g}-{high:g}"
+
+
+def _print_rows(header, rows, as_csv):
+    if as_csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(header)
+        writer.writerows(rows)
+        return
+    rows = [["" if v is None else str(v) for v in row] for row in rows]
+    widths = [max([len(h)] + [len(row[n]) for row in rows]) for n, h in enumerate(header)]
+    print("  ".join(h.ljust(w) for h, w in zip(header, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def _filters(args, date_column):
+    clauses = []
+    params = []
+    if args.patient:
+        clauses.append("patient_id = ?")
+        params.append(args.patient)
+    if args.date_from:
+        clauses.append(f"COALESCE({date_column}, last_acquisition_date) >= ?")
+        params.append(args.date_from)
+    if args.date_to:
+        clauses.append(f"COALESCE({date_column}, first_acquisition_date) <= ?")
+        params.append(args.date_to)
+    if args.min_instances:
+        clauses.append("instance_count >= ?")
+        params.append(args.min_instances)
+    return clauses, params
+
+
+def query_studies(conn, args):
+    """Studies matching the filters, with series / instance counts, modalities and ranges."""
+    clauses, params = _filters(args, "study_date")
+    if args.modality:
+        clauses.append("EXISTS (SELECT 1 FROM series_summary s WHERE s.study_instance_uid = study_summary.study_instance_uid "
+                       "AND s.modality = ?)")
+        params.append(args.modality)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = conn.execute(
+        "SELECT patient_id, study_instance_uid, study_date, study_description, modalities, series_count, "
+        "instance_count, first_acquisition_date, last_acquisition_date, min_slice_thickness, max_slice_thickness "
+        f"FROM study_summary {where} ORDER BY patient_id, study_date, study_instance_uid LIMIT ?",
+        params + [args.limit]).fetchall()
+    _print_rows(("patient_id", "study_instance_uid", "study_date", "description", "modalities", "series", "instances",
+                 "acquisition_dates", "slice_thickness"),
+                [row[:7] + (_date_range(row[7], row[8]), _thickness_range(row[9], row[10])) for row in rows],
+                args.csv)
+    return len(rows)
+
+
+def query_series(conn, args):
+    """Series matching the filters, grouped by study, with instance counts and ranges."""
+    clauses, params = _filters(args, "series_date")
+    if args.study:
+        clauses.append("study_instance_uid = ?")
+        params.append(args.study)
+    if args.modality:
+        clauses.append("modality = ?")
+        params.append(args.modality)
+    if args.min_thickness is not None:
+        clauses.append("min_slice_thickness >= ?")
+        params.append(args.min_thickness)
+    if args.max_thickness is not None:
+        clauses.append("max_slice_thickness <= ?")
+        params.append(args.max_thickness)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = conn.execute(
+        "SELECT patient_id, study_instance_uid, study_date, series_instance_uid, modality, series_description, "
+        "instance_count, first_acquisition_date, last_acquisition_date, min_slice_thickness, max_slice_thickness "
+        f"FROM series_summary {where} ORDER BY patient_id, study_date, study_instance_uid, series_date, "
+        "series_instance_uid LIMIT ?", params + [args.limit]).fetchall()
+    _print_rows(("patient_id", "study_instance_uid", "study_date", "series_instance_uid", "modality", "description",
+                 "instances", "acquisition_dates", "slice_thickness"),
+                [row[:7] + (_date_range(row[7], row[8]), _thickness_range(row[9], row[10])) for row in rows],
+                args.csv)
+    return len(rows)
+
+
+def query_totals(conn, args):
+    """Patients / studies / series / instances overall and per modality."""
+    patients, studies, instances = conn.execute(
+        "SELECT COUNT(DISTINCT patient_id), COUNT(*), COALESCE(SUM(instance_count), 0) FROM study_summary").fetchone()
+    series = conn.execute("SELECT COUNT(*) FROM series_summary").fetchone()[0]
+    if not args.csv:
+        print(f"Patients: {patients} | Studies: {studies} | Series: {series} | Instances: {instances}")
+    rows = conn.execute(
+        "SELECT modality, COUNT(DISTINCT patient_id), COUNT(DISTINCT study_instance_uid), COUNT(*), SUM(instance_count), "
+        "MIN(COALESCE(series_date, first_acquisition_date)), MAX(COALESCE(series_date, last_acquisition_date)) "
+        "FROM series_summary GROUP BY modality ORDER BY SUM(instance_count) DESC").fetchall()
+    _print_rows(("modality", "patients", "studies", "series", "instances", "dates"),
+                [row[:5] + (_date_range(row[5], row[6]),) for row in rows], args.csv)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Series / study summary tables: rebuild and cohort queries.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_rebuild = sub.add_parser("rebuild", help="Regenerate series_summary / study_summary from the instance rows.")
+    p_rebuild.add_argument("db_file", type=str, help="Path to the SQLite database file.")
+    for name, help_text in (("studies", "Studies with series / instance counts, modalities, date and thickness ranges."),
+                            ("series", "Series per study with instance counts, date and slice thickness ranges."),
+                            ("totals", "Patient / study / series / instance counts, overall and per modality.")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("db_file", type=str, help="Path to the SQLite database file.")
+        p.add_argument("--csv", action="store_true", help="Write CSV to stdout instead of an aligned table.")
+        if name == "totals":
+            continue
+        p.add_argument("--patient", type=str, default=None, help="Only this patient ID.")
+        p.add_argument("--modality", type=str, default=None,
+                       help="Only this modality (studies: studies with at least one such series).")
+        p.add_argument("--from", dest="date_from", type=int, default=None, metavar="YYYYMMDD",
+                       help="Study / series date on or after (acquisition dates when the date is missing).")
+        p.add_argument("--to", dest="date_to", type=int, default=None, metavar="YYYYMMDD",
+                       help="Study / series date on or before.")
+        p.add_argument("--min-instances", type=int, default=None, help="At least this many instances.")
+        p.add_argument("--limit", type=int, default=DEFAULT_QUERY_LIMIT,
+                       help=f"Maximum rows to print (default: {DEFAULT_QUERY_LIMIT}).")
+        if name == "series":
+            p.add_argument("--study", type=str, default=None, help="Only the series of this Study Instance UID.")
+            p.add_argument("--min-thickness", type=float, default=None, help="Thinnest slice at least this (mm).")
+            p.add_argument("--max-thickness", type=float, default=None, help="Thickest slice at most this (mm).")
+    args = parser.parse_args()
+
+    db_file = os.path.abspath(args.db_file)
+    if not os.path.exists(db_file):
+        print(f"Error: {db_file} not found.")
+        sys.exit(1)
+    conn = sqlite3.connect(db_file, timeout=30.0)
+    try:
+        if args.command == "rebuild":
+            if rollups_exist(conn):
+                rebuild_rollups(conn)
+            elif not create_rollup_tables(conn): # builds them when the DB has rows
+                sys.exit(1)
+        elif not rollups_exist(conn):
+            print(f"Error: {db_file} has no summary tables yet; run 'python dicom_rollup.py rebuild {args.db_file}'.")
+            sys.exit(1)
+        else:
+            since = stale_since(conn)
+            if since is not None:
+                print(f"Warning: the summaries are stale since {since} (rows were ingested without --rollups); "
+                      f"run 'python dicom_rollup.py rebuild {args.db_file}' for current numbers.", file=sys.stderr)
+            start = time.perf_counter()
+            query = {"studies": query_studies, "series": query_series, "totals": query_totals}[args.command]
+            count = query(conn, args)
+            if not args.csv:
+                print(f"({count} rows in {(time.perf_counter() - start) * 1000:.1f} ms)")
+    finally:
+        conn.close()
@@ -0,0 +1,97 @@
+# dicom_sampling.py
+# Series-sampling mode (--series-sample) shared by dicom_metadata2.py / dicom_metadata3.py
+#
+# A series folder holds hundreds of slices whose study / series / patient columns
+# are identical. In this mode each leaf directory becomes one task: the first few
+# files are parsed fully, the rest only get a targeted read (SOP UIDs, series UID
+# and the per-instance columns) that confirms they belong to the same series,
+# and their rows are filled in from the parsed sample. A directory that turns out
+# to mix series (or whose series UID is unknown) falls back to parsing every file.
+# With the hybrid engine the targeted reads run on the worker's I/O threads.
+import os
+
+from dicom_engine import io_map
+from dicom_failures import FailedFile
+from dicom_manifest import manifest_entry
+
+# --- 設定 ---
+DEFAULT_SAMPLE_FILES = 1
+# Upper bound on files per directory task (huge flat folders are split)
+MAX_GROUP_FILES = 2048
+
+
+def iter_directory_groups(paths, max_group=MAX_GROUP_FILES):
+    """Group consecutive paths by parent directory.
+
+    The crawler (and find) list a directory's files together, so grouping
+    consecutive runs is enough; a directory that shows up in two runs just
+    becomes two tasks.
+    """
+    group = []
+    current_dir = None
+    for path in paths:
+        directory = os.path.dirname(path)
+        if group and (directory != current_dir or len(group) >= max_group):
+            yield group
+            group = []
+        current_dir = directory
+        group.append(path)
+    if group:
+        yield group
+
+
+def sample_series_group(paths, row_func, probe_func, columns, instance_columns,
+                        sample_files=DEFAULT_SAMPLE_FILES):
+    """Worker task for one directory group; returns (attempted, [(row, manifest entry), ...]).
+
+    row_func(path) is the full parse ((row tuple in `columns` order, manifest
+    entry), a FailedFile or None). probe_func(path) is the targeted read:
+    (series UID, values of `instance_columns` as a tuple, os.stat result,
+    SOP Instance UID), or None when the cheap read cannot handle the file (it
+    is then parsed fully, which also takes care of error reporting).
+    """
+    path_i = columns.index("file_path")
+    series_i = columns.index("series_instance_uid")
+    instance_i = [columns.index(name) for name in instance_columns]
+    results = []
+    template = None
+    sampled = 0
+    mixed = False
+
+    def parse(path):
+        nonlocal template, mixed
+        result = row_func(path)
+        if result is None:
+            return
+        results.append(result)
+        if isinstance(result, FailedFile):
+            return
+        row = result[0]
+        if template is None:
+            template = row
+            mixed = row[series_i] in (None, "N/A") # cannot confirm membership without a UID
+        elif row[series_i] != template[series_i] and not mixed:
+            print(f"Note: {os.path.dirname(path)} mixes series, parsing the remaining files individually.")
+            mixed = True
+
+    i = 0
+    while i < len(paths) and (template is None or mixed or sampled < sample_files):
+        parse(paths[i])
+        sampled += 1
+        i += 1
+    rest = paths[i:]
+    if mixed:
+        results.extend(result for result in io_map(row_func, rest) if result is not None)
+        return len(paths), results
+    # Probes are read ahead (in order) on the I/O threads; the series check stays sequential
+    for path, probe in zip(rest, io_map(probe_func, rest)):
+        if mixed or probe is None or probe[0] != template[series_i]:
+            parse(path)
+            continue
+        _, values, st, sop_instance_uid = probe
+        row = list(template)
+        row[path_i] = path
+        for i, value in zip(instance_i, values):
+            row[i] = value
+        results.append((tuple(row), manifest_entry(path, st, sop_instance_uid)))
+    return len(paths), results
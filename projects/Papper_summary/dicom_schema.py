@@ -0,0 +1,437 @@
+# dicom_schema.py
+# Normalized, typed metadata schema (patients / studies / series / instances) and migration tool
+#
+# The original dicom_metadata table is one wide all-TEXT table ("N/A" for missing
+# values, no secondary indexes). The normalized schema stores each patient, study
+# and series once with integer surrogate keys, uses real types (dates as YYYYMMDD
+# integers, times as HHMMSS numbers - integers, or HHMMSS.ffffff reals when the
+# TM value has a fraction - REAL slice thickness, NULL for missing) and
+# indexes the columns cohort queries filter on. A read-only dicom_metadata view
+# keeps ad-hoc queries written against the flat table working.
+#
+# File paths are prefix-compressed: each directory is stored once in the
+# directories table (with its trailing separator) and instances / file_manifest
+# rows keep only (directory_pk, file_name), so the series folder is no longer
+# repeated for every file in the table, its UNIQUE index and the manifest.
+# The view rebuilds file_path as directories.path || file_name.
+#
+# Usage:
+#   python dicom_schema.py migrate dicom_metadata.db   # convert a flat DB in place (resumable)
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from dicom_manifest import DIRECTORY_MANIFEST_COLUMNS, DIRECTORY_MANIFEST_SQL, MANIFEST_COLUMNS, create_manifest_table
+from dicom_paths import DirectoryKeys, register_path_functions
+
+# --- 設定 ---
+MIGRATION_CHUNK_ROWS = 50000
+# Surrogate-key caches in the inserter are dropped when they grow past this
+KEY_CACHE_LIMIT = 1000000
+
+NORMALIZED_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS directories (
+    directory_pk INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS patients (
+    patient_pk INTEGER PRIMARY KEY,
+    patient_id TEXT UNIQUE,
+    patient_sex TEXT
+);
+CREATE TABLE IF NOT EXISTS studies (
+    study_pk INTEGER PRIMARY KEY,
+    study_instance_uid TEXT UNIQUE,
+    patient_pk INTEGER REFERENCES patients(patient_pk),
+    study_date INTEGER,
+    study_time INTEGER,
+    study_description TEXT,
+    institution_name TEXT,
+    patient_age TEXT
+);
+CREATE TABLE IF NOT EXISTS series (
+    series_pk INTEGER PRIMARY KEY,
+    series_instance_uid TEXT UNIQUE,
+    study_pk INTEGER REFERENCES studies(study_pk),
+    series_date INTEGER,
+    series_time INTEGER,
+    modality TEXT,
+    manufacturer TEXT,
+    series_description TEXT
+);
+CREATE TABLE IF NOT EXISTS instances (
+    instance_pk INTEGER PRIMARY KEY,
+    directory_pk INTEGER NOT NULL REFERENCES directories(directory_pk),
+    file_name TEXT NOT NULL,
+    series_pk INTEGER REFERENCES series(series_pk),
+    acquisition_date INTEGER,
+    acquisition_time INTEGER,
+    content_date INTEGER,
+    slice_thickness REAL,
+    sop_instance_uid TEXT,
+    UNIQUE (directory_pk, file_name)
+);
+CREATE INDEX IF NOT EXISTS idx_studies_patient ON studies(patient_pk);
+CREATE INDEX IF NOT EXISTS idx_studies_date ON studies(study_date);
+CREATE INDEX IF NOT EXISTS idx_series_study ON series(study_pk);
+CREATE INDEX IF NOT EXISTS idx_series_modality ON series(modality, series_date);
+CREATE INDEX IF NOT EXISTS idx_series_date ON series(series_date);
+CREATE INDEX IF NOT EXISTS idx_instances_series ON instances(series_pk);
+CREATE INDEX IF NOT EXISTS idx_instances_sop_uid ON instances(sop_instance_uid);
+"""
+
+# Same column names as the flat table; dates come back as 'YYYYMMDD' text so
+# existing string comparisons keep working (times as 'HHMMSS' or 'HHMMSS.ffffff').
+# Missing values are NULL, not 'N/A'.
+COMPAT_SELECT_SQL = """
+SELECT d.path || i.file_name AS file_path,
+       CASE WHEN st.study_date IS NOT NULL THEN printf('%08d', st.study_date) END AS study_date,
+       CASE WHEN se.series_date IS NOT NULL THEN printf('%08d', se.series_date) END AS series_date,
+       CASE WHEN i.acquisition_date IS NOT NULL THEN printf('%08d', i.acquisition_date) END AS acquisition_date,
+       CASE WHEN i.content_date IS NOT NULL THEN printf('%08d', i.content_date) END AS content_date,
+       CASE typeof(st.study_time) WHEN 'integer' THEN printf('%06d', st.study_time) WHEN 'real' THEN rtrim(printf('%013.6f', st.study_time), '0') END AS study_time,
+       CASE typeof(se.series_time) WHEN 'integer' THEN printf('%06d', se.series_time) WHEN 'real' THEN rtrim(printf('%013.6f', se.series_time), '0') END AS series_time,
+       CASE typeof(i.acquisition_time) WHEN 'integer' THEN printf('%06d', i.acquisition_time) WHEN 'real' THEN rtrim(printf('%013.6f', i.acquisition_time), '0') END AS acquisition_time,
+       se.modality, se.manufacturer, st.institution_name,
+       st.study_description, se.series_description,
+       p.patient_id, p.patient_sex, st.patient_age,
+       i.slice_thickness,
+       st.study_instance_uid, se.series_instance_uid, i.sop_instance_uid
+FROM instances i
+JOIN directories d ON d.directory_pk = i.directory_pk
+LEFT JOIN series se ON se.series_pk = i.series_pk
+LEFT JOIN studies st ON st.study_pk = se.study_pk
+LEFT JOIN patients p ON p.patient_pk = st.patient_pk
+"""
+COMPAT_VIEW_SQL = "CREATE VIEW IF NOT EXISTS dicom_metadata AS" + COMPAT_SELECT_SQL
+
+_DIGITS = re.compile(r"\D")
+
+
+# --- Typed converters (flat TEXT values -> normalized values) ---
+
+def to_text(value):
+    """'N/A' / empty -> None, otherwise stripped text."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    return None if value in ("", "N/A") else value
+
+
+def to_date_int(value):
+    """DICOM DA ('20240102', also old '2024.01.02') -> 20240102, else None."""
+    value = to_text(value)
+    if value is None:
+        return None
+    digits = _DIGITS.sub("", value)
+    return int(digits) if len(digits) == 8 else None
+
+
+def to_time_int(value):
+    """DICOM TM ('101112.5', '1011') -> HHMMSS integer (fraction dropped), else None."""
+    value = to_text(value)
+    if value is None:
+        return None
+    hhmmss = value.split(".")[0].replace(":", "")
+    if not hhmmss.isdigit() or len(hhmmss) not in (2, 4, 6):
+        return None
+    return int(hhmmss.ljust(6, "0"))
+
+
+def to_time_value(value):
+    """DICOM TM -> HHMMSS integer, or HHMMSS.ffffff float when it has a non-zero fraction (normalized columns)."""
+    hhmmss = to_time_int(value)
+    if hhmmss is None:
+        return None
+    fraction = to_text(value).partition(".")[2][:6]
+    if not fraction.isdigit() or not int(fraction):
+        return hhmmss
+    return hhmmss + int(fraction.ljust(6, "0")) / 1e6
+
+
+def to_real(value):
+    value = to_text(value)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+# --- Schema helpers ---
+
+def _flat_table_exists(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dicom_metadata'").fetchone() is not None
+
+
+def detect_schema(conn):
+    """Return 'normalized' if the instances table exists, else 'flat'."""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'instances'").fetchone()
+    return "normalized" if row else "flat"
+
+
+def path_table(conn):
+    """Table with one row per ingested file (the bloom filter tracks its rowid)."""
+    return "instances" if detect_schema(conn) == "normalized" else "dicom_metadata"
+
+
+def iter_path_rows(conn, after_rowid=0):
+    """(rowid, full path) of the path table in rowid order, starting after `after_rowid`."""
+    if detect_schema(conn) == "normalized":
+        sql = ("SELECT i.instance_pk, d.path || i.file_name FROM instances i "
+               "JOIN directories d ON d.directory_pk = i.directory_pk WHERE i.instance_pk > ? ORDER BY i.instance_pk")
+    else:
+        sql = "SELECT rowid, file_path FROM dicom_metadata WHERE rowid > ? ORDER BY rowid"
+    return conn.execute(sql, (after_rowid,))
+
+
+def path_at_rowid(conn, rowid):
+    """Full path of the path-table row with this rowid, or None."""
+    if detect_schema(conn) == "normalized":
+        sql = ("SELECT d.path || i.file_name FROM instances i "
+               "JOIN directories d ON d.directory_pk = i.directory_pk WHERE i.instance_pk = ?")
+    else:
+        sql = "SELECT file_path FROM dicom_metadata WHERE rowid = ?"
+    row = conn.execute(sql, (rowid,)).fetchone()
+    return row[0] if row else None
+
+
+def _has_column(conn, table, column):
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def resolve_schema(conn, requested):
+    """Schema an ingest run should write: an existing DB keeps its own, a new DB gets `requested`."""
+    if detect_schema(conn) == "normalized":
+        return "normalized"
+    if _flat_table_exists(conn):
+        return "flat"
+    return requested
+
+
+def fill_instance_uids(conn):
+    """Fill instances.sop_instance_uid from the file manifest for rows migrated from a flat table without the column."""
+    if _has_column(conn, "file_manifest", "directory_pk"):
+        conn.execute("UPDATE instances SET sop_instance_uid = (SELECT m.sop_instance_uid FROM file_manifest m "
+                     "WHERE m.directory_pk = instances.directory_pk AND m.file_name = instances.file_name) "
+                     "WHERE sop_instance_uid IS NULL")
+
+
+def create_normalized_schema(conn, with_view=True):
+    conn.executescript(NORMALIZED_SCHEMA_SQL)
+    if with_view:
+        conn.execute(COMPAT_VIEW_SQL)
+    conn.commit()
+
+
+class NormalizedInserter:
+    """Insert flat metadata rows (tuples in `columns` order) into the normalized tables.
+
+    Patients, studies and series are resolved through in-memory key caches, so
+    only the first row of each series touches those tables; the same goes
+    for directories (file paths are stored as directory_pk + file_name).
+    With replace (rescan / watch) that first row also overwrites the stored
+    patient / study / series attributes, so corrected headers are picked up.
+    Meant to be used from a single writer thread.
+    """
+
+    def __init__(self, columns, replace=False):
+        self.index = {name: i for i, name in enumerate(columns)}
+        self.replace = replace
+        self._patients = {}
+        self._studies = {}
+        self._series = {}
+        self.directories = DirectoryKeys() # shared with the manifest upsert (dicom_manifest.upsert_manifest)
+        conflict = ("ON CONFLICT(directory_pk, file_name) DO UPDATE SET series_pk = excluded.series_pk, "
+                    "acquisition_date = excluded.acquisition_date, acquisition_time = excluded.acquisition_time, "
+                    "content_date = excluded.content_date, slice_thickness = excluded.slice_thickness, "
+                    "sop_instance_uid = excluded.sop_instance_uid"
+                    if replace else "ON CONFLICT(directory_pk, file_name) DO NOTHING")
+        self.instance_sql = ("INSERT INTO instances (directory_pk, file_name, series_pk, acquisition_date, "
+                             "acquisition_time, content_date, slice_thickness, sop_instance_uid) "
+                             f"VALUES (?, ?, ?, ?, ?, ?, ?, ?) {conflict}")
+        self.patient_sql = self._upsert_sql("patients", "patient_id", ("patient_sex",))
+        self.study_sql = self._upsert_sql("studies", "study_instance_uid", (
+            "patient_pk", "study_date", "study_time", "study_description", "institution_name", "patient_age"))
+        self.series_sql = self._upsert_sql("series", "series_instance_uid", (
+            "study_pk", "series_date", "series_time", "modality", "manufacturer", "series_description"))
+
+    def _upsert_sql(self, table, uid_column, columns):
+        """INSERT of one patient / study / series row; keeps the stored row unless replace is set."""
+        conflict = (f"ON CONFLICT({uid_column}) DO UPDATE SET "
+                    + ", ".join(f"{column} = excluded.{column}" for column in columns)
+                    if self.replace else f"ON CONFLICT({uid_column}) DO NOTHING")
+        return (f"INSERT INTO {table} ({uid_column}, {', '.join(columns)}) "
+                f"VALUES ({', '.join(['?'] * (len(columns) + 1))}) {conflict}")
+
+    def _get(self, row, name):
+        i = self.index.get(name)
+        return row[i] if i is not None else None
+
+    def _key(self, c, cache, uid, insert_sql, insert_args, select_sql):
+        if uid is None:
+            return None
+        pk = cache.get(uid)
+        if pk is None:
+            c.execute(insert_sql, insert_args)
+            pk = c.execute(select_sql, (uid,)).fetchone()[0]
+            if len(cache) >= KEY_CACHE_LIMIT:
+                cache.clear()
+            cache[uid] = pk
+        return pk
+
+    def instance_row(self, c, row):
+        """Resolve surrogate keys for one flat row and return the instances tuple."""
+        get = self._get
+        patient_id = to_text(get(row, "patient_id"))
+        patient_pk = self._key(
+            c, self._patients, patient_id, self.patient_sql,
+            (patient_id, to_text(get(row, "patient_sex"))),
+            "SELECT patient_pk FROM patients WHERE patient_id = ?")
+        study_uid = to_text(get(row, "study_instance_uid"))
+        study_pk = self._key(
+            c, self._studies, study_uid, self.study_sql,
+            (study_uid, patient_pk, to_date_int(get(row, "study_date")), to_time_value(get(row, "study_time")),
+             to_text(get(row, "study_description")), to_text(get(row, "institution_name")),
+             to_text(get(row, "patient_age"))),
+            "SELECT study_pk FROM studies WHERE study_instance_uid = ?")
+        series_uid = to_text(get(row, "series_instance_uid"))
+        series_pk = self._key(
+            c, self._series, series_uid, self.series_sql,
+            (series_uid, study_pk, to_date_int(get(row, "series_date")), to_time_value(get(row, "series_time")),
+             to_text(get(row, "modality")), to_text(get(row, "manufacturer")),
+             to_text(get(row, "series_description"))),
+            "SELECT series_pk FROM series WHERE series_instance_uid = ?")
+        return self.directories.split(c, get(row, "file_path")) + (series_pk, to_date_int(get(row, "acquisition_date")),
+                to_time_value(get(row, "acquisition_time")), to_date_int(get(row, "content_date")),
+                to_real(get(row, "slice_thickness")), to_text(get(row, "sop_instance_uid")))
+
+    def reset_caches(self):
+        """Forget all cached keys; insert_batch calls this after rolling a batch back."""
+        self._patients.clear()
+        self._studies.clear()
+        self._series.clear()
+        self.directories.clear()
+
+    def insert(self, conn, rows):
+        c = conn.cursor()
+        c.executemany(self.instance_sql, [self.instance_row(c, row) for row in rows])
+        return len(rows)
+
+
+# --- Migration (flat dicom_metadata table -> normalized schema, in place) ---
+
+def _copy_flat_manifest(c):
+    """Rewrite a file_path-keyed manifest to (directory_pk, file_name) keys, inside the caller's transaction."""
+    c.execute("ALTER TABLE file_manifest RENAME TO file_manifest_paths")
+    c.execute("DROP INDEX IF EXISTS idx_manifest_inode")
+    c.execute("DROP INDEX IF EXISTS idx_manifest_sop_uid")
+    c.execute(DIRECTORY_MANIFEST_SQL)
+    c.execute("INSERT OR IGNORE INTO directories (path) "
+              "SELECT DISTINCT path_directory(file_path) FROM file_manifest_paths")
+    c.execute(f"INSERT OR REPLACE INTO file_manifest ({', '.join(DIRECTORY_MANIFEST_COLUMNS)}) "
+              f"SELECT d.directory_pk, path_file_name(m.file_path), {', '.join(MANIFEST_COLUMNS[1:])} "
+              "FROM file_manifest_paths m JOIN directories d ON d.path = path_directory(m.file_path)")
+    c.execute("DROP TABLE file_manifest_paths")
+
+
+def _copy_flat_table(conn):
+    """Stream the flat table into the normalized tables (resumable), then drop it."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(dicom_metadata)")]
+    total = conn.execute("SELECT COUNT(*) FROM dicom_metadata").fetchone()[0]
+    create_normalized_schema(conn, with_view=False) # view name is taken until the flat table is dropped
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_migration (last_rowid INTEGER)")
+    row = conn.execute("SELECT last_rowid FROM schema_migration").fetchone()
+    if row is None:
+        conn.execute("INSERT INTO schema_migration (last_rowid) VALUES (0)")
+        last_rowid = 0
+    else:
+        last_rowid = row[0]
+        print(f"Resuming migration after rowid {last_rowid}.")
+    conn.commit()
+
+    inserter = NormalizedInserter(columns)
+    select_sql = f"SELECT rowid, {', '.join(columns)} FROM dicom_metadata WHERE rowid > ? ORDER BY rowid LIMIT ?"
+    start_time = time.time()
+    copied = 0
+    while True:
+        chunk = conn.execute(select_sql, (last_rowid, MIGRATION_CHUNK_ROWS)).fetchall()
+        if not chunk:
+            break
+        last_rowid = chunk[-1][0]
+        inserter.insert(conn, [r[1:] for r in chunk])
+        conn.execute("UPDATE schema_migration SET last_rowid = ?", (last_rowid,))
+        conn.commit()
+        copied += len(chunk)
+        elapsed = time.time() - start_time
+        rate = copied / elapsed if elapsed > 0 else 0
+        print(f"Migrated: {copied}/{total} rows | Rate: {rate:.0f} rows/sec")
+
+    print(f"[{datetime.now()}] Copy complete, replacing dicom_metadata table with compatibility view...")
+    register_path_functions(conn)
+    c = conn.cursor()
+    c.execute("BEGIN")
+    try:
+        # The manifest switches to directory keys in the same transaction the flat table goes away
+        if _has_column(conn, "file_manifest", "file_path"):
+            _copy_flat_manifest(c)
+        c.execute("DROP TABLE dicom_metadata")
+        c.execute("DROP TABLE schema_migration")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def migrate_db(db_file, vacuum=True):
+    """Stream the flat table into the normalized schema, then replace it with the compat view.
+
+    Progress (last copied rowid) is committed with every chunk, so an
+    interrupted migration continues where it stopped when run again.
+    """
+    print(f"[{datetime.now()}] Migrating {db_file} to the normalized schema...")
+    conn = sqlite3.connect(db_file, timeout=30.0)
+    try:
+        if _flat_table_exists(conn):
+            _copy_flat_table(conn)
+        elif detect_schema(conn) != "normalized":
+            print(f"Error: {db_file} has no dicom_metadata table to migrate.")
+            sys.exit(1)
+        else:
+            print("Database already uses the normalized schema. Nothing to do.")
+            return
+        conn.execute(COMPAT_VIEW_SQL)
+        conn.commit()
+        create_manifest_table(conn) # a flat DB without a manifest gets the directory-keyed one
+        fill_instance_uids(conn) # rows copied from tables without the UID column
+        conn.commit()
+        counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                  for t in ("patients", "studies", "series", "instances", "directories")}
+        print("Rows: " + " | ".join(f"{t}: {n}" for t, n in counts.items()))
+        if vacuum:
+            size_before = os.path.getsize(db_file)
+            print(f"[{datetime.now()}] VACUUM (reclaiming space from the replaced tables)...")
+            conn.execute("VACUUM")
+            print(f"Database size: {size_before / 1e6:.1f} MB -> {os.path.getsize(db_file) / 1e6:.1f} MB")
+    finally:
+        conn.close()
+    print(f"[{datetime.now()}] Migration finished.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Normalized DICOM metadata schema tools.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_migrate = sub.add_parser("migrate", help="Convert a flat dicom_metadata DB to the normalized schema in place.")
+    p_migrate.add_argument("db_file", type=str, help="Path to the SQLite database file.")
+    p_migrate.add_argument("--no-vacuum", action="store_true",
+                           help="Skip the final VACUUM (faster, but the file does not shrink).")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate_db(os.path.abspath(args.db_file), vacuum=not args.no_vacuum)
@@ -0,0 +1,233 @@
+# dicom_shard.py
+# Sharded ingestion across several hosts (--shard i/N) and the merge tool for the shard databases
+#
+# SQLite allows one writer per database, so ingest hosts that mount the same
+# archive each write their own shard DB. The path space is split
+# deterministically (CRC32, identical on every host and Python version):
+#   --shard-by dir: by parent directory; a series folder always stays on one
+#                   host (required for --series-sample), any path list works
+#   --shard-by top: by the top-level directory below each scan root; the
+#                   crawler does not even enter other shards' trees
+# All hosts must see the archive under the same path, since file_path values
+# from different shards end up in one table.
+#
+# The merge command copies every shard into one DB with ATTACH and
+# INSERT OR IGNORE ... SELECT (first copy of a path wins, like the ingest
+# scripts). Normalized shards are merged level by level, re-resolving the
+# surrogate keys through the patient / study / series UIDs and directory paths.
+#
+# Usage (node k of 4):
+#   python dicom_metadata2.py /mnt/archive --shard k/4 -o shard_k.db
+#   python dicom_shard.py merge dicom_metadata.db shard_1.db shard_2.db shard_3.db shard_4.db
+import argparse
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from datetime import datetime
+
+from dicom_failures import create_failure_table
+from dicom_fields import create_flat_table
+from dicom_manifest import create_manifest_table
+from dicom_rollup import rebuild_rollups, rollups_exist
+from dicom_schema import create_normalized_schema, detect_schema, path_table, resolve_schema
+from dicom_writer import configure_connection
+
+# --- 設定 ---
+SHARD_MODES = ("dir", "top")
+DEFAULT_SHARD_BY = "dir"
+# Normalized merge order: (table, primary key, ((parent table, foreign key, parent's UNIQUE natural key), ...))
+_DIRECTORY_PARENT = ("directories", "directory_pk", "path")
+NORMALIZED_LEVELS = (
+    ("directories", "directory_pk", ()),
+    ("patients", "patient_pk", ()),
+    ("studies", "study_pk", (("patients", "patient_pk", "patient_id"),)),
+    ("series", "series_pk", (("studies", "study_pk", "study_instance_uid"),)),
+    ("instances", "instance_pk", (("series", "series_pk", "series_instance_uid"), _DIRECTORY_PARENT)),
+)
+
+
+def parse_shard(text):
+    """'i/N' (1-based, as in --shard 2/4) -> (i, N); argparse type function."""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {text!r}")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {text!r}: need 1 <= i <= N")
+    return index, count
+
+
+def _bucket(key, count):
+    return zlib.crc32(key.encode("utf-8", "surrogateescape")) % count
+
+
+class ShardFilter:
+    """Decides which paths belong to shard `index` of `count`."""
+
+    def __init__(self, index, count, by=DEFAULT_SHARD_BY, roots=None):
+        if by not in SHARD_MODES:
+            raise ValueError(f"unknown shard mode {by!r}")
+        if by == "top" and not roots:
+            raise ValueError("--shard-by top needs the scan roots (directory crawl)")
+        self.index = index
+        self.count = count
+        self.by = by
+        # Longest root first, so nested roots resolve to the innermost one
+        self.roots = sorted((os.path.join(os.path.abspath(r), "") for r in roots or ()), key=len, reverse=True)
+
+    def describe(self):
+        return f"{self.index}/{self.count} by {'parent directory' if self.by == 'dir' else 'top-level directory'}"
+
+    def _key(self, path):
+        if self.by == "dir":
+            return os.path.dirname(path)
+        for root in self.roots:
+            if path.startswith(root):
+                return path[len(root):].split(os.sep, 1)[0]
+        return os.path.dirname(path)
+
+    def owns(self, path):
+        return _bucket(self._key(path), self.count) == self.index - 1
+
+    def dir_filter(self, directory):
+        """Crawler hook (top mode): skip top-level directories of other shards, enter everything below ours."""
+        if self.by != "top" or os.path.dirname(directory) + os.sep not in self.roots:
+            return True
+        return self.owns(directory)
+
+    def iter_paths(self, paths):
+        for path in paths:
+            if self.owns(path):
+                yield path
+
+    def iter_entries(self, entries):
+        """Same for (path, stat) pairs (--rescan)."""
+        for entry in entries:
+            if self.owns(entry[0]):
+                yield entry
+
+
+# --- Merge ---
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _copy_table(conn, table, exclude=()):
+    """INSERT OR IGNORE every column both tables have; returns the number of rows added."""
+    target = _columns(conn, "main", table)
+    shared = [c for c in _columns(conn, "shard", table) if c in target and c not in exclude]
+    if not shared:
+        return 0
+    cols = ", ".join(shared)
+    before = conn.total_changes
+    conn.execute(f"INSERT OR IGNORE INTO main.{table} ({cols}) SELECT {cols} FROM shard.{table}")
+    return conn.total_changes - before
+
+
+def _copy_level(conn, table, pk, parents):
+    """Normalized level: natural-key dedup, foreign keys re-resolved through the parents' natural keys."""
+    fks = [fk for _, fk, _ in parents]
+    if not fks:
+        return _copy_table(conn, table, exclude=(pk,))
+    target = _columns(conn, "main", table)
+    shared = [c for c in _columns(conn, "shard", table) if c in target and c != pk and c not in fks]
+    cols = ", ".join(shared + fks)
+    select = ", ".join([f"t.{c}" for c in shared] + [f"m{n}.{fk}" for n, fk in enumerate(fks)])
+    joins = " ".join(
+        f"LEFT JOIN shard.{parent_table} p{n} ON p{n}.{fk} = t.{fk} "
+        f"LEFT JOIN main.{parent_table} m{n} ON m{n}.{parent_key} = p{n}.{parent_key}"
+        for n, (parent_table, fk, parent_key) in enumerate(parents))
+    before = conn.total_changes
+    conn.execute(f"INSERT OR IGNORE INTO main.{table} ({cols}) SELECT {select} FROM shard.{table} t {joins}")
+    return conn.total_changes - before
+
+
+def _has_table(conn, schema, table):
+    return conn.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+                        (table,)).fetchone() is not None
+
+
+def merge_shards(out_db, shard_dbs):
+    """Bulk-copy shard DBs into out_db (created if missing); returns the number of path rows added."""
+    shard_schemas = {}
+    for shard_db in shard_dbs:
+        probe = sqlite3.connect(shard_db)
+        shard_schemas[shard_db] = detect_schema(probe)
+        probe.close()
+    conn = sqlite3.connect(out_db, timeout=30.0)
+    configure_connection(conn)
+    schema = resolve_schema(conn, shard_schemas[shard_dbs[0]]) # a new target takes the shards' layout
+    mismatched = [db for db, s in shard_schemas.items() if s != schema]
+    if mismatched:
+        print(f"Error: {', '.join(mismatched)}: not the {schema} schema of {out_db}; "
+              f"migrate with 'python dicom_schema.py migrate' first.")
+        conn.close()
+        sys.exit(1)
+    if schema == "normalized":
+        create_normalized_schema(conn)
+    else:
+        create_flat_table(conn)
+    create_manifest_table(conn)
+    create_failure_table(conn)
+
+    print(f"[{datetime.now()}] Merging {len(shard_dbs)} shard(s) into {out_db} ({schema} schema)")
+    total_added = 0
+    try:
+        for shard_db in shard_dbs:
+            start = time.time()
+            conn.execute("ATTACH DATABASE ? AS shard", (shard_db,))
+            try:
+                with conn: # one transaction per shard
+                    if schema == "normalized":
+                        for table, pk, parents in NORMALIZED_LEVELS:
+                            added = _copy_level(conn, table, pk, parents) # ends with instances
+                        if _has_table(conn, "shard", "file_manifest"):
+                            _copy_level(conn, "file_manifest", None, (_DIRECTORY_PARENT,))
+                    else:
+                        added = _copy_table(conn, "dicom_metadata")
+                        if _has_table(conn, "shard", "file_manifest"):
+                            _copy_table(conn, "file_manifest")
+                    if _has_table(conn, "shard", "file_failures"):
+                        _copy_table(conn, "file_failures")
+                    shard_rows = conn.execute(f"SELECT COUNT(*) FROM shard.{path_table(conn)}").fetchone()[0]
+            finally:
+                conn.execute("DETACH DATABASE shard")
+            total_added += added
+            print(f"  {shard_db}: {added} of {shard_rows} rows added "
+                  f"({shard_rows - added} already present) in {time.time() - start:.2f} seconds")
+        with conn:
+            # A path that failed on one host but was ingested by another (overlapping shards) is not a failure
+            conn.execute("DELETE FROM file_failures WHERE file_path IN (SELECT file_path FROM dicom_metadata)")
+        # Summaries are derived data: regenerated for the merged rows instead of copied (if the DB keeps them)
+        if rollups_exist(conn):
+            rebuild_rollups(conn)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    print(f"[{datetime.now()}] Merge complete: {total_added} rows added. "
+          f"Bloom filter sidecars are per database; let the next ingest run rebuild one for {out_db}.")
+    return total_added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shard database tools for multi-host DICOM ingestion.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_merge = sub.add_parser("merge", help="Combine shard DBs into one (INSERT OR IGNORE semantics).")
+    p_merge.add_argument("out_db", type=str, help="Target SQLite database (created if missing).")
+    p_merge.add_argument("shard_dbs", type=str, nargs="+", help="Shard databases written with --shard i/N.")
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        out_db = os.path.abspath(args.out_db)
+        shard_dbs = [os.path.abspath(db) for db in args.shard_dbs]
+        missing = [db for db in shard_dbs if not os.path.exists(db)]
+        if missing:
+            print(f"Error: {', '.join(missing)} not found.")
+            sys.exit(1)
+        if out_db in shard_dbs:
+            print("Error: the output database cannot also be a shard.")
+            sys.exit(1)
+        merge_shards(out_db, shard_dbs)
@@ -0,0 +1,80 @@
+# dicom_sniff.py
+# Content sniffing (--sniff): find DICOM files without a .dcm extension
+#
+# Many modality exports write extensionless or numeric file names, which the
+# default .dcm name filter never sees. With --sniff the crawler accepts every
+# file name and this stage, placed after the processed-file filter and the
+# failure ledger (so files already in the DB are never read again), checks the
+# first 132 bytes of each remaining file (dicom_fastread.looks_like_dicom).
+# Only files that look like DICOM go on to extraction; a non-DICOM file costs
+# one small read. Files named *.dcm are passed through without a read.
+#
+# Reads run in a thread pool in batches; the output keeps the input order, so
+# the per-directory grouping of --series-sample is unaffected. Archive members
+# (--archives) pass through: they are sniffed inside the archive task.
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from dicom_crawler import dcm_suffix_filter
+from dicom_fastread import sniff_dicom
+from dicom_paths import is_member_path
+
+# --- 設定 ---
+DEFAULT_SNIFF_THREADS = 16
+# Paths per thread-pool task
+SNIFF_BATCH_SIZE = 64
+# Batches in flight per thread (read-ahead)
+SNIFF_BATCHES_PER_THREAD = 4
+
+
+def any_file_filter(name):
+    """Crawler name filter for --sniff: every file is a candidate."""
+    return True
+
+
+def _sniff_batch(paths):
+    return [path for path in paths if dcm_suffix_filter(path) or is_member_path(path) or sniff_dicom(path)]
+
+
+def iter_sniffed(paths, threads=DEFAULT_SNIFF_THREADS, batch_size=SNIFF_BATCH_SIZE, counts=None, verbose=True):
+    """Phase 2 (streaming): yield the paths that are named *.dcm or whose header looks like DICOM.
+
+    A counts dict, if given, receives checked / passed / skipped totals.
+    """
+    if counts is None:
+        counts = {}
+    for key in ("checked", "passed", "skipped"):
+        counts.setdefault(key, 0)
+    if verbose:
+        print(f"[{datetime.now()}] Phase 2: Sniffing candidates without a .dcm name "
+              f"({threads} threads, 132-byte header check)...")
+    start_time = time.time()
+    max_in_flight = max(1, threads) * SNIFF_BATCHES_PER_THREAD
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="sniff") as pool:
+        batch = []
+        for path in paths:
+            batch.append(path)
+            if len(batch) >= batch_size:
+                in_flight.append((len(batch), pool.submit(_sniff_batch, batch)))
+                batch = []
+                while len(in_flight) >= max_in_flight:
+                    yield from _collect(in_flight.popleft(), counts)
+        if batch:
+            in_flight.append((len(batch), pool.submit(_sniff_batch, batch)))
+        while in_flight:
+            yield from _collect(in_flight.popleft(), counts)
+    if verbose:
+        print(f"[{datetime.now()}] Phase 2: Sniffing complete in {time.time() - start_time:.2f} seconds. "
+              f"Checked: {counts['checked']} | DICOM: {counts['passed']} | Not DICOM (skipped): {counts['skipped']}")
+
+
+def _collect(task, counts):
+    size, future = task
+    passed = future.result()
+    counts["checked"] += size
+    counts["passed"] += len(passed)
+    counts["skipped"] += size - len(passed)
+    return passed
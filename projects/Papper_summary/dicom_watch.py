@@ -0,0 +1,411 @@
+# dicom_watch.py
+# Watch daemon: ingest new DICOM files seconds after they arrive instead of on the next cron run
+#
+# Uses Linux inotify (through ctypes, no extra dependency) on every directory
+# below the given roots. A file counts as arrived on IN_CLOSE_WRITE or
+# IN_MOVED_TO; events are collected per directory (one series folder) and the
+# directory is flushed once it has been quiet for --debounce seconds, or after
+# --max-delay seconds during a continuous burst. A flush stats the files,
+# compares them with the file manifest (new / changed files are parsed,
+# moved ones re-linked) and hands the rows to one long-lived DB writer.
+#
+# Where inotify is unavailable or does not see the writes (NFS / SMB mounts
+# written by other hosts, watch limit reached) the daemon falls back to
+# periodic incremental rescans (--poll-interval); with inotify the same
+# rescan runs rarely as a safety net and after an event-queue overflow.
+# Stop it with SIGTERM / Ctrl-C: pending directories are flushed and committed.
+#
+# Usage:
+#   python dicom_watch.py /mnt/archive -o dicom_metadata.db [--debounce 5] [--poll]
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import signal
+import sqlite3
+import struct
+import sys
+import time
+from datetime import datetime
+from functools import partial
+
+import dicom_ingest as ingest
+from dicom_crawler import DEFAULT_SCAN_THREADS, dcm_suffix_filter, iter_crawl
+from dicom_engine import DEFAULT_CHUNK_SIZE, DEFAULT_ENGINE, DEFAULT_IO_THREADS, ENGINES, iter_extracted, make_executor
+from dicom_failures import FailedFile, create_failure_table, skip_known_failures
+from dicom_fields import COLUMNS, REPLACE_SQL
+from dicom_manifest import create_manifest_table, iter_changed_files
+from dicom_rollup import open_rollups
+from dicom_sampling import DEFAULT_SAMPLE_FILES, iter_directory_groups
+from dicom_sniff import any_file_filter, iter_sniffed
+from dicom_schema import NormalizedInserter, create_normalized_schema, resolve_schema
+from dicom_writer import DEFAULT_COMMIT_ROWS, DbWriter, PendingResults, configure_connection
+
+# --- 設定 ---
+DEFAULT_DEBOUNCE = 5.0
+DEFAULT_MAX_DELAY = 60.0
+# Incremental rescan interval: the only source of new files in polling mode,
+# a safety net (missed events, files written before a watch was added) with inotify
+DEFAULT_POLL_INTERVAL = 300.0
+DEFAULT_SAFETY_RESCAN = 6 * 3600.0
+DEFAULT_WATCH_WORKERS = min(8, os.cpu_count() or 4)
+# The writer commits at least this often, so rows show up in the DB within seconds
+WATCH_COMMIT_SECONDS = 2.0
+WATCH_BATCH_SIZE = 2000
+
+# inotify constants (<sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+EVENT_BUFFER_SIZE = 256 * 1024
+
+
+class InotifyUnavailable(Exception):
+    """inotify cannot be used here (not Linux, no libc symbol, watch limit reached)."""
+
+
+class Inotify:
+    """Minimal ctypes binding: recursive directory watches and decoded (directory, name, mask) events."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        try:
+            self._libc = ctypes.CDLL(libc_name, use_errno=True)
+            self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise InotifyUnavailable(str(e))
+        if self.fd < 0:
+            raise InotifyUnavailable(os.strerror(ctypes.get_errno()))
+        self.paths = {} # wd -> directory
+
+    def add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise InotifyUnavailable("watch limit reached (raise fs.inotify.max_user_watches)")
+            if err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                raise InotifyUnavailable(os.strerror(err))
+            return None # vanished or unreadable: nothing to watch
+        self.paths[wd] = directory
+        return wd
+
+    def add_tree(self, root):
+        """Watch root and every directory below it (symlinks are not followed, like the crawler)."""
+        count = 0
+        for directory, subdirs, _ in os.walk(root):
+            if self.add_watch(directory) is not None:
+                count += 1
+        return count
+
+    def remove_tree(self, root):
+        """Forget watches at or below root (the tree was moved away; its wd paths are stale)."""
+        prefix = os.path.join(root, "")
+        for wd, directory in list(self.paths.items()):
+            if directory == root or directory.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                self.paths.pop(wd, None)
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds; return [(directory, name, mask), ...]."""
+        readable, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((self.paths.get(wd), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchDaemon:
+    def __init__(self, dicom_dirs, db_file, max_workers=DEFAULT_WATCH_WORKERS, engine=DEFAULT_ENGINE,
+                 debounce=DEFAULT_DEBOUNCE, max_delay=DEFAULT_MAX_DELAY, poll_interval=None, use_inotify=True,
+                 initial_scan=True, scan_threads=DEFAULT_SCAN_THREADS, schema="flat", series_sample=0,
+                 retry_failed=False, name_filter=dcm_suffix_filter, sniff=False, rollups=False):
+        self.dicom_dirs = dicom_dirs
+        self.db_file = db_file
+        self.max_workers = max_workers
+        self.engine = engine
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.use_inotify = use_inotify
+        self.poll_interval = poll_interval
+        self.initial_scan = initial_scan
+        self.scan_threads = scan_threads
+        self.schema = schema
+        self.series_sample = series_sample
+        self.retry_failed = retry_failed
+        self.sniff = sniff # --sniff: every file name is a candidate, new files are checked by content
+        self.name_filter = any_file_filter if sniff else name_filter
+        self.rollups = rollups # --rollups: keep the series / study summaries current (dicom_rollup.py)
+        self.pending = {} # directory -> [set of names, first event time, last event time]
+        self.stop = False
+        self.totals = {"ingested": 0, "failed": 0, "moved": 0, "removed": 0, "flushes": 0}
+        self.inotify = None
+        self.conn = None
+        self.writer = None
+        self.executor = None # extraction pool, started once and shared by every flush
+
+    # --- setup / teardown ---
+
+    def _open_db(self):
+        self.conn = sqlite3.connect(self.db_file, timeout=30.0)
+        configure_connection(self.conn)
+        schema = resolve_schema(self.conn, self.schema)
+        if self.schema == "normalized" and schema == "flat":
+            print(f"Fatal: {self.db_file} uses the flat dicom_metadata table; "
+                  f"run 'python dicom_schema.py migrate {self.db_file}' first.")
+            sys.exit(1)
+        if schema == "normalized":
+            create_normalized_schema(self.conn)
+        else:
+            ingest.create_db_table(self.conn)
+        create_manifest_table(self.conn)
+        create_failure_table(self.conn)
+        rollups = open_rollups(self.conn, COLUMNS, schema == "normalized", replace=True, enabled=self.rollups)
+        # Arrivals may replace files already in the DB: overwrite like --rescan
+        normalized = NormalizedInserter(COLUMNS, replace=True) if schema == "normalized" else None
+        self.writer = DbWriter(self.db_file, partial(ingest.insert_batch, insert_sql=REPLACE_SQL, normalized=normalized,
+                                                     rollups=rollups),
+                               DEFAULT_COMMIT_ROWS, WATCH_COMMIT_SECONDS).start()
+
+    def _start_inotify(self):
+        try:
+            self.inotify = Inotify()
+            start = time.time()
+            watches = sum(self.inotify.add_tree(root) for root in self.dicom_dirs)
+            print(f"[{datetime.now()}] inotify: watching {watches} directories ({time.time() - start:.1f}s to set up)")
+        except InotifyUnavailable as e:
+            print(f"Warning: inotify unavailable ({e}); falling back to incremental rescans "
+                  f"every {self.poll_interval or DEFAULT_POLL_INTERVAL:.0f} seconds.")
+            if self.inotify is not None:
+                self.inotify.close()
+            self.inotify = None
+
+    def _handle_signal(self, signum, frame):
+        print(f"[{datetime.now()}] Signal {signum}: flushing pending directories and stopping...")
+        self.stop = True
+
+    # --- ingestion ---
+
+    def _ingest(self, stat_entries, label, roots=None):
+        """Manifest compare -> failure ledger -> extract -> writer, for one flush or a rescan of roots."""
+        start = time.time()
+        counts = {}
+        changes = PendingResults(WATCH_BATCH_SIZE) # relinks / removals, written by the same writer as the rows
+        changes.attach(self.writer)
+        paths = iter_changed_files(self.conn, stat_entries, changes, counts, verbose=False, roots=roots)
+        paths = skip_known_failures(paths, self.conn, self.retry_failed, verbose=False)
+        if self.sniff:
+            paths = iter_sniffed(paths, self.scan_threads, verbose=False)
+        if self.series_sample:
+            row_func = partial(ingest.extract_series_group, sample_files=self.series_sample)
+            paths = iter_directory_groups(paths)
+        else:
+            row_func = ingest.extract_metadata_row
+        ingested = failed = 0
+        batch = []
+        for _, rows in iter_extracted(row_func, paths, self.engine, self.max_workers, DEFAULT_CHUNK_SIZE,
+                                      DEFAULT_IO_THREADS, grouped=bool(self.series_sample), executor=self.executor):
+            bad = sum(1 for row in rows if isinstance(row, FailedFile))
+            failed += bad
+            ingested += len(rows) - bad
+            batch.extend(rows)
+            if len(batch) >= WATCH_BATCH_SIZE:
+                self.writer.submit(batch)
+                batch = []
+        if batch:
+            self.writer.submit(batch)
+        changes.flush()
+        self.totals["ingested"] += ingested
+        self.totals["failed"] += failed
+        self.totals["moved"] += counts.get("moved", 0)
+        self.totals["removed"] += counts.get("removed", 0)
+        self.totals["flushes"] += 1
+        if ingested or failed or counts.get("moved") or counts.get("removed"):
+            print(f"[{datetime.now()}] {label}: {counts.get('new', 0)} new, {counts.get('changed', 0)} changed, "
+                  f"{counts.get('moved', 0)} moved, {counts.get('removed', 0)} removed -> "
+                  f"{ingested} ingested, {failed} failed "
+                  f"({time.time() - start:.2f}s, committed so far: {self.writer.committed_count})")
+
+    def _stat_names(self, directory, names):
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            try:
+                yield path, os.stat(path)
+            except OSError:
+                continue # removed again before the flush
+
+    def _flush(self, now, force=False):
+        for directory, (names, first, last) in list(self.pending.items()):
+            if force or now - last >= self.debounce or now - first >= self.max_delay:
+                del self.pending[directory]
+                self._ingest(self._stat_names(directory, names), directory)
+
+    def _rescan(self, label, settle=0.0):
+        """Incremental rescan of all roots (polling mode / safety net); skips files modified in the last `settle` s."""
+        now = time.time()
+        entries = iter_crawl(self.dicom_dirs, self.scan_threads, self.name_filter, with_stat=True)
+        if settle:
+            # Still being written (no close-write event to wait for): picked up by the next rescan
+            entries = ((path, st) for path, st in entries if now - st.st_mtime >= settle)
+        self._ingest(entries, label, self.dicom_dirs)
+
+    # --- events ---
+
+    def _add(self, directory, name):
+        entry = self.pending.get(directory)
+        now = time.time()
+        if entry is None:
+            self.pending[directory] = [{name}, now, now]
+        else:
+            entry[0].add(name)
+            entry[2] = now
+
+    def _new_directory(self, path):
+        """A directory was created or moved in: watch its tree and queue files that are already there."""
+        self.inotify.remove_tree(path)
+        try:
+            self.inotify.add_tree(path)
+        except InotifyUnavailable as e:
+            print(f"Warning: cannot watch {path} ({e}); it is covered by the periodic rescan only.")
+        for directory, _, files in os.walk(path):
+            for name in files:
+                if self.name_filter(name):
+                    self._add(directory, name)
+
+    def _handle(self, directory, name, mask):
+        if mask & IN_Q_OVERFLOW:
+            print(f"[{datetime.now()}] Warning: inotify queue overflow, running an incremental rescan.")
+            self._rescan("overflow rescan")
+            return
+        if directory is None:
+            return # event for a watch removed meanwhile
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._new_directory(path)
+            elif mask & IN_MOVED_FROM:
+                self.inotify.remove_tree(path)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self.name_filter(name):
+            self._add(directory, name)
+
+    # --- main loop ---
+
+    def run(self):
+        print(f"[{datetime.now()}] Watch daemon starting: {', '.join(self.dicom_dirs)} -> {self.db_file}")
+        print(f"Debounce: {self.debounce}s per directory (max delay {self.max_delay}s) | "
+              f"Workers: {self.max_workers} ({self.engine} engine)")
+        self._open_db()
+        self.executor = make_executor(self.engine, self.max_workers, DEFAULT_IO_THREADS)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        if self.use_inotify:
+            self._start_inotify() # before the initial scan, so nothing arriving meanwhile is missed
+        if self.poll_interval is None:
+            self.poll_interval = DEFAULT_SAFETY_RESCAN if self.inotify else DEFAULT_POLL_INTERVAL
+        if self.inotify is None:
+            print(f"Mode: incremental rescan every {self.poll_interval:.0f} seconds")
+        try:
+            if self.initial_scan:
+                self._rescan("initial rescan", settle=0.0 if self.inotify else self.debounce)
+            next_rescan = time.time() + self.poll_interval
+            while not self.stop:
+                now = time.time()
+                deadlines = [next_rescan]
+                for names, first, last in self.pending.values():
+                    deadlines.append(min(last + self.debounce, first + self.max_delay))
+                timeout = max(0.0, min(deadlines) - now)
+                if self.inotify is not None:
+                    try:
+                        for directory, name, mask in self.inotify.read_events(min(timeout, 1.0)):
+                            self._handle(directory, name, mask)
+                    except InterruptedError:
+                        pass
+                else:
+                    time.sleep(min(timeout, 1.0))
+                now = time.time()
+                self._flush(now)
+                if now >= next_rescan:
+                    self._rescan("periodic rescan", settle=0.0 if self.inotify else self.debounce)
+                    next_rescan = time.time() + self.poll_interval
+            self._flush(time.time(), force=True)
+        finally:
+            self.executor.shutdown()
+            self.writer.close()
+            self.conn.close()
+            if self.inotify is not None:
+                self.inotify.close()
+        print(f"[{datetime.now()}] Watch daemon stopped: {self.totals['ingested']} files ingested, "
+              f"{self.totals['failed']} failed, {self.totals['moved']} re-linked, {self.totals['removed']} removed "
+              f"in {self.totals['flushes']} flushes.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuously ingest new DICOM files (inotify, with a polling fallback).")
+    parser.add_argument("dicom_dirs", type=str, nargs="+", help="Directories to watch (recursively).")
+    parser.add_argument("-o", "--output", type=str, default="dicom_metadata.db",
+                        help="Path to the SQLite database file (the daemon is its only writer).")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WATCH_WORKERS,
+                        help=f"Extraction workers per flush (default: {DEFAULT_WATCH_WORKERS}).")
+    parser.add_argument("-e", "--engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                        help=f"Extraction engine (default: {DEFAULT_ENGINE}; bursts are small, threads start fastest).")
+    parser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE,
+                        help=f"Seconds a directory must be quiet before its files are ingested (default: {DEFAULT_DEBOUNCE}).")
+    parser.add_argument("--max-delay", type=float, default=DEFAULT_MAX_DELAY,
+                        help=f"Ingest a directory after this many seconds even if events keep coming (default: {DEFAULT_MAX_DELAY}).")
+    parser.add_argument("--poll", action="store_true",
+                        help="Do not use inotify (network mounts written by other hosts): incremental rescans only.")
+    parser.add_argument("--poll-interval", type=float, default=None,
+                        help=f"Seconds between incremental rescans (default: {DEFAULT_POLL_INTERVAL:.0f} when polling, "
+                             f"{DEFAULT_SAFETY_RESCAN:.0f} as a safety net with inotify).")
+    parser.add_argument("--no-initial-scan", action="store_true",
+                        help="Skip the incremental rescan at startup that catches up on files that arrived while stopped.")
+    parser.add_argument("-s", "--scan-threads", type=int, default=DEFAULT_SCAN_THREADS,
+                        help=f"Threads listing directories during rescans (default: {DEFAULT_SCAN_THREADS}).")
+    parser.add_argument("--schema", choices=("flat", "normalized"), default="flat",
+                        help="Table layout for a new database (existing databases keep theirs).")
+    parser.add_argument("--series-sample", type=int, nargs="?", const=DEFAULT_SAMPLE_FILES, default=0, metavar="N",
+                        help="Series-sampling mode for each flushed directory (see dicom_ingest.py).")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Parse files in the failure ledger again even if unchanged and not due for a retry.")
+    parser.add_argument("--sniff", action="store_true",
+                        help="Also ingest DICOM files without a .dcm extension (recognised by their first 132 bytes).")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Keep the series / study summary tables up to date (see dicom_rollup.py).")
+    args = parser.parse_args()
+
+    WatchDaemon([os.path.abspath(d) for d in args.dicom_dirs], os.path.abspath(args.output),
+                args.workers, args.engine, args.debounce, args.max_delay, args.poll_interval,
+                not args.poll, not args.no_initial_scan, args.scan_threads, args.schema,
+                args.series_sample, args.retry_failed, sniff=args.sniff, rollups=args.rollups).run()
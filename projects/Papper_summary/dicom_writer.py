@@ -0,0 +1,200 @@
+# dicom_writer.py
+# Dedicated SQLite writer thread: bounded input queue, WAL mode, periodic commits
+#
+# The collection loop only hands finished batches to DbWriter.submit(); inserts,
+# commits and WAL checkpoints happen on other threads. Rows are committed every
+# commit_rows rows or commit_seconds seconds, so a killed run loses at most one
+# commit interval and the next run resumes from the last commit (committed paths
+# are filtered out as already processed).
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# --- 設定 ---
+DEFAULT_COMMIT_ROWS = 20000
+DEFAULT_COMMIT_SECONDS = 5.0
+DEFAULT_CHECKPOINT_SECONDS = 30.0
+# Batches buffered between the collection loop and the writer (backpressure beyond this)
+WRITER_QUEUE_BATCHES = 8
+
+# Applied to every connection that touches the metadata DB
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # readers (filter phase) never block the writer
+    "PRAGMA synchronous=NORMAL",     # safe with WAL: a crash can lose the last commit, never corrupt the DB
+    "PRAGMA cache_size=-262144",     # 256 MiB page cache
+    "PRAGMA mmap_size=1073741824",   # 1 GiB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+)
+
+_STOP = object()
+
+
+def configure_connection(conn):
+    """Apply CONNECTION_PRAGMAS (WAL mode is persistent in the DB file once set)."""
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+
+
+class DbWriter:
+    """Owns the write connection; insert_func(conn, batch) does the actual INSERTs for one batch."""
+
+    def __init__(self, db_file, insert_func, commit_rows=DEFAULT_COMMIT_ROWS,
+                 commit_seconds=DEFAULT_COMMIT_SECONDS, checkpoint_seconds=DEFAULT_CHECKPOINT_SECONDS,
+                 metrics=None):
+        self.db_file = db_file
+        self.insert_func = insert_func
+        self.metrics = metrics # optional dicom_metrics.Metrics: insert / commit durations
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+        self.checkpoint_seconds = checkpoint_seconds
+        self.inserted_count = 0  # rows attempted (INSERT OR IGNORE)
+        self.committed_count = 0 # rows covered by a successful commit
+        self.commit_count = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=WRITER_QUEUE_BATCHES)
+        self._stop_checkpoints = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._checkpointer = threading.Thread(target=self._checkpoint_loop, name="db-checkpoint", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._checkpointer.start()
+        return self
+
+    def submit(self, batch):
+        """Queue a batch for insertion; blocks only while the writer is WRITER_QUEUE_BATCHES behind."""
+        if self.error is not None:
+            raise RuntimeError(f"Database writer stopped: {self.error}")
+        self._queue.put(batch)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        """Flush, commit, checkpoint and stop both threads."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._stop_checkpoints.set()
+        if self._checkpointer.is_alive():
+            self._checkpointer.join()
+
+    def _commit(self, conn, pending):
+        """Commit pending rows; False (and self.error set) if the commit failed."""
+        start = time.perf_counter()
+        try:
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Fatal: Database commit error ({pending} rows not committed): {e}")
+            self.error = e
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            return False
+        self.committed_count += pending
+        self.commit_count += 1
+        if self.metrics is not None:
+            self.metrics.observe("writer_seconds", "commit", time.perf_counter() - start)
+            self.metrics.inc("rows_committed", pending)
+            self.metrics.inc("commits")
+        return True
+
+    def _run(self):
+        try:
+            conn = sqlite3.connect(self.db_file, timeout=30.0)
+            configure_connection(conn)
+            # Checkpoints run on the checkpoint thread, not inside our commits
+            conn.execute("PRAGMA wal_autocheckpoint=0")
+        except sqlite3.Error as e:
+            print(f"Fatal: Database writer could not open {self.db_file}: {e}")
+            self.error = e
+            self._drain()
+            return
+
+        pending = 0
+        last_commit = time.time()
+        while True:
+            try:
+                batch = self._queue.get(timeout=self.commit_seconds)
+            except queue.Empty:
+                batch = None # Timer tick: commit whatever is pending
+            if batch is _STOP:
+                break
+            if batch:
+                try:
+                    start = time.perf_counter()
+                    inserted = self.insert_func(conn, batch)
+                    self.inserted_count += inserted
+                    if self.metrics is not None:
+                        self.metrics.observe("writer_seconds", "insert_batch", time.perf_counter() - start)
+                except Exception as e:
+                    print(f"Fatal: Database writer error: {e}")
+                    self.error = e
+                    self._drain()
+                    break
+                pending += inserted # rows, not FailedFile entries (or records of a rolled-back batch)
+            # in_transaction: failure-only batches still have ledger writes to commit
+            if conn.in_transaction and (pending >= self.commit_rows or time.time() - last_commit >= self.commit_seconds):
+                if not self._commit(conn, pending):
+                    self._drain() # later batches would pile up behind a DB that cannot commit
+                    break
+                pending = 0
+                last_commit = time.time()
+
+        if conn.in_transaction and self.error is None:
+            self._commit(conn, pending)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            print(f"Warning: final WAL checkpoint failed: {e}")
+        conn.close()
+        print(f"[{datetime.now()}] Database writer finished: {self.committed_count} rows committed in {self.commit_count} commits.")
+
+    def _drain(self):
+        """After a fatal error: discard batches until close() so submit()/close() never block on a dead writer."""
+        while self._queue.get() is not _STOP:
+            pass
+
+    def _checkpoint_loop(self):
+        """Background PASSIVE checkpoints keep the WAL file from growing without limit."""
+        conn = None
+        try:
+            conn = sqlite3.connect(self.db_file, timeout=30.0)
+            while not self._stop_checkpoints.wait(self.checkpoint_seconds):
+                conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except sqlite3.Error as e:
+            print(f"Warning: background WAL checkpoint failed: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+
+class PendingResults:
+    """Results produced next to the extraction engines (dedup links, rescan relinks), queued for a DbWriter.
+
+    The pipeline stage that produces them runs on the main connection and
+    never writes; they reach the DB through the writer's insert_func like
+    parsed rows, in batches of batch_size. Attach the writer before the stage
+    starts pulling paths, flush() once it is exhausted.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.writer = None
+        self.pending = []
+
+    def attach(self, writer):
+        self.writer = writer
+
+    def add(self, results):
+        self.pending.extend(results)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending and self.writer is not None:
+            self.writer.submit(self.pending)
+            self.pending = []